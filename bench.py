@@ -0,0 +1,404 @@
+"""Load generator and benchmark of WorkerSPY server.
+
+Runs server in its own process and simulated clients (client.py protocol) in one asyncio
+event loop of this process, so thousands of clients don't take thousands of threads.
+Measures connections per second, MB/s of received payload, latency from command being
+sent to client until its answer is stored, server's memory and threads, and prints
+results as JSON to compare runs:
+
+    python bench.py --clients 2000 --mode asyncio --output before.json
+"""
+import os
+import sys
+import json
+import time
+import socket
+import asyncio
+import argparse
+import shutil
+import tempfile
+import threading
+import multiprocessing
+from functools import lru_cache
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows
+    resource = None
+
+import server
+from client import Client, FRAME_V2, SUPPORTED_CODECS, compress, generated_screen
+
+
+def synthetic_processes(count: int) -> bytes:
+    """ProcessJSON with count processes."""
+    processes = [{'exe': f'process_{number}.exe', 'pid': 1000 + number} for number in range(count)]
+    return json.dumps({'processes': processes}).encode('utf-8')
+
+
+def percentile(values: list, percent: float) -> float:
+    """Nearest-rank percentile of sorted values."""
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, max(0, int(round(percent / 100.0 * len(values))) - 1))]
+
+
+def process_status() -> dict:
+    """Memory and threads of this process."""
+    status = {'rss_mb': 0.0, 'peak_rss_mb': 0.0, 'threads': threading.active_count()}
+    try:
+        with open('/proc/self/status') as f:
+            fields = dict(line.split(':', 1) for line in f if ':' in line)
+        status['rss_mb'] = int(fields['VmRSS'].split()[0]) / 1024
+        status['peak_rss_mb'] = int(fields['VmHWM'].split()[0]) / 1024
+        status['threads'] = int(fields['Threads'])
+    except (OSError, KeyError, ValueError):
+        if resource is not None:
+            status['peak_rss_mb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    return status
+
+
+def raise_open_files_limit() -> None:
+    """Every client takes a descriptor on both sides."""
+    if resource is None:
+        return
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+
+class BenchServer:
+    """Server without menu, controlled by benchmark through ShardChannel.
+
+    Time a command is put to client's outbox is remembered, and latency is counted when
+    screenshot store or process store has written client's answer.
+    """
+    def __init__(self, connection, **kwargs):
+        self.channel = server.ShardChannel(connection, self.handle_bench_request)
+        self.shutdown = threading.Event()
+        self.bench_lock = threading.Lock()
+        self.sent = {}              # MAC -> monotonic time command was sent
+        self.latencies = []
+        self.payload_bytes = 0
+        self.expected = 0
+        self.round_done = threading.Event()
+        super().__init__(**kwargs)
+
+        send = self.dispatcher.send
+        def timed_send(session, data):
+            with self.bench_lock:
+                self.sent.setdefault(session.mac, time.monotonic())
+            return send(session, data)
+        self.dispatcher.send = timed_send
+
+        store = self.screenshots.store
+        def timed_store(client_id, received_at, bmp, path=None):
+            store(client_id, received_at, bmp, path)
+            self.stored(client_id.replace('_', ':'))
+        self.screenshots.store = timed_store
+
+        write_changes = self.processes.write_changes
+        def timed_write_changes(connection, client_mac, ts, message):
+            write_changes(connection, client_mac, ts, message)
+            self.stored(client_mac)
+        self.processes.write_changes = timed_write_changes
+
+    def announce_start(self, mode: str = "") -> None:
+        self.channel.notify('started', self.PORT)
+
+    def announce_stop(self) -> None:
+        pass
+
+    def menu_loop(self) -> None:
+        self.shutdown.wait()
+        self.server_running = False
+
+    def handle_frame(self, session: server.ClientSession, frame: server.Frame) -> None:
+        size = len(frame.payload) if frame.payload is not None else 0
+        with self.bench_lock:
+            self.payload_bytes += size
+        super().handle_frame(session, frame)
+
+    def stored(self, client_mac: str) -> None:
+        with self.bench_lock:
+            sent_at = self.sent.pop(client_mac, None)
+            if sent_at is None:
+                return
+            self.latencies.append(time.monotonic() - sent_at)
+            if len(self.latencies) >= self.expected:
+                self.round_done.set()
+
+    def run_round(self, command_option: int, expected: int, timeout: float) -> dict:
+        """Send command to all clients and wait until expected answers are stored."""
+        with self.bench_lock:
+            self.sent.clear()
+            self.latencies = []
+            self.payload_bytes = 0
+            self.expected = expected
+            self.round_done.clear()
+
+        started = time.monotonic()
+        self.send_Command_to_all(command_option)
+        if expected:
+            self.round_done.wait(timeout)
+        seconds = time.monotonic() - started
+
+        with self.bench_lock:
+            return {'seconds': seconds, 'stored': len(self.latencies), 'bytes': self.payload_bytes,
+                    'latencies': sorted(self.latencies)}
+
+    def handle_bench_request(self, method: str, args: tuple):
+        if method == 'round':
+            return self.run_round(*args)
+        if method == 'stats':
+            return dict(process_status(), clients=len(self.clients))
+        if method == 'stop':
+            self.shutdown.set()
+            return None
+        raise ValueError(f"Unknown request {method}")
+
+
+class ThreadedBenchServer(BenchServer, server.Server):
+    pass
+
+
+class AsyncBenchServer(BenchServer, server.AsyncServer):
+    pass
+
+
+def run_bench_server(connection, mode: str, workdir: str, verbose: bool, kwargs: dict) -> None:
+    """Entry point of server process."""
+    os.chdir(workdir)
+    raise_open_files_limit()
+    if not verbose:
+        # Server logs every frame, printing them would be measured too
+        sys.stdout = open(os.devnull, 'w')
+    server_class = AsyncBenchServer if mode == 'asyncio' else ThreadedBenchServer
+    server_class(connection, **kwargs).start_server()
+
+
+cached_compress = lru_cache(maxsize=8)(compress)
+
+
+class SimulatedClient(Client):
+    """Client.py protocol over asyncio streams. Every client sends the same payloads,
+    so they are compressed once for all clients."""
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, verbose=False, **kwargs)
+        self.reader = None
+        self.writer = None
+
+    async def connect_async(self) -> None:
+        reader, self.writer = await asyncio.open_connection(self.host, self.port)
+        await reader.readexactly(len(b"SEND_MAC"))
+        self.writer.write(self.hello())
+        if self.protocol == 2:
+            header = await reader.readexactly(FRAME_V2.size)
+            self.accept_hello(header, await reader.readexactly(FRAME_V2.unpack(header)[4]))
+        self.reader = reader
+
+    async def run_async(self) -> None:
+        while True:
+            data = await self.reader.read(65536)
+            if not data:
+                return
+            for command, request_id in self.parse_commands(data):
+                if not self.handle(command, request_id):
+                    return
+            await self.writer.drain()
+
+    def send_frame(self, command: str, payload: bytes, request_id: int = 0) -> None:
+        for data in self.encode_frame(command, payload, request_id):
+            self.writer.write(data)
+
+    def compress(self, payload: bytes) -> bytes:
+        return cached_compress(payload, self.codec)
+
+    def close(self) -> None:
+        if self.writer is not None:
+            self.writer.close()
+
+
+class Benchmark:
+    """Connects simulated clients and runs rounds of commands, collects results."""
+    def __init__(self, args):
+        self.args = args
+        self.channel = None
+        self.started = threading.Event()
+        self.port = None
+        self.clients = []
+        self.tasks = []
+        self.failed = {}            # Reason -> clients that didn't connect
+        self.connected_at = 0.0     # Monotonic time the last client finished handshake
+
+    def handle_server_request(self, method: str, args: tuple):
+        if method == 'started':
+            self.port = args[0]
+            self.started.set()
+        return None
+
+    def server_options(self) -> dict:
+        args = self.args
+        return dict(
+            host='127.0.0.1', port=args.port, backlog=args.backlog, screen_format=args.screen_format,
+            payload_sink=args.payload_sink, max_uploads=args.max_uploads,
+            memory_budget=args.memory_budget * 1024 * 1024, dedup_screens=False
+        )
+
+    async def connect_clients(self, processes: bytes, screen: bytes) -> float:
+        """Connect all clients, at most args.concurrency handshakes at once, and wait until server registers them.
+        Return: seconds until the last client connected, failed clients waiting for connect_timeout aren't counted"""
+        limit = asyncio.Semaphore(self.args.concurrency)
+        codecs = tuple(codec for codec in self.args.codecs.split(',') if codec)
+
+        async def connect(number):
+            client = SimulatedClient('127.0.0.1', self.port, f'BE:{number >> 24 & 0xFF:02X}:{number >> 16 & 0xFF:02X}:'
+                                     f'{number >> 8 & 0xFF:02X}:{number & 0xFF:02X}:00', self.args.protocol, codecs,
+                                     screen=screen, processes=processes)
+            async with limit:
+                try:
+                    # Connections dropped from full backlog are retried by kernel, slow ones count as failed
+                    await asyncio.wait_for(client.connect_async(), self.args.connect_timeout)
+                except (OSError, asyncio.IncompleteReadError, asyncio.TimeoutError) as e:
+                    reason = 'timeout' if isinstance(e, asyncio.TimeoutError) else type(e).__name__
+                    self.failed[reason] = self.failed.get(reason, 0) + 1
+                    return
+            self.connected_at = time.monotonic()
+            self.clients.append(client)
+            self.tasks.append(asyncio.create_task(client.run_async()))
+
+        started = time.monotonic()
+        await asyncio.gather(*(connect(number) for number in range(self.args.clients)))
+
+        deadline = started + self.args.timeout
+        while time.monotonic() < deadline:
+            stats = await self.call('stats')
+            if stats['clients'] >= len(self.clients):
+                break
+            await asyncio.sleep(0.05)
+        return max(self.connected_at - started, 0.0)
+
+    async def call(self, method: str, *args, timeout: float = None):
+        return await asyncio.get_running_loop().run_in_executor(None, lambda: self.channel.call(method, *args, timeout=timeout))
+
+    async def run_rounds(self, command_option: int, rounds: int) -> dict:
+        results = {'rounds': rounds, 'stored': 0, 'expected': len(self.clients) * rounds, 'mb': 0.0, 'seconds': 0.0}
+        latencies = []
+        for _ in range(rounds):
+            result = await self.call('round', command_option, len(self.clients), self.args.timeout)
+            results['stored'] += result['stored']
+            results['mb'] += result['bytes'] / (1024 * 1024)
+            results['seconds'] += result['seconds']
+            latencies.extend(result['latencies'])
+
+        latencies.sort()
+        results['mb_per_sec'] = results['mb'] / results['seconds'] if results['seconds'] else 0.0
+        results['latency_p50'] = percentile(latencies, 50)
+        results['latency_p99'] = percentile(latencies, 99)
+        results['latency_max'] = latencies[-1] if latencies else 0.0
+        return results
+
+    async def run_clients(self) -> dict:
+        args = self.args
+        processes = synthetic_processes(args.processes)
+        screen = generated_screen(args.screen_width, args.screen_height)
+
+        connect_seconds = await self.connect_clients(processes, screen)
+        report = {
+            'connect': {
+                'clients': len(self.clients),
+                'seconds': connect_seconds,
+                'per_sec': len(self.clients) / connect_seconds if connect_seconds else 0.0,
+            },
+            'connect_failed': {
+                'clients': sum(self.failed.values()),
+                'reasons': self.failed,
+            },
+            'server_connected': await self.call('stats'),
+        }
+        report['stat'] = await self.run_rounds(1, args.stat_rounds)
+        report['screen'] = await self.run_rounds(2, args.screen_rounds)
+        report['server'] = await self.call('stats')
+
+        for client in self.clients:
+            client.close()
+        if self.tasks:
+            await asyncio.wait(self.tasks, timeout=5.0)
+        return report
+
+    def run(self) -> dict:
+        args = self.args
+        raise_open_files_limit()
+        context = multiprocessing.get_context('spawn')
+        own_connection, server_connection = context.Pipe()
+        workdir = args.workdir or tempfile.mkdtemp(prefix='workerspy-bench-')
+
+        process = context.Process(
+            target=run_bench_server,
+            args=(server_connection, args.mode, workdir, args.verbose, self.server_options()),
+            name="BenchServer"
+        )
+        process.start()
+        self.channel = server.ShardChannel(own_connection, self.handle_server_request, handler_threads=1)
+
+        try:
+            if not self.started.wait(30.0):
+                raise RuntimeError("Server didn't start")
+            report = asyncio.run(self.run_clients())
+        finally:
+            try:
+                self.channel.call('stop', timeout=10.0)
+            except (ConnectionResetError, RuntimeError, server.FutureTimeoutError):
+                pass
+            process.join(30.0)
+            if process.is_alive():
+                process.terminate()
+            self.channel.close()
+            if not args.workdir:
+                shutil.rmtree(workdir, ignore_errors=True)
+
+        report['config'] = {key: value for key, value in vars(args).items() if key not in ('output', 'verbose')}
+        report['client'] = process_status()
+        return report
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="WorkerSPY server benchmark")
+    parser.add_argument("--clients", type=int, default=1000, help="Number of simulated clients (default: 1000)")
+    parser.add_argument("--concurrency", type=int, default=200, help="Handshakes at once (default: 200)")
+    parser.add_argument("--protocol", type=int, choices=(1, 2), default=2, help="Protocol of clients (default: 2)")
+    parser.add_argument("--codecs", default=','.join(SUPPORTED_CODECS), help="Compressions offered by clients, '' - none")
+    parser.add_argument("--processes", type=int, default=200, help="Processes in every process list (default: 200)")
+    parser.add_argument("--screen-width", type=int, default=640, help="Width of screenshots (default: 640)")
+    parser.add_argument("--screen-height", type=int, default=480, help="Height of screenshots (default: 480)")
+    parser.add_argument("--stat-rounds", type=int, default=3, help="SEND_STAT rounds (default: 3)")
+    parser.add_argument("--screen-rounds", type=int, default=1, help="SEND_SCREEN rounds (default: 1)")
+    parser.add_argument("--connect-timeout", type=float, default=10.0, help="Seconds for one client to connect (default: 10)")
+    parser.add_argument("--timeout", type=float, default=120.0, help="Seconds to wait for one round (default: 120)")
+    parser.add_argument("--mode", choices=("threads", "asyncio"), default="threads", help="Server mode (default: threads)")
+    parser.add_argument("--port", type=int, default=0, help="Server port (default: any free port)")
+    parser.add_argument("--backlog", type=int, default=socket.SOMAXCONN,
+                        help=f"Server's listen backlog (default: SOMAXCONN, {socket.SOMAXCONN})")
+    parser.add_argument("--screen-format", choices=("png", "bmp", "delta"), default="png", help="Server's screen format")
+    parser.add_argument("--payload-sink", choices=("file", "memory"), default="file", help="Server's payload sink")
+    parser.add_argument("--max-uploads", type=int, default=16, help="Server's concurrent screen uploads")
+    parser.add_argument("--memory-budget", type=int, default=256, help="Server's memory budget, MB")
+    parser.add_argument("--workdir", help="Directory for server's files (default: temporary directory removed after run)")
+    parser.add_argument("--output", help="Write JSON report to file as well")
+    parser.add_argument("--verbose", action="store_true", help="Show server's log")
+    args = parser.parse_args()
+    args.port = args.port or free_port()
+
+    report = Benchmark(args).run()
+    text = json.dumps(report, indent=2)
+    print(text)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + "\n")
@@ -0,0 +1,326 @@
+"""Reference client of WorkerSPY server in Python.
+
+Speaks both protocols of server.py:
+    v1 - text headers '<Command>, <size>\\n', the same as client.cpp sends,
+    v2 - binary frames with request IDs and zlib/lz4 compression negotiated in Hello.
+Process list is taken from psutil or /proc, screen is read from BMP file or generated,
+so client runs on any OS and may be used to test server without Windows clients.
+"""
+import sys
+import os
+import json
+import zlib
+import uuid
+import struct
+import socket
+import argparse
+from datetime import datetime
+from functools import lru_cache
+
+try:
+    import lz4.frame as lz4_frame
+except ImportError:
+    lz4_frame = None
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+
+# Protocol v2 frame header, must match server.py
+FRAME_V2 = struct.Struct('!2sBBIII')
+FRAME_V2_MAGIC = b'W2'
+FRAME_TYPES = {1: "Hello", 2: "Command", 3: "ProcessJSON", 4: "ScreenShot BMP"}
+FRAME_TYPE_IDS = {name: frame_type for frame_type, name in FRAME_TYPES.items()}
+FRAME_CODEC_MASK = 0x03
+FRAME_CODECS = {0: None, 1: 'zlib', 2: 'lz4'}
+FRAME_CODEC_IDS = {codec: flag for flag, codec in FRAME_CODECS.items()}
+SUPPORTED_CODECS = ('lz4', 'zlib') if lz4_frame is not None else ('zlib',)
+
+
+def compress(data: bytes, codec: str) -> bytes:
+    """Compress payload with negotiated codec.
+
+    ARGS:   data: payload,
+            codec: 'zlib', 'lz4' or None
+    Return: compressed payload, None if it isn't smaller than data
+    """
+    if codec == 'zlib':
+        compressed = zlib.compress(data, 1)
+    elif codec == 'lz4':
+        compressed = lz4_frame.compress(data)
+    else:
+        return None
+    return compressed if len(compressed) < len(data) else None
+
+
+def decompress(data: bytes, codec: str) -> bytes:
+    if codec == 'zlib':
+        return zlib.decompress(data)
+    if codec == 'lz4':
+        return lz4_frame.decompress(data)
+    return data
+
+
+def process_list() -> bytes:
+    """Running processes as ProcessJSON '{ "processes": [{ "exe": ..., "pid": ... }, ...] }'."""
+    processes = []
+
+    if psutil is not None:
+        for process in psutil.process_iter(['name', 'pid']):
+            processes.append({'exe': process.info['name'] or '', 'pid': process.info['pid']})
+    elif os.path.isdir('/proc'):
+        for pid in os.listdir('/proc'):
+            if not pid.isdigit():
+                continue
+            try:
+                with open(f'/proc/{pid}/comm', encoding='utf-8', errors='replace') as f:
+                    processes.append({'exe': f.read().strip(), 'pid': int(pid)})
+            except OSError:
+                # Process exited while list was read
+                pass
+
+    return json.dumps({'processes': processes}).encode('utf-8')
+
+
+@lru_cache(maxsize=4)
+def generated_screen(width: int, height: int) -> bytes:
+    """32-bit BMP with gradient, compresses like a real desktop rather than noise."""
+    row = bytes((x * 255 // max(width - 1, 1)) for x in range(width))
+    pixels = bytearray()
+    for y in range(height):
+        shade = y * 255 // max(height - 1, 1)
+        pixels += bytes(value for x in row for value in (x, shade, 255 - x, 0))
+
+    info_header = struct.pack('<IiiHHIIiiII', 40, width, height, 1, 32, 0, len(pixels), 0, 0, 0, 0)
+    offset = 14 + len(info_header)
+    file_header = struct.pack('<2sIHHI', b'BM', offset + len(pixels), 0, 0, offset)
+    return file_header + info_header + bytes(pixels)
+
+
+def default_mac() -> str:
+    node = uuid.getnode()
+    return ':'.join(f'{(node >> shift) & 0xFF:02X}' for shift in range(40, -8, -8))
+
+
+class Client:
+    """Connection to server answering its commands.
+
+    In protocol v1 commands come without delimiter, so they are split by known names.
+    In protocol v2 every answer carries request ID of the command, so server may send
+    many commands without waiting (pipelining) and match answers to them.
+    """
+    COMMANDS = ("SEND_STAT", "SEND_SCREEN", "DEAUTH_REQUEST", "SEND_MAC")
+
+    def __init__(self, host: str = '127.0.0.1', port: int = 8888, mac: str = None, protocol: int = 2,
+                 codecs: tuple = SUPPORTED_CODECS, screen: bytes = None, screen_size: tuple = (1280, 720),
+                 processes: bytes = None, verbose: bool = True):
+        self.host = host
+        self.port = port
+        self.mac = mac or default_mac()
+        self.protocol = protocol
+        self.codecs = codecs        # Offered to server in preference order
+        self.codec = None           # Chosen by server
+        self.screen = screen        # BMP sent for SEND_SCREEN, None - generated of screen_size
+        self.screen_size = screen_size
+        self.processes = processes  # ProcessJSON sent for SEND_STAT, None - running processes
+        self.verbose = verbose
+        self.sock = None
+        self.buffer = bytearray()   # Received bytes not parsed into commands yet
+
+    def log(self, message: str) -> None:
+        if self.verbose:
+            print(f"[{datetime.now().strftime('%H:%M:%S')}] {message}")
+
+    def connect(self, timeout: float = 30.0) -> None:
+        """Connect and pass handshake."""
+        self.sock = socket.create_connection((self.host, self.port), timeout=timeout)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+        self.receive_exact(len(b"SEND_MAC"))
+        self.sock.sendall(self.hello())
+        if self.protocol == 2:
+            header = self.receive_exact(FRAME_V2.size)
+            self.accept_hello(header, self.receive_exact(FRAME_V2.unpack(header)[4]))
+        self.log_connected()
+
+    def hello(self) -> bytes:
+        """Answer to SEND_MAC."""
+        mac = self.mac.encode('utf-8')
+        if self.protocol == 1:
+            # Header and MAC in one segment, server doesn't need them to come separately
+            return b"MAC_ADDRESS, %d" % len(mac) + mac
+
+        hello = json.dumps({'mac': self.mac, 'codecs': list(self.codecs), 'version': 2}).encode('utf-8')
+        return FRAME_V2.pack(FRAME_V2_MAGIC, FRAME_TYPE_IDS["Hello"], 0, 0, len(hello), len(hello)) + hello
+
+    def accept_hello(self, header: bytes, payload: bytes) -> None:
+        """Take compression chosen by server from its Hello."""
+        magic, frame_type, _, _, _, _ = FRAME_V2.unpack(header)
+        if magic != FRAME_V2_MAGIC or frame_type != FRAME_TYPE_IDS["Hello"]:
+            raise ConnectionError("Server doesn't support protocol v2")
+        self.codec = json.loads(payload)['codec']
+
+    def log_connected(self) -> None:
+        self.log(f"Connected to {self.host}:{self.port} as {self.mac}, protocol v{self.protocol}"
+                 + (f", compression {self.codec}" if self.protocol == 2 else ""))
+
+    def receive_exact(self, size: int) -> bytes:
+        while len(self.buffer) < size:
+            data = self.sock.recv(65536)
+            if not data:
+                raise ConnectionResetError("Connection closed by server")
+            self.buffer += data
+
+        data = bytes(self.buffer[:size])
+        del self.buffer[:size]
+        return data
+
+    def receive_commands(self) -> list:
+        """Receive data from server and cut it into commands.
+
+        Return: list of (command, request_id), None if connection was closed
+        """
+        data = self.sock.recv(65536)
+        if not data:
+            return None
+        return self.parse_commands(data)
+
+    def parse_commands(self, data: bytes) -> list:
+        """Cut received data into commands, incomplete command is kept in buffer.
+
+        ARGS:   data: bytes received from server
+        Return: list of (command, request_id)
+        """
+        self.buffer += data
+        commands = []
+        if self.protocol == 1:
+            while self.buffer:
+                command = next((command for command in self.COMMANDS if self.buffer.startswith(command.encode())), None)
+                if command is not None:
+                    del self.buffer[:len(command)]
+                    commands.append((command, 0))
+                elif any(command.encode().startswith(self.buffer) for command in self.COMMANDS):
+                    break
+                else:
+                    self.log(f"Unknown command {bytes(self.buffer)!r}")
+                    self.buffer.clear()
+            return commands
+
+        while len(self.buffer) >= FRAME_V2.size:
+            magic, frame_type, flags, request_id, size, _ = FRAME_V2.unpack_from(self.buffer)
+            if magic != FRAME_V2_MAGIC:
+                raise ConnectionError(f"Invalid frame magic {magic!r}")
+            if len(self.buffer) < FRAME_V2.size + size:
+                break
+
+            payload = bytes(self.buffer[FRAME_V2.size:FRAME_V2.size + size])
+            del self.buffer[:FRAME_V2.size + size]
+            if frame_type == FRAME_TYPE_IDS["Command"]:
+                payload = decompress(payload, FRAME_CODECS.get(flags & FRAME_CODEC_MASK))
+                commands.append((payload.decode('utf-8', errors='replace'), request_id))
+        return commands
+
+    def send_frame(self, command: str, payload: bytes, request_id: int = 0) -> None:
+        """Send ProcessJSON or ScreenShot BMP.
+
+        ARGS:   command: frame command,
+                payload: uncompressed payload,
+                request_id: ID of command it answers
+        Return: None
+        """
+        for data in self.encode_frame(command, payload, request_id):
+            self.sock.sendall(data)
+
+    def encode_frame(self, command: str, payload: bytes, request_id: int = 0) -> tuple:
+        """Header and payload as they are sent, payload isn't copied to be joined with header."""
+        if self.protocol == 1:
+            return f"{command}, {len(payload)}\n".encode('utf-8'), payload
+
+        compressed = self.compress(payload)
+        flags = FRAME_CODEC_IDS[self.codec] if compressed is not None else 0
+        data = compressed if compressed is not None else payload
+        return FRAME_V2.pack(FRAME_V2_MAGIC, FRAME_TYPE_IDS[command], flags, request_id, len(data), len(payload)), data
+
+    def compress(self, payload: bytes) -> bytes:
+        return compress(payload, self.codec)
+
+    def screenshot(self) -> bytes:
+        return self.screen if self.screen is not None else generated_screen(*self.screen_size)
+
+    def handle(self, command: str, request_id: int = 0) -> bool:
+        """Answer server's command.
+
+        ARGS:   command: command received from server,
+                request_id: its request ID (protocol v2)
+        Return: False if client must disconnect
+        """
+        if command == "SEND_STAT":
+            self.send_frame("ProcessJSON", self.processes if self.processes is not None else process_list(), request_id)
+        elif command == "SEND_SCREEN":
+            self.send_frame("ScreenShot BMP", self.screenshot(), request_id)
+        elif command == "DEAUTH_REQUEST":
+            self.log("Deauthorized by server")
+            return False
+        else:
+            self.log(f"Unknown command {command}")
+        return True
+
+    def run(self) -> None:
+        """Answer commands until server deauthorizes client or closes connection."""
+        self.sock.settimeout(None)
+        while True:
+            commands = self.receive_commands()
+            if commands is None:
+                self.log("Connection closed by server")
+                return
+
+            for command, request_id in commands:
+                if not self.handle(command, request_id):
+                    return
+
+    def close(self) -> None:
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="WorkerSPY client")
+    parser.add_argument("host", nargs='?', default='127.0.0.1', help="Server address (default: 127.0.0.1)")
+    parser.add_argument("port", nargs='?', type=int, default=8888, help="Server port (default: 8888)")
+    parser.add_argument("--mac", help="MAC address sent to server (default: MAC of this computer)")
+    parser.add_argument("--protocol", type=int, choices=(1, 2), default=2, help="Protocol version (default: 2)")
+    parser.add_argument("--codecs", default=','.join(SUPPORTED_CODECS),
+                        help=f"Compressions offered to server in protocol v2, comma separated (default: {','.join(SUPPORTED_CODECS)})")
+    parser.add_argument("--screen", help="BMP file sent as screen (default: generated picture)")
+    parser.add_argument("--screen-size", default='1280x720', help="Size of generated picture (default: 1280x720)")
+    args = parser.parse_args()
+
+    codecs = tuple(codec for codec in args.codecs.split(',') if codec)
+    unsupported = [codec for codec in codecs if codec not in SUPPORTED_CODECS]
+    if unsupported:
+        parser.error(f"unsupported compression: {', '.join(unsupported)}")
+
+    screen = None
+    if args.screen:
+        with open(args.screen, 'rb') as f:
+            screen = f.read()
+
+    try:
+        width, height = (int(value) for value in args.screen_size.lower().split('x'))
+    except ValueError:
+        parser.error("--screen-size must be WIDTHxHEIGHT")
+
+    client = Client(args.host, args.port, args.mac, args.protocol, codecs, screen, (width, height))
+    try:
+        client.connect()
+        client.run()
+    except KeyboardInterrupt:
+        pass
+    except OSError as e:
+        print(f"Connection error: {e}")
+        sys.exit(1)
+    finally:
+        client.close()
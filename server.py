@@ -1,106 +1,3355 @@
+import sys
+import errno
 import threading
+import asyncio
+import argparse
 import socket
+import queue
 import json
-from datetime import datetime
+import time
+import os
+import struct
+import zlib
+import hashlib
+import bisect
+import sqlite3
+import signal
+import multiprocessing
+import heapq
+import random
+import tempfile
+import mmap
+import hmac
+import secrets
+from concurrent.futures import Future, ThreadPoolExecutor, wait, TimeoutError as FutureTimeoutError
+from collections import OrderedDict, deque
+from datetime import datetime, timedelta
 from pathlib import Path
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qsl, urlencode
+from html import escape
+
+try:
+    import numpy as np
+except ImportError:
+    # Screens are compared with bytes slices if NumPy isn't installed
+    np = None
+
+try:
+    import lz4.frame as lz4_frame
+except ImportError:
+    # Protocol v2 compresses with zlib only if lz4 isn't installed
+    lz4_frame = None
+
+
+def parse_timedelta(value: str) -> timedelta:
+    """Parse str(timedelta) like '1 day, 2:03:04.500000' back to timedelta."""
+    days = 0
+    if 'day' in value:
+        days_part, value = value.split(',')
+        days = int(days_part.split()[0])
+    hours, minutes, seconds = value.strip().split(':')
+    return timedelta(days=days, hours=int(hours), minutes=int(minutes), seconds=float(seconds))
+
+
+class ProtocolError(ValueError):
+    """Client sent data that doesn't follow '<Command>, <size>\\n' framing."""
+
+
+# Protocol v2 frame header: magic, type, flags, request ID, payload length, uncompressed length
+FRAME_V2 = struct.Struct('!2sBBIII')
+FRAME_V2_MAGIC = b'W2'
+FRAME_TYPES = {1: "Hello", 2: "Command", 3: "ProcessJSON", 4: "ScreenShot BMP"}
+FRAME_TYPE_IDS = {name: frame_type for frame_type, name in FRAME_TYPES.items()}
+FRAME_CODEC_MASK = 0x03     # Low bits of flags
+FRAME_CODECS = {0: None, 1: 'zlib', 2: 'lz4'}
+FRAME_CODEC_IDS = {codec: flag for flag, codec in FRAME_CODECS.items()}
+SUPPORTED_CODECS = ('lz4', 'zlib') if lz4_frame is not None else ('zlib',)
+
+
+class Counter:
+    """Monotonic counter, one value per combination of label values."""
+    kind = 'counter'
+
+    def __init__(self, name: str, documentation: str, labels: tuple = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self.values = {}        # Label values -> value
+        self.lock = threading.Lock()
+
+    def inc(self, amount: float = 1, labels: tuple = ()) -> None:
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def samples(self) -> list:
+        with self.lock:
+            return [(self.name, dict(zip(self.labels, labels)), value) for labels, value in self.values.items()]
+
+
+class Histogram:
+    """Distribution of observed values in cumulative buckets, like Prometheus histogram."""
+    kind = 'histogram'
+    BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+    def __init__(self, name: str, documentation: str, labels: tuple = (), buckets: tuple = BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self.buckets = buckets
+        self.values = {}        # Label values -> [count per bucket (last is +Inf), sum]
+        self.lock = threading.Lock()
+
+    def observe(self, value: float, labels: tuple = ()) -> None:
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            state = self.values.get(labels)
+            if state is None:
+                state = self.values[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+            state[0][index] += 1
+            state[1] += value
+
+    def samples(self) -> list:
+        samples = []
+        with self.lock:
+            values = [(labels, list(counts), total) for labels, (counts, total) in self.values.items()]
+
+        for labels, counts, total in values:
+            names = dict(zip(self.labels, labels))
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                samples.append((self.name + '_bucket', dict(names, le='+Inf' if bound == float('inf') else repr(bound)), cumulative))
+            samples.append((self.name + '_sum', names, total))
+            samples.append((self.name + '_count', names, cumulative))
+        return samples
+
+
+class Gauge:
+    """Current value taken from function when metrics are collected."""
+    kind = 'gauge'
+
+    def __init__(self, name: str, documentation: str, function):
+        self.name = name
+        self.documentation = documentation
+        self.function = function
+
+    def samples(self) -> list:
+        return [(self.name, {}, self.function())]
+
+
+class Metrics:
+    """Registry of process's metrics, rendered in Prometheus text exposition format.
+
+    Updating counter or histogram takes one uncontended lock, gauges are computed only
+    when metrics are collected, so instrumentation of hot paths costs next to nothing.
+    """
+    def __init__(self):
+        self.families = OrderedDict()   # Name -> Counter, Histogram or Gauge
+        self.lock = threading.Lock()
+
+    def register(self, family):
+        with self.lock:
+            self.families[family.name] = family
+        return family
+
+    def counter(self, name: str, documentation: str, labels: tuple = ()) -> Counter:
+        return self.register(Counter(name, documentation, labels))
+
+    def histogram(self, name: str, documentation: str, labels: tuple = (), buckets: tuple = Histogram.BUCKETS) -> Histogram:
+        return self.register(Histogram(name, documentation, labels, buckets))
+
+    def gauge(self, name: str, documentation: str, function) -> Gauge:
+        """Register gauge, gauge registered with the same name before is replaced."""
+        return self.register(Gauge(name, documentation, function))
+
+    def collect(self) -> list:
+        """Picklable snapshot: [(name, kind, documentation, [(sample name, labels, value), ...]), ...]"""
+        with self.lock:
+            families = list(self.families.values())
+        return [(family.name, family.kind, family.documentation, family.samples()) for family in families]
+
+    @staticmethod
+    def render(collected: list) -> str:
+        lines = []
+        for name, kind, documentation, samples in collected:
+            lines.append(f"# HELP {name} {documentation}")
+            lines.append(f"# TYPE {name} {kind}")
+            for sample_name, labels, value in samples:
+                if labels:
+                    label_text = ','.join(f'{key}="{escape_label(str(label))}"' for key, label in labels.items())
+                    lines.append(f"{sample_name}{{{label_text}}} {value}")
+                else:
+                    lines.append(f"{sample_name} {value}")
+        return '\n'.join(lines) + '\n'
+
+
+def escape_label(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+METRICS = Metrics()
+RECEIVED_BYTES = METRICS.counter('workerspy_received_bytes_total', "Bytes received from clients by message type", ('type',))
+RECV_CALLS = METRICS.counter('workerspy_recv_calls_total', "Reads from client connections")
+PAYLOAD_ASSEMBLY = METRICS.histogram('workerspy_payload_assembly_seconds',
+                                     "Time from message header until its payload is fully received", ('type',))
+FILE_WRITE = METRICS.histogram('workerspy_file_write_seconds', "Latency of writing logs and screens to files", ('kind',))
+DB_SAVE = METRICS.histogram('workerspy_db_save_seconds', "Latency of client database snapshot (save_database)")
+PREVIEW_RENDER = METRICS.histogram('workerspy_preview_seconds', "Latency of downscaling screen to preview")
+DB_JOURNAL = METRICS.histogram('workerspy_db_journal_seconds', "Latency of committing batch of client database events")
+METRICS.gauge('workerspy_threads', "Threads of server process", threading.active_count)
+
+
+class SamplingProfiler:
+    """Statistical profiler: samples stacks of all threads from its own thread.
+
+    Nothing is done while it is stopped, so it may be turned on and off at runtime.
+    Stacks are counted in collapsed form 'outer;inner;innermost' used by flame graphs.
+    """
+    MAX_STACKS = 10000      # Distinct stacks kept, rarer ones are counted as '[other]'
+
+    def __init__(self, interval: float = 0.005):
+        self.interval = interval
+        self.stacks = {}        # Collapsed stack -> samples
+        self.samples = 0
+        self.lock = threading.Lock()
+        self.thread = None
+        self.stop_event = threading.Event()
+
+    @property
+    def running(self) -> bool:
+        return self.thread is not None
+
+    def start(self) -> None:
+        if self.thread is not None:
+            return
+        self.stop_event.clear()
+        self.thread = threading.Thread(target=self.run, daemon=True, name="SamplingProfiler")
+        self.thread.start()
+
+    def stop(self) -> None:
+        if self.thread is None:
+            return
+        self.stop_event.set()
+        self.thread.join()
+        self.thread = None
+
+    def reset(self) -> None:
+        with self.lock:
+            self.stacks = {}
+            self.samples = 0
+
+    def run(self) -> None:
+        own_id = threading.get_ident()
+        while not self.stop_event.wait(self.interval):
+            frames = sys._current_frames()
+            with self.lock:
+                self.samples += 1
+                for thread_id, frame in frames.items():
+                    if thread_id == own_id:
+                        continue
+                    stack = []
+                    while frame is not None:
+                        stack.append(f"{frame.f_code.co_name} ({os.path.basename(frame.f_code.co_filename)}:{frame.f_code.co_firstlineno})")
+                        frame = frame.f_back
+                    key = ';'.join(reversed(stack))
+                    if key not in self.stacks and len(self.stacks) >= self.MAX_STACKS:
+                        key = '[other]'
+                    self.stacks[key] = self.stacks.get(key, 0) + 1
+            del frames
+
+    def snapshot(self) -> dict:
+        with self.lock:
+            return dict(self.stacks)
+
+    @staticmethod
+    def collapsed(stacks: dict) -> str:
+        """Stacks as 'frame;frame;frame count' lines, input of flamegraph.pl and speedscope."""
+        return ''.join(f"{stack} {count}\n" for stack, count in sorted(stacks.items(), key=lambda item: -item[1]))
+
+    @staticmethod
+    def top_functions(stacks: dict, limit: int = 20) -> list:
+        """Functions by samples where they were running (self) and on stack (total).
+        
+        ARGS:   stacks: collapsed stack -> samples,
+                limit: number of functions
+        Return: [(function, self samples, total samples), ...] by self samples
+        """
+        own = {}
+        total = {}
+        for stack, count in stacks.items():
+            functions = stack.split(';')
+            own[functions[-1]] = own.get(functions[-1], 0) + count
+            for function in set(functions):
+                total[function] = total.get(function, 0) + count
+        ranked = sorted(own.items(), key=lambda item: -item[1])[:limit]
+        return [(function, count, total[function]) for function, count in ranked]
+
+
+class LocalHTTPServer:
+    """Small HTTP endpoint served by its own threads, for loopback tools like Prometheus.
+
+    routes: path -> function(query) returning (status, content type, body), query is
+    dict of parameters from URL. post_routes are the same for POST requests, query is
+    JSON object from body. Route raises ValueError for bad parameters.
+
+    POST changes server's state, so it's accepted only with Content-Type application/json
+    and token in TOKEN_HEADER. Web page can't send either to other origin without CORS
+    preflight, which isn't answered, so browser of server's user can't be used for CSRF.
+    Token is generated at start unless it's given.
+    """
+    TOKEN_HEADER = 'X-WorkerSPY-Token'
+
+    def __init__(self, port: int, routes: dict, host: str = '127.0.0.1', post_routes: dict = None, token: str = None):
+        self.routes = routes
+        self.post_routes = post_routes or {}
+        self.token = token or secrets.token_urlsafe(24)
+
+        endpoint = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                url = urlsplit(self.path)
+                self.respond(endpoint.routes.get(url.path), url.path, dict(parse_qsl(url.query)))
+
+            def do_POST(self):
+                url = urlsplit(self.path)
+                route = endpoint.post_routes.get(url.path)
+                body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+                query = {}
+                error = None
+
+                if route is None:
+                    pass
+                elif not endpoint.authorized(self.headers.get(endpoint.TOKEN_HEADER)):
+                    error = 403, f"Missing or wrong {endpoint.TOKEN_HEADER} header"
+                elif self.headers.get_content_type() != 'application/json':
+                    error = 415, "Content-Type must be application/json"
+                else:
+                    try:
+                        query = json.loads(body or b'{}')
+                        if not isinstance(query, dict):
+                            raise ValueError("JSON object expected")
+                    except ValueError as e:
+                        error = 400, f"Bad request body: {e}"
+
+                if error is not None:
+                    route = lambda query, status=error[0], text=error[1]: (status, 'text/plain', f"{text}\n")
+                self.respond(route, url.path, query)
+
+            def respond(self, route, path: str, query: dict):
+                if route is None:
+                    status, content_type, body = 404, 'text/plain', f"Unknown path {path}\n"
+                else:
+                    try:
+                        status, content_type, body = route(query)
+                    except ValueError as e:
+                        status, content_type, body = 400, 'text/plain', f"{e}\n"
+                    except Exception as e:
+                        status, content_type, body = 500, 'text/plain', f"{type(e).__name__}: {e}\n"
+
+                data = body.encode('utf-8') if isinstance(body, str) else body
+                self.send_response(status)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, format, *args):
+                # Requests aren't logged to server's console
+                pass
+
+        self.httpd = ThreadingHTTPServer((host, port), Handler)
+        self.httpd.daemon_threads = True
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True, name="LocalHTTPServer")
+        self.thread.start()
+
+    @property
+    def port(self) -> int:
+        return self.httpd.server_address[1]
+
+    def authorized(self, token: str) -> bool:
+        """True if token of request is endpoint's token."""
+        if token is None:
+            return False
+        return hmac.compare_digest(token.encode('latin-1', errors='replace'), self.token.encode('latin-1'))
+
+    def close(self) -> None:
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+class Frame:
+    """One message received from client: command name and its payload.
+    Payload received to file is mmap of the file and path is file's name."""
+    __slots__ = ('command', 'payload', 'path', 'on_release', 'request_id', 'assembly_time')
+
+    def __init__(self, command: str, payload: bytearray = None, on_release=None, path: str = None, request_id: int = 0,
+                 assembly_time: float = 0.0):
+        self.command = command
+        self.payload = payload
+        self.path = path
+        self.on_release = on_release
+        self.request_id = request_id    # Server's request the frame answers (protocol v2), 0 - unsolicited
+        self.assembly_time = assembly_time  # Seconds from header until payload was fully received
+
+    def release(self) -> None:
+        """Free payload's memory or file once payload is processed."""
+        on_release, self.on_release = self.on_release, None
+        if on_release is not None:
+            on_release()
+
+
+class MemoryBudget:
+    """Global limit of payload bytes held in memory by all connections.
+
+    Reader reserves frame's size before payload is allocated and the reservation is
+    released when payload is processed. Frames that don't fit are received to disk.
+    """
+    def __init__(self, limit: int = 0):
+        self.limit = limit      # 0 - unlimited
+        self.used = 0
+        self.peak = 0
+        self.spooled = 0        # Frames received to disk because budget was exhausted
+        self.lock = threading.Lock()
+
+    def reserve(self, size: int) -> bool:
+        """Reserve size bytes.
+        
+        ARGS:   size: payload size
+        Return: True if payload may be kept in memory
+        """
+        with self.lock:
+            if self.limit and self.used + size > self.limit:
+                self.spooled += 1
+                return False
+            self.used += size
+            self.peak = max(self.peak, self.used)
+            return True
+
+    def release(self, size: int) -> None:
+        with self.lock:
+            self.used -= size
+
+    def metrics(self) -> dict:
+        with self.lock:
+            return {'limit': self.limit, 'used': self.used, 'peak': self.peak, 'spooled': self.spooled}
+
+
+class MemorySink:
+    """Payload received into preallocated bytearray."""
+    path = None
+
+    def __init__(self, size: int):
+        self.payload = bytearray(size)
+        self.view = memoryview(self.payload)
+        self.written = 0
+
+    def write(self, data: memoryview) -> None:
+        """Copy bytes already received into reader's buffer."""
+        self.view[self.written:self.written + len(data)] = data
+        self.written += len(data)
+
+    def buffer(self, limit: int) -> memoryview:
+        """Free space for recv_into, at most limit bytes."""
+        return self.view[self.written:self.written + limit]
+
+    def commit(self, received: int) -> None:
+        """Count bytes received into buffer()."""
+        self.written += received
+
+    def finish(self):
+        self.view.release()
+        return self.payload
+
+    def discard(self) -> None:
+        self.view.release()
+
+    def cleanup(self) -> None:
+        pass
+
+
+class FileSink:
+    """Payload received straight into preallocated temporary file mapped to memory.
+
+    Pages of the file are written by kernel, so payload doesn't take process memory
+    however large it is. File is kept until frame is released and may be renamed
+    to its final name instead of being copied.
+    """
+    def __init__(self, size: int, directory: str):
+        Path(directory).mkdir(exist_ok=True)
+        fd, self.path = tempfile.mkstemp(suffix='.part', dir=directory)
+        try:
+            os.ftruncate(fd, size)
+            self.map = mmap.mmap(fd, size)
+        except Exception:
+            os.close(fd)
+            os.remove(self.path)
+            raise
+        os.close(fd)
+        self.view = memoryview(self.map)
+        self.written = 0
+
+    def write(self, data: memoryview) -> None:
+        """Copy bytes already received into reader's buffer."""
+        self.view[self.written:self.written + len(data)] = data
+        self.written += len(data)
+
+    def buffer(self, limit: int) -> memoryview:
+        """Free space for recv_into, at most limit bytes."""
+        return self.view[self.written:self.written + limit]
+
+    def commit(self, received: int) -> None:
+        """Count bytes received into buffer()."""
+        self.written += received
+
+    def finish(self):
+        self.view.release()
+        return self.map
+
+    def discard(self) -> None:
+        self.view.release()
+        self.cleanup()
+
+    def cleanup(self) -> None:
+        """Unmap file and remove it unless it was renamed."""
+        try:
+            self.map.close()
+        except BufferError:
+            # Payload is still referenced somewhere, mapping is closed with its last reference
+            pass
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+
+
+class TokenBucket:
+    """Limits rate of bytes received from one client.
+
+    Reader asks how long to pause after every receive. While reading is paused the
+    client's data stays in kernel buffers and TCP slows the client down.
+    """
+    def __init__(self, rate: float, burst: float = None):
+        self.rate = rate            # Bytes per second, 0 - unlimited
+        self.burst = burst or rate
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+
+    def consume(self, amount: int) -> float:
+        """Take amount of tokens.
+        
+        ARGS:   amount: number of received bytes
+        Return: seconds to pause reading
+        """
+        if not self.rate:
+            return 0.0
+
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= amount
+        return -self.tokens / self.rate if self.tokens < 0 else 0.0
+
+
+class FrameReader:
+    """Incremental parser of client's stream.
+
+    Client sends '<Command>, <size>\\n' header followed by <size> bytes of payload.
+    Headers are received with recv_into into one per-connection buffer and searched
+    only in newly received bytes. Payload goes to its sink preallocated for <size>:
+    bytearray, or temporary file for file_commands and payloads that don't fit into
+    memory budget. Once buffered bytes are used, payload is received with recv_into
+    straight into the sink in reads of up to recv_size bytes, without extra copies.
+    Size from header is checked against max_sizes before anything is allocated.
+    """
+    FRAME_COMMANDS = ("ProcessJSON", "ScreenShot BMP")
+
+    def __init__(self, buffer_size: int = 65536, max_header_size: int = 256, max_sizes: dict = None,
+                 budget: MemoryBudget = None, spool_dir: str = 'incoming', file_commands: tuple = (),
+                 recv_size: int = 1024 * 1024):
+        self.buffer = bytearray(buffer_size)
+        self.view = memoryview(self.buffer)
+        self.max_header_size = max_header_size
+        self.max_sizes = max_sizes or {}    # Command -> maximum payload size, 0 - unlimited
+        self.budget = budget
+        self.spool_dir = spool_dir
+        self.file_commands = file_commands  # Commands which payload is always received to file
+        self.recv_size = recv_size          # Maximum size of one read into payload's sink
+        self.start = 0          # First unparsed byte in buffer
+        self.end = 0            # End of received data in buffer
+        self.scanned = 0        # Header bytes already checked for '\n'
+        self.command = None     # Command of the frame being received
+        self.sink = None        # Sink of the frame being received
+        self.size = 0           # Payload size of the frame being received
+        self.reserved = 0       # Bytes of the frame reserved in memory budget
+        self.bytes_read = 0     # Running counter of payload bytes received
+        self.received_bytes = 0 # Total bytes received from connection
+        self.decoder = None     # Decompressor of the frame being received (protocol v2)
+        self.request_id = 0     # Request ID of the frame being received (protocol v2)
+        self.opened_at = 0.0    # Monotonic time header of the frame being received was parsed
+
+    def recv_from(self, sock: socket.socket) -> list:
+        """Receive available data from socket and parse it.
+
+        ARGS:   sock: connected client's socket
+        Return: list of completed frames, None if connection was closed
+        """
+        if self.sink is not None and self.decoder is None and self.start == self.end:
+            # Nothing is buffered, payload is received straight into its sink
+            with self.sink.buffer(min(self.size - self.bytes_read, self.recv_size)) as target:
+                received = sock.recv_into(target)
+            if not received:
+                return None
+
+            self.received_bytes += received
+            self.sink.commit(received)
+            self.bytes_read += received
+            return [self._close_frame()] if self.bytes_read == self.size else []
+
+        if self.end == len(self.buffer):
+            self._compact()
+
+        received = sock.recv_into(self.view[self.end:])
+        if not received:
+            return None
+
+        self.end += received
+        self.received_bytes += received
+        return self._parse()
+
+    def feed(self, data: bytes) -> list:
+        """Parse data received by other means (e.g. asyncio transport).
+
+        ARGS:   data: bytes received from client
+        Return: list of completed frames
+        """
+        frames = []
+        data = memoryview(data)
+        self.received_bytes += len(data)
+
+        while data:
+            if self.sink is not None and self.start == self.end:
+                # Payload is copied straight into its sink
+                size = min(len(data), self.size - self.bytes_read)
+                self._write_payload(data[:size])
+                self.bytes_read += size
+                data = data[size:]
+                if self.bytes_read == self.size:
+                    frames.append(self._close_frame())
+                continue
+
+            if self.end == len(self.buffer):
+                self._compact()
+
+            size = min(len(data), len(self.buffer) - self.end)
+            self.view[self.end:self.end + size] = data[:size]
+            self.end += size
+            data = data[size:]
+            frames.extend(self._parse())
+
+        return frames
+
+    def receiving_payload(self) -> bool:
+        """True while frame's payload is not fully received."""
+        return self.sink is not None
+
+    def close(self) -> None:
+        """Drop partially received payload when connection is closed."""
+        if self.sink is not None:
+            self.sink.discard()
+            self.sink = None
+        if self.reserved:
+            self.budget.release(self.reserved)
+            self.reserved = 0
+
+    def _compact(self) -> None:
+        """Move unparsed bytes to the buffer's beginning."""
+        unparsed = self.end - self.start
+        if unparsed and not self.start:
+            # Buffer is full of header without '\n'
+            raise ProtocolError(f"Header is longer than {self.max_header_size} bytes")
+
+        self.buffer[:unparsed] = self.buffer[self.start:self.end]
+        self.scanned -= self.start
+        self.start = 0
+        self.end = unparsed
+
+    def _open_frame(self, header: bytes) -> Frame:
+        """Parse '<Command>, <size>' header and prepare payload for it.
+
+        ARGS:   header: header line without '\\n'
+        Return: Frame if it is already complete (unrecognized or empty), else None
+        """
+        message = header.decode('utf-8', errors='replace').strip().split(',')
+
+        if message[0] not in self.FRAME_COMMANDS:
+            return Frame(message[0])
+
+        try:
+            size = int(message[1])
+        except (IndexError, ValueError):
+            raise ProtocolError(f"Invalid message size in header {header!r}")
+        if size < 0:
+            raise ProtocolError(f"Negative message size in header {header!r}")
+
+        max_size = self.max_sizes.get(message[0])
+        if max_size and size > max_size:
+            raise ProtocolError(f"{message[0]} of {size} bytes exceeds limit of {max_size} bytes")
+
+        if size == 0:
+            return Frame(message[0], bytearray())
+
+        self.command = message[0]
+        self.size = size
+        self.bytes_read = 0
+        self._open_sink(size)
+        return None
+
+    def _open_sink(self, size: int) -> None:
+        """Preallocate sink for payload of size bytes."""
+        self.opened_at = time.monotonic()
+        if self.command in self.file_commands or (self.budget is not None and not self.budget.reserve(size)):
+            self.sink = FileSink(size, self.spool_dir)
+        else:
+            self.reserved = size if self.budget is not None else 0
+            self.sink = MemorySink(size)
+
+    def _take_header(self) -> bytes:
+        """Cut '<Command>, <size>' line from buffer.
+        
+        Return: header without '\\n', None if it isn't fully received
+        """
+        newline = self.buffer.find(b'\n', max(self.start, self.scanned), self.end)
+
+        if newline == -1:
+            self.scanned = self.end
+            if self.end - self.start > self.max_header_size:
+                raise ProtocolError(f"Header is longer than {self.max_header_size} bytes")
+            return None
+
+        header = bytes(self.view[self.start:newline])
+        self.start = self.scanned = newline + 1
+        return header
+
+    def _write_payload(self, data: memoryview) -> None:
+        self.sink.write(data)
+
+    def _close_frame(self) -> Frame:
+        """Complete frame whose payload is fully received."""
+        on_release = self.sink.cleanup if self.sink.path else None
+        if self.reserved:
+            on_release = lambda budget=self.budget, size=self.reserved: budget.release(size)
+
+        frame = Frame(self.command, self.sink.finish(), on_release, self.sink.path, self.request_id,
+                      time.monotonic() - self.opened_at)
+        self.command = None
+        self.sink = None
+        self.reserved = 0
+        self.bytes_read = 0
+        self.decoder = None
+        self.request_id = 0
+        return frame
+
+    def _parse(self) -> list:
+        """Cut received bytes into headers and payloads."""
+        frames = []
+
+        while self.start < self.end:
+            # Waiting for header
+            if self.sink is None:
+                header = self._take_header()
+                if header is None:
+                    break
+
+                frame = self._open_frame(header)
+                if frame is not None:
+                    frames.append(frame)
+
+            # Receiving payload
+            else:
+                size = min(self.end - self.start, self.size - self.bytes_read)
+                self._write_payload(self.view[self.start:self.start + size])
+                self.bytes_read += size
+                self.start += size
+
+                if self.bytes_read == self.size:
+                    frames.append(self._close_frame())
+
+        if self.start == self.end:
+            self.start = self.end = self.scanned = 0
+
+        return frames
+
+
+class FrameReaderV2(FrameReader):
+    """Incremental parser of client's stream in protocol v2.
+
+    Every frame starts with FRAME_V2 header: magic, type, flags, request ID, payload length
+    and uncompressed length. Compressed payload is decompressed while it's received straight
+    into sink preallocated for uncompressed length, so it is never held compressed as whole.
+    """
+    DECOMPRESS_CHUNK = 256 * 1024   # Maximum output of one decompress call
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.codec = None       # Compression of the frame being received
+
+    def _take_header(self) -> bytes:
+        if self.end - self.start < FRAME_V2.size:
+            return None
+
+        header = bytes(self.view[self.start:self.start + FRAME_V2.size])
+        self.start += FRAME_V2.size
+        return header
+
+    def _open_frame(self, header: bytes) -> Frame:
+        magic, frame_type, flags, request_id, size, raw_size = FRAME_V2.unpack(header)
+        if magic != FRAME_V2_MAGIC:
+            raise ProtocolError(f"Invalid frame magic {magic!r}")
+
+        command = FRAME_TYPES.get(frame_type, f"Unknown type {frame_type}")
+        codec = FRAME_CODECS.get(flags & FRAME_CODEC_MASK, 'unknown')
+        if codec is not None and codec not in SUPPORTED_CODECS:
+            raise ProtocolError(f"Unsupported compression {codec}")
+        if codec is None and size != raw_size:
+            raise ProtocolError(f"Uncompressed frame of {size} bytes declares {raw_size} bytes")
+
+        max_size = self.max_sizes.get(command) if command in self.FRAME_COMMANDS else self.max_header_size
+        if max_size and max(size, raw_size) > max_size:
+            raise ProtocolError(f"{command} of {raw_size} bytes exceeds limit of {max_size} bytes")
+
+        if raw_size == 0:
+            if size:
+                raise ProtocolError(f"Empty {command} has {size} bytes of payload")
+            return Frame(command, bytearray(), request_id=request_id)
+
+        self.command = command
+        self.request_id = request_id
+        self.size = size
+        self.bytes_read = 0
+        self.codec = codec
+        if codec == 'zlib':
+            self.decoder = zlib.decompressobj()
+        elif codec == 'lz4':
+            self.decoder = lz4_frame.LZ4FrameDecompressor()
+        self._open_sink(raw_size)
+        return None
+
+    def _write_payload(self, data: memoryview) -> None:
+        if self.decoder is None:
+            self.sink.write(data)
+            return
+
+        # Output is taken in bounded chunks, so small compressed payload can't allocate more than its sink
+        if self.codec == 'zlib':
+            while data:
+                self._write_decompressed(self.decoder.decompress(data, self.DECOMPRESS_CHUNK))
+                data = self.decoder.unconsumed_tail
+        else:
+            self._write_decompressed(self.decoder.decompress(bytes(data), self.DECOMPRESS_CHUNK))
+            while not self.decoder.needs_input:
+                self._write_decompressed(self.decoder.decompress(b'', self.DECOMPRESS_CHUNK))
+
+    def _write_decompressed(self, data: bytes) -> None:
+        if self.sink.written + len(data) > len(self.sink.view):
+            raise ProtocolError(f"{self.command} is larger than declared when decompressed")
+        self.sink.write(data)
+
+    def _close_frame(self) -> Frame:
+        if self.decoder is not None:
+            if self.codec == 'zlib':
+                self._write_decompressed(self.decoder.flush())
+            if self.sink.written != len(self.sink.view):
+                raise ProtocolError(f"{self.command} is {self.sink.written} bytes when decompressed, "
+                                    f"{len(self.sink.view)} declared")
+        self.codec = None
+        return super()._close_frame()
+
+
+class Handshake:
+    """Incremental parser of client's answer to SEND_MAC.
+
+    Client of protocol v1 sends 'MAC_ADDRESS, <size>' and MAC in two send() calls without
+    delimiter, TCP may deliver them in one segment or split anywhere. Size of MAC is two
+    digits (12-64), so MAC is taken once <size> bytes after the digits are received.
+    Client of protocol v2 sends Hello frame with JSON {"mac": ..., "codecs": [...]}.
+    Bytes received after the answer are left in rest.
+    """
+    V1_PREFIX = b"MAC_ADDRESS, "
+    MAX_SIZE = 4096
+
+    def __init__(self):
+        self.data = bytearray()
+        self.version = None
+        self.mac = None
+        self.codecs = []        # Compressions supported by v2 client in its preference order
+        self.codec = None       # Compression chosen by server, first one of client's it supports
+        self.rest = b''
+
+    def feed(self, data: bytes) -> bool:
+        """Add received bytes.
+        
+        ARGS:   data: bytes received from client
+        Return: True when answer is complete
+        """
+        if not data:
+            raise ConnectionResetError("Connection closed during handshake")
+
+        self.data += data
+        if len(self.data) > self.MAX_SIZE:
+            raise ProtocolError(f"Handshake is longer than {self.MAX_SIZE} bytes")
+
+        head = bytes(self.data[:len(self.V1_PREFIX)])
+        if head.startswith(FRAME_V2_MAGIC):
+            return self.parse_v2()
+        if self.V1_PREFIX.startswith(head):
+            return self.parse_v1()
+        if FRAME_V2_MAGIC.startswith(head):
+            return False
+        raise ProtocolError(f"Unexpected answer to SEND_MAC {bytes(self.data[:32])!r}")
+
+    def parse_v1(self) -> bool:
+        start = len(self.V1_PREFIX)
+        digits = self.data[start:start + 2]
+        if len(digits) < 2:
+            return False
+        if not digits.isdigit() or not 12 <= int(digits) <= 64:
+            raise ProtocolError(f"Invalid MAC size {bytes(digits)!r}")
+
+        end = start + 2 + int(digits)
+        if len(self.data) < end:
+            return False
+
+        self.version = 1
+        self.mac = self.data[start + 2:end].decode('utf-8', errors='replace').strip()
+        self.rest = bytes(self.data[end:])
+        return True
+
+    def parse_v2(self) -> bool:
+        if len(self.data) < FRAME_V2.size:
+            return False
+
+        _, frame_type, flags, _, size, raw_size = FRAME_V2.unpack_from(self.data)
+        if frame_type != FRAME_TYPE_IDS["Hello"] or flags or size != raw_size:
+            raise ProtocolError("Protocol v2 client must start with uncompressed Hello")
+        if len(self.data) < FRAME_V2.size + size:
+            return False
+
+        try:
+            hello = json.loads(bytes(self.data[FRAME_V2.size:FRAME_V2.size + size]))
+            self.mac = str(hello['mac'])
+            self.codecs = [str(codec) for codec in hello.get('codecs', [])]
+        except (ValueError, KeyError, TypeError) as e:
+            raise ProtocolError(f"Invalid Hello: {e}")
+
+        self.version = 2
+        self.codec = next((codec for codec in self.codecs if codec in SUPPORTED_CODECS), None)
+        self.rest = bytes(self.data[FRAME_V2.size + size:])
+        return True
+
+    def reply(self) -> bytes:
+        """Server's Hello for v2 client: protocol version and chosen compression."""
+        hello = {'version': 2, 'codec': self.codec}
+        return encode_frame(FRAME_TYPE_IDS["Hello"], json.dumps(hello).encode('utf-8'))
+
+
+def encode_frame(frame_type: int, payload: bytes = b'', request_id: int = 0, codec: str = None) -> bytes:
+    """Build protocol v2 frame.
+    
+    ARGS:   frame_type: one of FRAME_TYPES keys,
+            payload: uncompressed payload,
+            request_id: ID of request or of request it answers,
+            codec: compression from SUPPORTED_CODECS, None - not compressed
+    Return: header and payload
+    """
+    data = payload
+    if codec == 'zlib':
+        data = zlib.compress(payload, 6)
+    elif codec == 'lz4':
+        data = lz4_frame.compress(payload)
+
+    if codec is None or len(data) >= len(payload):
+        # Incompressible payload is sent as is
+        return FRAME_V2.pack(FRAME_V2_MAGIC, frame_type, 0, request_id, len(payload), len(payload)) + payload
+    return FRAME_V2.pack(FRAME_V2_MAGIC, frame_type, FRAME_CODEC_IDS[codec], request_id, len(data), len(payload)) + data
+
+
+def parse_bmp(data: bytes) -> tuple:
+    """Parse BITMAPFILEHEADER and BITMAPINFOHEADER of uncompressed BMP.
+    
+    ARGS:   data: BMP file
+    Return: tuple(width, height, bits per pixel, pixels offset, row size in bytes, top_down)
+    """
+    if len(data) < 54 or data[:2] != b'BM':
+        raise ValueError("Not a BMP file")
+
+    pixels_offset, = struct.unpack_from('<I', data, 10)
+    _, width, height, _, bits, compression = struct.unpack_from('<IiiHHI', data, 14)
+
+    if compression != 0 or bits not in (24, 32) or width <= 0 or height == 0:
+        raise ValueError(f"Unsupported BMP: {bits} bits, compression {compression}")
+
+    row_size = ((width * bits + 31) // 32) * 4
+    if pixels_offset + row_size * abs(height) > len(data):
+        raise ValueError("BMP pixel data is truncated")
+
+    return width, abs(height), bits, pixels_offset, row_size, height < 0
+
+
+def bmp_to_rgb(data: bytes) -> tuple:
+    """Convert BMP pixels (bottom-up BGR(A) rows) to top-down RGB rows.
+    
+    ARGS:   data: BMP file
+    Return: tuple(width, height, RGB bytes)
+    """
+    width, height, bits, offset, row_size, top_down = parse_bmp(data)
+    channels = bits // 8
+    view = memoryview(data)
+
+    rows = [view[offset + row * row_size:offset + row * row_size + width * channels] for row in range(height)]
+    if not top_down:
+        rows.reverse()
+    pixels = b''.join(rows)
+
+    rgb = bytearray(width * height * 3)
+    rgb[0::3] = pixels[2::channels]
+    rgb[1::3] = pixels[1::channels]
+    rgb[2::3] = pixels[0::channels]
+    return width, height, rgb
+
+
+def bmp_preview(data: bytes, max_width: int) -> tuple:
+    """Downscale BMP with box filter: pixel of preview is average of factor x factor
+    block of screen's pixels. Without NumPy the middle pixel of block is taken.
+    
+    ARGS:   data: BMP file (bytes or mmap of the file),
+            max_width: maximum width of preview
+    Return: tuple(width, height, RGB bytes)
+    """
+    width, height, bits, offset, row_size, top_down = parse_bmp(data)
+    channels = bits // 8
+    factor = -(-width // max_width)
+    factor_y = min(factor, height)
+    preview_width, preview_height = width // factor, height // factor_y
+
+    if np is not None:
+        pixels = np.frombuffer(data, np.uint8, count=row_size * height, offset=offset).reshape(height, row_size)
+        if not top_down:
+            pixels = pixels[::-1]
+        # Columns and rows not filling whole block are cut
+        pixels = pixels[:preview_height * factor_y, :preview_width * factor * channels]
+
+        # Blocks are summed by adding strided views: much faster than sum() over 5-D view
+        rows = pixels[0::factor_y].astype(np.uint32)
+        for row in range(1, factor_y):
+            rows += pixels[row::factor_y]
+        rows = rows.reshape(preview_height, preview_width, factor * channels)
+        blocks = rows[:, :, :channels].copy()
+        for column in range(1, factor):
+            blocks += rows[:, :, column * channels:(column + 1) * channels]
+
+        # BGR(A) -> RGB
+        rgb = (blocks[:, :, 2::-1] // (factor_y * factor)).astype(np.uint8)
+        return preview_width, preview_height, rgb.tobytes()
+
+    rgb = bytearray(preview_width * preview_height * 3)
+    start = factor // 2 * channels
+    step = factor * channels
+    for row in range(preview_height):
+        source = row * factor_y + factor_y // 2
+        if not top_down:
+            source = height - 1 - source
+        line = data[offset + source * row_size:offset + source * row_size + width * channels]
+        position = row * preview_width * 3
+        for channel in range(3):
+            rgb[position + channel:position + preview_width * 3:3] = line[start + 2 - channel::step][:preview_width]
+    return preview_width, preview_height, rgb
+
+
+def encode_png(width: int, height: int, rgb: bytes, level: int = 6) -> bytes:
+    """Encode RGB pixels as PNG file."""
+    def chunk(chunk_type: bytes, data: bytes) -> bytes:
+        return struct.pack('>I', len(data)) + chunk_type + data + struct.pack('>I', zlib.crc32(chunk_type + data))
+
+    row_size = width * 3
+    view = memoryview(rgb)
+    # Each PNG row starts with filter type byte (0 - no filter)
+    raw = b''.join(b'\x00' + view[row * row_size:(row + 1) * row_size] for row in range(height))
+
+    return (b'\x89PNG\r\n\x1a\n'
+            + chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0))
+            + chunk(b'IDAT', zlib.compress(raw, level))
+            + chunk(b'IEND', b''))
+
+
+def decode_png(data: bytes) -> tuple:
+    """Decode PNG written by encode_png (8-bit RGB, rows without filter).
+    
+    ARGS:   data: PNG file
+    Return: tuple(width, height, RGB bytes)
+    """
+    if data[:8] != b'\x89PNG\r\n\x1a\n':
+        raise ValueError("Not a PNG file")
+
+    position = 8
+    idat = []
+    width = height = None
+    while position < len(data):
+        length, chunk_type = struct.unpack_from('>I4s', data, position)
+        chunk_data = data[position + 8:position + 8 + length]
+        if chunk_type == b'IHDR':
+            width, height, depth, color_type = struct.unpack_from('>IIBB', chunk_data)
+            if depth != 8 or color_type != 2:
+                raise ValueError("Only 8-bit RGB PNG is supported")
+        elif chunk_type == b'IDAT':
+            idat.append(chunk_data)
+        position += 12 + length
+
+    raw = memoryview(zlib.decompress(b''.join(idat)))
+    row_size = width * 3 + 1
+    if any(raw[row * row_size] != 0 for row in range(height)):
+        raise ValueError("Only PNG rows without filter are supported")
+
+    return width, height, bytearray(b''.join(raw[row * row_size + 1:(row + 1) * row_size] for row in range(height)))
+
+
+def tile_rect(width: int, height: int, tile: int, index: int) -> tuple:
+    """Rectangle (x, y, width, height) of tile with index counted row by row."""
+    tiles_x = -(-width // tile)
+    x = (index % tiles_x) * tile
+    y = (index // tiles_x) * tile
+    return x, y, min(tile, width - x), min(tile, height - y)
+
+
+def find_changed_tiles(width: int, height: int, rgb: bytes, base: bytes, tile: int) -> list:
+    """Compare two RGB pictures tile by tile.
+    
+    ARGS:   width, height: size of both pictures,
+            rgb: new picture,
+            base: picture to compare with,
+            tile: size of square tile in pixels
+    Return: indices of tiles which have at least one changed pixel
+    """
+    tiles_x = -(-width // tile)
+    tiles_y = -(-height // tile)
+
+    if np is not None:
+        changed = np.frombuffer(rgb, np.uint8) != np.frombuffer(base, np.uint8)
+        changed = changed.reshape(height, width, 3).any(axis=2)
+        padded = np.zeros((tiles_y * tile, tiles_x * tile), dtype=bool)
+        padded[:height, :width] = changed
+        return np.flatnonzero(padded.reshape(tiles_y, tile, tiles_x, tile).any(axis=(1, 3))).tolist()
+
+    changed = []
+    row_size = width * 3
+    for index in range(tiles_x * tiles_y):
+        x, y, w, h = tile_rect(width, height, tile, index)
+        for row in range(y, y + h):
+            start = row * row_size + x * 3
+            if rgb[start:start + w * 3] != base[start:start + w * 3]:
+                changed.append(index)
+                break
+    return changed
+
+
+def get_tile(width: int, height: int, rgb: bytes, tile: int, index: int) -> bytes:
+    """Copy pixels of one tile."""
+    x, y, w, h = tile_rect(width, height, tile, index)
+    if np is not None:
+        return np.frombuffer(rgb, np.uint8).reshape(height, width * 3)[y:y + h, x * 3:(x + w) * 3].tobytes()
+
+    row_size = width * 3
+    return b''.join(rgb[row * row_size + x * 3:row * row_size + (x + w) * 3] for row in range(y, y + h))
+
+
+def put_tile(width: int, height: int, rgb: bytearray, tile: int, index: int, data: bytes) -> None:
+    """Write pixels of one tile into picture."""
+    x, y, w, h = tile_rect(width, height, tile, index)
+    row_size = width * 3
+    for row in range(h):
+        start = (y + row) * row_size + x * 3
+        rgb[start:start + w * 3] = data[row * w * 3:(row + 1) * w * 3]
+
+
+class WriteBehindExecutor:
+    """Bounded queue of file writes served by a small pool of writer threads.
+
+    Tasks with the same key (e.g. client's ID) always go to the same writer, so they are
+    written in order. Writer keeps files it appends to open (LRU of max_open_files) and
+    joins consecutive appends to one file into one write.
+
+    full_policy sets what happens when writer's queue is full:
+        'block' - caller waits for free place,
+        'drop'  - task is dropped and counted,
+        'spill' - task is appended to spill file and written after the queue is emptied.
+                  Spill file is written by the caller's thread (buffered append without
+                  fsync), so caller waits for the disk, but not for the writer's queue.
+
+    Callback given to write() is called when its data isn't held by executor anymore:
+    after file is written (or writing failed), task is dropped or spilled to disk.
+    """
+    FULL_POLICIES = ('block', 'drop', 'spill')
+    SPILL_RECORD = '<BHI'     # Task kind, filename size, data size
+
+    def __init__(self, writers: int = 2, max_queue: int = 1024, max_open_files: int = 128,
+                 full_policy: str = 'block', spill_dir: str = 'spill', batch_size: int = 64):
+        if full_policy not in self.FULL_POLICIES:
+            raise ValueError(f"Unknown full policy {full_policy}, expected one of {self.FULL_POLICIES}")
+
+        self.full_policy = full_policy
+        self.spill_dir = spill_dir
+        self.batch_size = batch_size
+        self.max_open_files = max(1, max_open_files // writers)     # Open files per writer
+        self.queues = [queue.Queue(maxsize=max(1, max_queue // writers)) for _ in range(writers)]
+        self.spilling = [False] * writers
+        self.spill_locks = [threading.Lock() for _ in range(writers)]
+        self.stats_lock = threading.Lock()
+        self.stats = {'submitted': 0, 'written': 0, 'batches': 0, 'dropped': 0, 'spilled': 0, 'errors': 0, 'max_depth': 0}
+        self.open_files = [0] * writers
+        self.workers = [
+            threading.Thread(target=self.writer_loop, args=(i,), daemon=True, name=f"FileWriter-{i}")
+            for i in range(writers)
+        ]
+        for worker in self.workers:
+            worker.start()
+
+    def append(self, filename: str, data: bytes, key: str = None) -> bool:
+        """Append data to the end of file.
+        
+        ARGS:   filename: file to append to,
+                data: bytes to append (str is encoded as UTF-8),
+                key: ordering key, filename if not given
+        Return: False if task was dropped by 'drop' policy
+        """
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        return self.submit(key or filename, ('append', filename, data, None))
+
+    def write(self, filename: str, data: bytes, key: str = None, on_written=None) -> bool:
+        """Write whole file through temporary name, so it never appears half-written.
+        
+        ARGS:   filename: file to (re)write,
+                data: file content,
+                key: ordering key, filename if not given,
+                on_written: called when data isn't needed anymore (e.g. releases its memory)
+        Return: False if task was dropped by 'drop' policy
+        """
+        return self.submit(key or filename, ('write', filename, data, on_written))
+
+    def submit(self, key: str, task: tuple) -> bool:
+        """Put task into queue of writer chosen by key, full queue is handled by full_policy."""
+        writer = hash(key) % len(self.queues)
+        tasks = self.queues[writer]
+
+        with self.stats_lock:
+            self.stats['submitted'] += 1
+            self.stats['max_depth'] = max(self.stats['max_depth'], tasks.qsize() + 1)
+
+        if self.full_policy == 'block':
+            tasks.put(task)
+            return True
+
+        if self.full_policy == 'spill':
+            with self.spill_locks[writer]:
+                # After the first spilled task all following ones are spilled too to keep order
+                if self.spilling[writer]:
+                    self.spill(writer, task)
+                    return True
+                try:
+                    tasks.put_nowait(task)
+                except queue.Full:
+                    self.spilling[writer] = True
+                    self.spill(writer, task)
+                return True
+
+        try:
+            tasks.put_nowait(task)
+            return True
+        except queue.Full:
+            with self.stats_lock:
+                self.stats['dropped'] += 1
+            if task[3] is not None:
+                task[3]()
+            return False
+
+    def spill(self, writer: int, task: tuple) -> None:
+        """Append task to writer's spill file. Called under writer's spill lock."""
+        kind, filename, data, on_written = task
+        filename = filename.encode('utf-8')
+        Path(self.spill_dir).mkdir(exist_ok=True)
+
+        with open(Path(self.spill_dir) / f"writer-{writer}.spill", 'ab') as spill:
+            spill.write(struct.pack(self.SPILL_RECORD, kind == 'write', len(filename), len(data)))
+            spill.write(filename)
+            spill.write(data)
+
+        with self.stats_lock:
+            self.stats['spilled'] += 1
+        if on_written is not None:
+            on_written()
+
+    def read_spill(self, writer: int) -> list:
+        """Take all tasks spilled for writer and stop spilling."""
+        with self.spill_locks[writer]:
+            if not self.spilling[writer]:
+                return []
+
+            spill_filename = Path(self.spill_dir) / f"writer-{writer}.spill"
+            with open(spill_filename, 'rb') as spill:
+                data = spill.read()
+            os.remove(spill_filename)
+            self.spilling[writer] = False
+
+        tasks = []
+        position = 0
+        header_size = struct.calcsize(self.SPILL_RECORD)
+        while position < len(data):
+            kind, filename_size, data_size = struct.unpack_from(self.SPILL_RECORD, data, position)
+            position += header_size
+            filename = data[position:position + filename_size].decode('utf-8')
+            position += filename_size
+            tasks.append(('write' if kind else 'append', filename, data[position:position + data_size], None))
+            position += data_size
+        return tasks
+
+    def writer_loop(self, writer: int) -> None:
+        tasks = self.queues[writer]
+        files = OrderedDict()   # Filename -> open file, LRU
+        running = True
+
+        while running:
+            batch = []
+            try:
+                batch.append(tasks.get(timeout=1.0))
+                while len(batch) < self.batch_size:
+                    batch.append(tasks.get_nowait())
+            except queue.Empty:
+                pass
+            
+            if None in batch:
+                # close() was called
+                running = False
+                batch = [task for task in batch if task is not None]
+
+            if tasks.empty():
+                batch.extend(self.read_spill(writer))
+
+            self.write_batch(batch, files)
+            self.open_files[writer] = len(files)
+
+        for f in files.values():
+            f.close()
+        self.open_files[writer] = 0
+
+    def write_batch(self, batch: list, files: OrderedDict) -> None:
+        """Write tasks of one batch, consecutive appends to the same file are joined."""
+        position = 0
+        touched = set()
+
+        while position < len(batch):
+            kind, filename, data, on_written = batch[position]
+            position += 1
+
+            try:
+                if kind == 'append':
+                    chunks = [data]
+                    while position < len(batch) and batch[position][0] == 'append' and batch[position][1] == filename:
+                        chunks.append(batch[position][2])
+                        position += 1
+
+                    started = time.perf_counter()
+                    self.get_file(filename, files).write(b''.join(chunks))
+                    FILE_WRITE.observe(time.perf_counter() - started, ('append',))
+                    touched.add(filename)
+                else:
+                    if filename in files:
+                        files.pop(filename).close()
+                    started = time.perf_counter()
+                    Path(filename).parent.mkdir(parents=True, exist_ok=True)
+                    with open(f"{filename}.tmp", 'wb') as f:
+                        f.write(data)
+                    os.replace(f"{filename}.tmp", filename)
+                    FILE_WRITE.observe(time.perf_counter() - started, ('write',))
+            except OSError as e:
+                print(f"\nError while writing {filename}: {e}")
+                with self.stats_lock:
+                    self.stats['errors'] += 1
+            finally:
+                if on_written is not None:
+                    on_written()
+
+        for filename in touched:
+            if filename in files:
+                files[filename].flush()
+
+        if batch:
+            with self.stats_lock:
+                self.stats['written'] += len(batch)
+                self.stats['batches'] += 1
+
+    def get_file(self, filename: str, files: OrderedDict):
+        """Open file for appending or take already opened one."""
+        if filename in files:
+            files.move_to_end(filename)
+            return files[filename]
+
+        while len(files) >= self.max_open_files:
+            _, oldest = files.popitem(last=False)
+            oldest.close()
+
+        Path(filename).parent.mkdir(parents=True, exist_ok=True)
+        files[filename] = open(filename, 'ab')
+        return files[filename]
+
+    def metrics(self) -> dict:
+        """Counters of executor and current depth of writers' queues."""
+        with self.stats_lock:
+            metrics = dict(self.stats)
+        metrics['queue_depth'] = sum(tasks.qsize() for tasks in self.queues)
+        metrics['queue_capacity'] = sum(tasks.maxsize for tasks in self.queues)
+        metrics['open_files'] = sum(self.open_files)
+        metrics['spilling'] = sum(self.spilling)
+        return metrics
+
+    def close(self) -> None:
+        """Write all queued tasks and stop writers."""
+        for tasks in self.queues:
+            tasks.put(None)
+        for worker in self.workers:
+            worker.join()
+
+
+class ScreenshotStore:
+    """Storage pipeline for screenshots received from clients.
+
+    Handler only passes BMP to worker's queue. Workers compress pixels to PNG and skip
+    screen identical to the previous one of the same client. Screens of one client are
+    always processed by the same worker, so their order is kept.
+
+    In 'delta' format screens of a client are stored in '<directory>/<client_id>/':
+    keyframes as PNG and other frames as '.delta' files with tiles changed since keyframe.
+    Every frame is listed in 'index.jsonl' of that folder, read_frame() restores any of them.
+
+    If WriteBehindExecutor is given, ready files are written by its writers.
+    Screen received to file is passed with its path and stored BMP is that file renamed.
+
+    Every stored screen is also downscaled to PNG preview '<directory>/previews/<client_id>.png'.
+    Latest screen of every client is listed in 'previews/index.json', previews of the most
+    recent clients are kept in memory, so overview of all clients doesn't read screens.
+    """
+    DELTA_MAGIC = b'WSD1'
+
+    def __init__(self, directory: str = 'screen', image_format: str = 'png', keep_bmp: bool = False,
+                 dedup: bool = True, compress_level: int = 6, workers: int = 2,
+                 tile_size: int = 64, keyframe_interval: int = 30, keyframe_threshold: float = 50.0,
+                 keyframe_cache_size: int = 64, executor: WriteBehindExecutor = None,
+                 preview_width: int = 320, preview_cache_size: int = 1024, preview_index: bool = True,
+                 index_interval: float = 5.0, on_preview=None):
+        self.directory = directory
+        self.executor = executor            # Files are written by executor's writers if given
+        self.image_format = image_format    # ['png', 'bmp', 'delta'] format of stored screens
+        self.keep_bmp = keep_bmp            # Store original BMP next to PNG
+        self.dedup = dedup
+        self.compress_level = compress_level
+        self.last_hashes = {}               # Client -> hash of last stored screen
+        self.tile_size = tile_size
+        self.keyframe_interval = keyframe_interval      # Frames between keyframes
+        self.keyframe_threshold = keyframe_threshold    # Changed area (%) when delta is replaced by keyframe
+        self.keyframe_cache_size = keyframe_cache_size  # Keyframes' pixels kept in memory
+        self.delta_state = {}               # Client -> {'keyframe', 'width', 'height', 'frames'}
+        self.keyframes = OrderedDict()      # Client -> RGB pixels of keyframe, LRU
+        self.keyframes_lock = threading.Lock()
+        self.preview_width = preview_width              # Maximum width of previews, 0 - no previews
+        self.preview_dir = os.path.join(directory, 'previews')
+        self.preview_cache_size = preview_cache_size    # Previews kept in memory
+        self.previews = OrderedDict()       # Client -> PNG of latest preview, LRU
+        self.latest = {}                    # Client -> {'time', 'file', 'width', 'height', 'preview'} of latest screen
+        self.previews_lock = threading.Lock()
+        self.index_fname = os.path.join(self.preview_dir, 'index.json') if preview_index else None
+        self.index_interval = index_interval    # Seconds between writes of index of latest screens
+        self.index_saved = 0.0
+        self.on_preview = on_preview        # Called with (client_id, entry, png) for every new preview
+        self.load_latest()
+        self.queues = [queue.Queue() for _ in range(workers)]
+        self.workers = [
+            threading.Thread(target=self.worker_loop, args=(tasks,), daemon=True, name=f"ScreenshotWorker-{i}")
+            for i, tasks in enumerate(self.queues)
+        ]
+        for worker in self.workers:
+            worker.start()
+
+    def submit(self, client_id: str, bmp: bytes, release=None, path: str = None) -> None:
+        """Pass screen to storage pipeline. Never blocks.
+        
+        ARGS:   client_id: client's identification ID used in file names,
+                bmp: BMP file received from client (bytes or mmap of the file),
+                release: called when screen is stored and bmp isn't needed anymore,
+                         with executor it may be called by writer after bmp is written,
+                path: name of received file if bmp is its mmap
+        Return: None
+        """
+        tasks = self.queues[hash(client_id) % len(self.queues)]
+        tasks.put((client_id, datetime.now(), bmp, release, path))
+
+    def close(self) -> None:
+        """Store all queued screens and stop workers."""
+        for tasks in self.queues:
+            tasks.put(None)
+        for worker in self.workers:
+            worker.join()
+        self.save_latest()
+
+    def worker_loop(self, tasks: queue.Queue) -> None:
+        while True:
+            task = tasks.get()
+            if task is None:
+                break
+
+            client_id, received_at, bmp, release, path = task
+            passed = False
+            try:
+                passed = self.store(client_id, received_at, bmp, path, release)
+            except Exception as e:
+                print(f"\nError while saving screen of {client_id}: {e}")
+            finally:
+                # Received BMP queued to executor is released by its writer
+                if release is not None and not passed:
+                    release()
+
+    def store(self, client_id: str, received_at: datetime, bmp: bytes, path: str = None, release=None) -> bool:
+        """Compress, deduplicate and write one screen.
+        
+        Return: True if release is passed to executor together with bmp
+        """
+        Path(self.directory).mkdir(exist_ok=True)
+        filename = f"{self.directory}/{client_id}_[{received_at.strftime('%Y-%m-%d_%H-%M-%S')}]"
+
+        try:
+            width, height, bits, offset, row_size, _ = parse_bmp(bmp)
+        except ValueError as e:
+            # Unknown picture is stored as is
+            print(f"\nScreen of {client_id} is stored as received: {e}")
+            return self.keep_file(f"{filename}.bmp", bmp, path, client_id, release)
+
+        if self.dedup:
+            digest = hashlib.blake2b(memoryview(bmp)[offset:offset + row_size * height], digest_size=16).digest()
+            if self.last_hashes.get(client_id) == digest:
+                print(f"\nScreen of {client_id} is the same as previous, not stored")
+                return False
+            self.last_hashes[client_id] = digest
+
+        # Preview is made before received BMP file is renamed
+        preview = None
+        if self.preview_width:
+            started = time.perf_counter()
+            preview = encode_png(*bmp_preview(bmp, self.preview_width), level=self.compress_level)
+            PREVIEW_RENDER.observe(time.perf_counter() - started)
+
+        if self.image_format == 'png':
+            stored = f"{filename}.png"
+            self.write_file(stored, encode_png(*bmp_to_rgb(bmp), level=self.compress_level), client_id)
+
+        elif self.image_format == 'delta':
+            stored = self.store_delta(client_id, received_at, *bmp_to_rgb(bmp))
+
+        passed = False
+        if self.image_format == 'bmp' or self.keep_bmp:
+            if self.image_format == 'bmp':
+                stored = f"{filename}.bmp"
+            passed = self.keep_file(f"{filename}.bmp", bmp, path, client_id, release)
+
+        if preview is not None:
+            self.store_preview(client_id, received_at, stored, width, height, preview)
+        return passed
+
+    def store_preview(self, client_id: str, received_at: datetime, stored: str, width: int, height: int, png: bytes) -> None:
+        """Write client's latest preview and list its screen in index."""
+        Path(self.preview_dir).mkdir(parents=True, exist_ok=True)
+        filename = os.path.join(self.preview_dir, f"{client_id}.png")
+        self.write_file(filename, png, client_id)
+        entry = {'time': received_at.isoformat(timespec='seconds'), 'file': stored, 'width': width, 'height': height, 'preview': filename}
+        self.add_preview(client_id, entry, png)
+        if self.on_preview is not None:
+            self.on_preview(client_id, entry, png)
+
+    def add_preview(self, client_id: str, entry: dict, png: bytes = None) -> None:
+        """Make screen the latest one of client.
+        
+        ARGS:   client_id: client's identification ID used in file names,
+                entry: description of screen for index,
+                png: preview, None if it is only on disk
+        Return: None
+        """
+        with self.previews_lock:
+            self.latest[client_id] = entry
+            self.previews.pop(client_id, None)
+            if png is not None and self.preview_cache_size:
+                self.previews[client_id] = png
+                while len(self.previews) > self.preview_cache_size:
+                    self.previews.popitem(last=False)
+            save = time.monotonic() - self.index_saved >= self.index_interval
+
+        if save:
+            self.save_latest()
+
+    def get_preview(self, client_id: str) -> bytes:
+        """PNG of client's latest preview, read from disk if it isn't in memory. None if client has no screens."""
+        with self.previews_lock:
+            png = self.previews.get(client_id)
+            if png is not None:
+                self.previews.move_to_end(client_id)
+                return png
+            entry = self.latest.get(client_id)
+
+        if entry is None:
+            return None
+        try:
+            with open(entry['preview'], 'rb') as f:
+                png = f.read()
+        except OSError:
+            return None
+
+        with self.previews_lock:
+            # Preview could be replaced while it was read
+            if self.preview_cache_size and self.latest.get(client_id) is entry:
+                self.previews[client_id] = png
+                while len(self.previews) > self.preview_cache_size:
+                    self.previews.popitem(last=False)
+        return png
+
+    def latest_screens(self) -> dict:
+        """Client -> description of its latest screen."""
+        with self.previews_lock:
+            return dict(self.latest)
+
+    def load_latest(self) -> None:
+        if self.index_fname is None or not Path(self.index_fname).exists():
+            return
+        try:
+            with open(self.index_fname, 'r', encoding='utf-8') as f:
+                self.latest = json.load(f)
+        except (OSError, ValueError) as e:
+            print(f"\nIndex of latest screens is broken: {e}")
+
+    def save_latest(self) -> None:
+        """Write index of latest screens. While screens are received it's written at most once in index_interval."""
+        if self.index_fname is None or not self.latest:
+            return
+        with self.previews_lock:
+            self.index_saved = time.monotonic()
+            index = json.dumps(self.latest, ensure_ascii=False).encode('utf-8')
+        Path(self.preview_dir).mkdir(parents=True, exist_ok=True)
+        # Every write of index has the same key, so they are written in order
+        self.write_file(self.index_fname, index, self.index_fname)
+
+    def store_delta(self, client_id: str, received_at: datetime, width: int, height: int, rgb: bytes) -> str:
+        """Store screen as keyframe or as tiles changed since the last keyframe. Return: name of written file."""
+        client_dir = Path(self.directory) / client_id
+        client_dir.mkdir(exist_ok=True)
+        name = received_at.strftime('%Y-%m-%d_%H-%M-%S-%f')
+
+        state = self.delta_state.get(client_id)
+        keyframe = self.get_keyframe(client_id) if state else None
+        changed = None
+
+        if (keyframe is not None and state['frames'] < self.keyframe_interval
+                and (state['width'], state['height']) == (width, height)):
+            changed = find_changed_tiles(width, height, rgb, keyframe, self.tile_size)
+            rects = (tile_rect(width, height, self.tile_size, index) for index in changed)
+            changed_area = 100.0 * sum(w * h for _, _, w, h in rects) / (width * height)
+            if changed_area > self.keyframe_threshold:
+                changed = None
+
+        if changed is None:
+            self.write_file(str(client_dir / f"{name}.png"), encode_png(width, height, rgb, level=self.compress_level), client_id)
+            state = self.delta_state[client_id] = {'keyframe': f"{name}.png", 'width': width, 'height': height, 'frames': 0}
+            with self.keyframes_lock:
+                self.keyframes[client_id] = rgb
+                self.keyframes.move_to_end(client_id)
+                while len(self.keyframes) > self.keyframe_cache_size:
+                    self.keyframes.popitem(last=False)
+            entry = {'time': received_at.isoformat(timespec='microseconds'), 'kind': 'key', 'file': f"{name}.png", 'keyframe': f"{name}.png", 'changed_area': 100.0}
+        else:
+            body = struct.pack(f'<{len(changed)}I', *changed) + b''.join(get_tile(width, height, rgb, self.tile_size, index) for index in changed)
+            header = struct.pack('<4sIIHI', self.DELTA_MAGIC, width, height, self.tile_size, len(changed))
+            self.write_file(str(client_dir / f"{name}.delta"), header + zlib.compress(body, self.compress_level), client_id)
+            state['frames'] += 1
+            entry = {'time': received_at.isoformat(timespec='microseconds'), 'kind': 'delta', 'file': f"{name}.delta", 'keyframe': state['keyframe'], 'changed_area': round(changed_area, 2)}
+
+        index_line = json.dumps(entry) + '\n'
+        if self.executor is not None:
+            # Same key as frame's file, so index line is written after the file
+            self.executor.append(str(client_dir / 'index.jsonl'), index_line, client_id)
+        else:
+            with open(client_dir / 'index.jsonl', 'a', encoding='utf-8') as index:
+                index.write(index_line)
+        return str(client_dir / entry['file'])
+
+    def get_keyframe(self, client_id: str) -> bytes:
+        """Pixels of client's current keyframe, read from disk if they aren't in memory."""
+        with self.keyframes_lock:
+            if client_id in self.keyframes:
+                self.keyframes.move_to_end(client_id)
+                return self.keyframes[client_id]
+
+        try:
+            with open(Path(self.directory) / client_id / self.delta_state[client_id]['keyframe'], 'rb') as f:
+                rgb = decode_png(f.read())[2]
+        except (OSError, ValueError):
+            return None
+
+        with self.keyframes_lock:
+            self.keyframes[client_id] = rgb
+            while len(self.keyframes) > self.keyframe_cache_size:
+                self.keyframes.popitem(last=False)
+        return rgb
+
+    def frame_index(self, client_id: str) -> list:
+        """List of stored frames of client in 'delta' format.
+        
+        ARGS:   client_id: client's identification ID used in file names
+        Return: list of dicts {'time', 'kind', 'file', 'keyframe', 'changed_area'}
+        """
+        index_filename = Path(self.directory) / client_id / 'index.jsonl'
+        if not index_filename.exists():
+            return []
+
+        with open(index_filename, 'r', encoding='utf-8') as index:
+            return [json.loads(line) for line in index if line.strip()]
+
+    def read_frame(self, client_id: str, at: datetime) -> tuple:
+        """Restore screen of client stored in 'delta' format.
+        
+        ARGS:   client_id: client's identification ID used in file names,
+                at: moment of time, the last frame received before it is restored
+        Return: tuple(width, height, RGB bytes), None if there is no such frame
+        """
+        frames = self.frame_index(client_id)
+        position = bisect.bisect_right([frame['time'] for frame in frames], at.isoformat(timespec='microseconds'))
+        if position == 0:
+            return None
+
+        frame = frames[position - 1]
+        client_dir = Path(self.directory) / client_id
+        with open(client_dir / frame['keyframe'], 'rb') as f:
+            width, height, rgb = decode_png(f.read())
+
+        if frame['kind'] == 'delta':
+            with open(client_dir / frame['file'], 'rb') as f:
+                data = f.read()
+            magic, width, height, tile, count = struct.unpack_from('<4sIIHI', data)
+            if magic != self.DELTA_MAGIC:
+                raise ValueError(f"{frame['file']} is not a delta frame")
+
+            body = memoryview(zlib.decompress(data[struct.calcsize('<4sIIHI'):]))
+            indices = struct.unpack_from(f'<{count}I', body)
+            position = count * 4
+            for index in indices:
+                *_, w, h = tile_rect(width, height, tile, index)
+                put_tile(width, height, rgb, tile, index, body[position:position + w * h * 3])
+                position += w * h * 3
+
+        return width, height, rgb
+
+    def write_file(self, filename: str, data: bytes, client_id: str, on_written=None) -> None:
+        """Write file through temporary name, so it never appears half-written."""
+        if self.executor is not None:
+            self.executor.write(filename, data, client_id, on_written)
+            return
+
+        started = time.perf_counter()
+        with open(f"{filename}.tmp", 'wb') as f:
+            f.write(data)
+        os.replace(f"{filename}.tmp", filename)
+        FILE_WRITE.observe(time.perf_counter() - started, ('write',))
+
+    def keep_file(self, filename: str, data: bytes, path: str, client_id: str, release=None) -> bool:
+        """Store received file as is. File received to disk is renamed instead of copied.
+        
+        ARGS:   filename: name of stored file,
+                data: received file (bytes or mmap of the file),
+                path: name of received file, None if it was received to memory,
+                client_id: client's identification ID,
+                release: frees received data, executor calls it after data is written
+        Return: True if release is passed to executor
+        """
+        if path is None:
+            if self.executor is None or release is None:
+                self.write_file(filename, data, client_id)
+                return False
+            self.write_file(filename, data, client_id, release)
+            return True
+
+        try:
+            # Mapping must be closed before rename on Windows
+            data.close()
+            os.replace(path, filename)
+        except (OSError, BufferError):
+            # E.g. received files and screens are on different disks
+            self.write_file(filename, Path(path).read_bytes(), client_id)
+        return False
 
 
 class ClientDatabase:
-    """Class for interaction with client's database."""
-    def __init__(self, db_fname='clients_db.json'):
+    """Class for interaction with client's database.
+
+    Database is split into index '<name>.index.json' with summary of every client (address,
+    first and last time seen, counters, status) and history file of every client in
+    '<name>.history/' with its 'connection_history' and 'connection_rollups'. Index is loaded
+    at start, history is loaded when it is needed and kept in LRU cache of history_cache
+    clients, so start doesn't depend on how long clients' histories are.
+
+    Every change is an event, which is applied to memory and appended to journal
+    '<db_fname>.journal' by one writer thread in batches. Journal is periodically compacted:
+    changed histories and then index are replaced atomically. Every history file keeps
+    sequence number of its last event, so events replayed after crash are applied once.
+    Database of single file '<db_fname>' is converted once when index doesn't exist.
+
+    Only last history_limit sessions of each client are kept in 'connection_history'.
+    Every session is also counted in per-day 'connection_rollups':
+    {'YYYY-MM-DD': {'sessions': N, 'online_seconds': S, 'ips': [...]}}.
+    """
+    HISTORY_FIELDS = ('connection_history', 'connection_rollups')
+
+    def __init__(self, db_fname='clients_db.json', history_limit=50, compact_events=1000, compact_interval=300.0, flush_interval=0.5,
+                 history_cache=1024):
         self.db_fname = db_fname
+        name = db_fname[:-len('.json')] if db_fname.endswith('.json') else db_fname
+        self.index_fname = f"{name}.index.json"
+        self.history_dir = f"{name}.history"
+        self.history_limit = history_limit          # Raw sessions kept per client
+        self.journal_fname = f"{db_fname}.journal"
+        self.compact_events = compact_events        # Journal events before compaction
+        self.compact_interval = compact_interval    # Seconds between compactions if journal isn't empty
+        self.flush_interval = flush_interval        # Seconds writer waits to collect batch
+        self.history_cache = history_cache          # Loaded histories kept in memory
+        self.lock = threading.RLock()
+        self.events = queue.Queue()
+        self.seq = 0            # Sequence number of last applied event
+        self.snapshot_seq = 0   # Sequence number of last event in snapshot
+        self.histories = OrderedDict()  # MAC -> {'seq': ..., 'connection_history': ..., 'connection_rollups': ...}, LRU
+        self.dirty = set()      # MACs which histories changed since snapshot
         self.load_database()
+
+        self.writer_thread = threading.Thread(target=self.writer_loop, daemon=True, name="DatabaseWriter")
+        self.writer_thread.start()
     
     def load_database(self) -> dict:
-        """Load database from file."""
-        if Path(self.db_fname).exists():
+        """Load index and replay journal over it."""
+        self.clients_data = {}
+        self.seq = self.snapshot_seq = 0
+
+        if not Path(self.index_fname).exists() and Path(self.db_fname).exists():
+            self.migrate()
+
+        if Path(self.index_fname).exists():
+            try:
+                with open(self.index_fname, 'r', encoding='utf-8') as f:
+                    data = json.load(f)
+                self.clients_data = data['clients']
+                self.seq = self.snapshot_seq = data['journal_seq']
+            except (OSError, ValueError, KeyError) as e:
+                print(f"\nClient database index is broken: {e}")
+                self.clients_data = {}
+
+        self.replay_journal()
+
+    def replay_journal(self) -> None:
+        if not Path(self.journal_fname).exists():
+            return
+
+        with open(self.journal_fname, 'rb+') as f:
+            position = 0
+            for line in f:
+                try:
+                    event = json.loads(line) if line.endswith(b'\n') else None
+                except ValueError:
+                    event = None
+                if event is None:
+                    # Last line may be cut by crash while writing, it is cut off,
+                    # so new events are not appended to it
+                    print(f"\nClient database journal is cut after event {self.seq}")
+                    f.truncate(position)
+                    break
+                position += len(line)
+
+                if event['seq'] > self.seq:
+                    self.apply_event(event)
+                    self.seq = event['seq']
+
+    def migrate(self) -> None:
+        """Convert database of single file and its journal to index and history files.
+        Old file is kept as '<db_fname>.migrated'."""
+        started = time.monotonic()
+        try:
+            with open(self.db_fname, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+        except (OSError, ValueError) as e:
+            print(f"\nClient database {self.db_fname} can't be migrated: {e}")
+            return
+
+        # Snapshot written by journaled database, else plain dict of clients
+        if 'clients' in data and 'journal_seq' in data:
+            clients, self.seq = data['clients'], data['journal_seq']
+        else:
+            clients = data
+        for client_data in clients.values():
+            self.upgrade_client(client_data)
+
+        # Journal was written against old snapshot, it is replayed with full client data in memory
+        self.clients_data = clients
+        for client_mac, client_data in clients.items():
+            self.histories[client_mac] = {'seq': self.seq, **{field: client_data.pop(field) for field in self.HISTORY_FIELDS}}
+        self.dirty.update(clients)  # Not written yet, so they are never evicted
+        self.replay_journal()
+
+        Path(self.history_dir).mkdir(exist_ok=True)
+        for client_mac, history in self.histories.items():
+            self.write_history(client_mac, history, sync=False)
+        self.dirty.clear()
+        self.write_index(self.seq)
+        self.histories.clear()
+
+        with open(self.journal_fname, 'w', encoding='utf-8'):
+            pass
+        os.replace(self.db_fname, f"{self.db_fname}.migrated")
+        print(f"Client database migrated: {len(clients)} clients in {time.monotonic() - started:.1f}s, "
+              f"old file is kept as {self.db_fname}.migrated")
+
+    def history_fname(self, client_mac: str) -> str:
+        """File of client's history, MAC that isn't safe file name is hashed."""
+        if client_mac and all(char.isalnum() or char in ':-_' for char in client_mac):
+            name = client_mac.replace(':', '_')
+        else:
+            name = hashlib.sha1(client_mac.encode('utf-8')).hexdigest()
+        return os.path.join(self.history_dir, f"{name}.json")
+
+    def get_history(self, client_mac: str) -> dict:
+        """Client's history, loaded from its file if it isn't in cache.
+        
+        ARGS:   client_mac: MAC address of a client
+        Return: dict with 'seq', 'connection_history' and 'connection_rollups'
+        """
+        with self.lock:
+            history = self.histories.get(client_mac)
+            if history is not None:
+                self.histories.move_to_end(client_mac)
+                return history
+
+            history = {'seq': 0, 'connection_history': [], 'connection_rollups': {}}
+            try:
+                with open(self.history_fname(client_mac), 'r', encoding='utf-8') as f:
+                    history = json.load(f)
+            except FileNotFoundError:
+                pass
+            except (OSError, ValueError) as e:
+                print(f"\nHistory of {client_mac} is broken: {e}")
+
+            self.histories[client_mac] = history
+            if len(self.histories) > self.history_cache:
+                # Changed histories stay until they are written
+                for cached_mac in list(self.histories):
+                    if len(self.histories) <= self.history_cache:
+                        break
+                    if cached_mac not in self.dirty and cached_mac != client_mac:
+                        del self.histories[cached_mac]
+            return history
+
+    def write_history(self, client_mac: str, history, sync: bool = True) -> None:
+        """Replace client's history file, history is dict or its JSON."""
+        fname = self.history_fname(client_mac)
+        with open(f"{fname}.tmp", 'w', encoding='utf-8') as f:
+            f.write(history if isinstance(history, str) else json.dumps(history, ensure_ascii=False))
+            if sync:
+                f.flush()
+                os.fsync(f.fileno())
+        os.replace(f"{fname}.tmp", fname)
+
+    def write_index(self, snapshot_seq: int, index: str = None) -> None:
+        if index is None:
+            index = json.dumps({'journal_seq': snapshot_seq, 'clients': self.clients_data}, ensure_ascii=False)
+        tmp_fname = f"{self.index_fname}.tmp"
+        with open(tmp_fname, 'w', encoding='utf-8') as f:
+            f.write(index)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_fname, self.index_fname)
+        self.snapshot_seq = snapshot_seq
+
+    def upgrade_client(self, client_data: dict) -> None:
+        """Bring client loaded from old database to current format:
+        numeric 'Time_Online', rollups and bounded history."""
+        if 'connection_rollups' not in client_data:
+            client_data['connection_rollups'] = {}
+            client_data['total_online_seconds'] = 0.0
+
+            for conn in client_data['connection_history']:
+                if isinstance(conn['Time_Online'], str):
+                    conn['Time_Online'] = parse_timedelta(conn['Time_Online']).total_seconds()
+                self.rollup_session(client_data, conn['connected_at'], conn['ip'])
+                if conn['Time_Online'] is not None:
+                    self.rollup_online_time(client_data, conn['connected_at'], conn['Time_Online'])
+                    client_data['total_online_seconds'] += conn['Time_Online']
+
+        del client_data['connection_history'][:-self.history_limit]
+
+    def rollup_session(self, client_data: dict, connected_at: str, client_ip: str) -> None:
+        """Count new session in rollup of its day."""
+        rollup = client_data['connection_rollups'].setdefault(connected_at[:10], {'sessions': 0, 'online_seconds': 0.0, 'ips': []})
+        rollup['sessions'] += 1
+        if client_ip not in rollup['ips']:
+            rollup['ips'].append(client_ip)
+
+    def rollup_online_time(self, client_data: dict, connected_at: str, seconds: float) -> None:
+        """Add finished session's time to rollup of the day it was started."""
+        rollup = client_data['connection_rollups'].get(connected_at[:10])
+        if rollup is not None:
+            rollup['online_seconds'] += seconds
+    
+    def save_database(self) -> None:
+        """Save snapshot of database: changed histories, then index. Every file is written to
+        temporary file and replaces existing one atomically, so crash never leaves broken database."""
+        started = time.perf_counter()
+        with self.lock:
+            dirty, self.dirty = self.dirty, set()
+            histories = {client_mac: json.dumps(self.histories[client_mac], ensure_ascii=False) for client_mac in dirty}
+            index = json.dumps({'journal_seq': self.seq, 'clients': self.clients_data}, ensure_ascii=False)
+            snapshot_seq = self.seq
+
+        try:
+            Path(self.history_dir).mkdir(exist_ok=True)
+            for client_mac, history in histories.items():
+                self.write_history(client_mac, history)
+            self.write_index(snapshot_seq, index)
+        except OSError:
+            with self.lock:
+                self.dirty |= dirty
+            raise
+        DB_SAVE.observe(time.perf_counter() - started)
+
+    def writer_loop(self) -> None:
+        """Single writer of journal: commits events in batches and compacts journal."""
+        journal = open(self.journal_fname, 'a', encoding='utf-8')
+        journaled = 0
+        last_compaction = time.monotonic()
+        running = True
+
+        while running:
+            batch = []
+            try:
+                batch.append(self.events.get(timeout=self.flush_interval))
+                while True:
+                    batch.append(self.events.get_nowait())
+            except queue.Empty:
+                pass
+
+            if None in batch:
+                # close() was called
+                running = False
+                batch = [event for event in batch if event is not None]
+
+            if batch:
+                started = time.perf_counter()
+                journal.write(''.join(json.dumps(event, ensure_ascii=False) + '\n' for event in batch))
+                journal.flush()
+                os.fsync(journal.fileno())
+                DB_JOURNAL.observe(time.perf_counter() - started)
+                journaled += len(batch)
+
+            if journaled and (not running or journaled >= self.compact_events
+                              or time.monotonic() - last_compaction >= self.compact_interval):
+                try:
+                    self.save_database()
+                    # Snapshot contains every journaled event, journal can be dropped
+                    journal.close()
+                    journal = open(self.journal_fname, 'w', encoding='utf-8')
+                    journaled = 0
+                except OSError as e:
+                    print(f"\nDatabase compaction error: {e}")
+                last_compaction = time.monotonic()
+
+        journal.close()
+
+    def close(self) -> None:
+        """Commit remaining events and write final snapshot."""
+        if self.writer_thread.is_alive():
+            self.events.put(None)
+            self.writer_thread.join()
+
+    def commit_event(self, event: dict) -> None:
+        """Apply event to database and pass it to journal writer.
+        
+        ARGS:   event: dict with 'event' name, 'mac' and 'time' of change
+        Return: None
+        """
+        with self.lock:
+            self.seq += 1
+            event['seq'] = self.seq
+            self.apply_event(event)
+            self.events.put(event)
+
+    def apply_event(self, event: dict) -> None:
+        """Change database data by event. Used both for new and replayed events."""
+        client_mac = event['mac']
+
+        if event['event'] == 'create':
+            self.clients_data[client_mac] = {
+                'mac': client_mac,
+                'ip': None,
+                'port': None,
+                'first_seen': event['time'],
+                'last_seen': event['time'],
+                'total_connections': 0,
+                'total_online_seconds': 0.0
+            }
+            return
+
+        client_data = self.clients_data.get(client_mac)
+        if client_data is None:
+            return
+
+        # History written after index may already contain replayed event
+        history = self.get_history(client_mac)
+        update_history = event['seq'] > history['seq']
+        if update_history:
+            history['seq'] = event['seq']
+            self.dirty.add(client_mac)
+        connections = history['connection_history']
+
+        if event['event'] == 'connected':
+            client_data['last_seen'] = event['time']
+            client_data['total_connections'] += 1
+            client_data['ip'] = event['ip']
+            client_data['port'] = event['port']
+            client_data['status'] = 'online'
+
+            if update_history:
+                connections.append({
+                    'connected_at': event['time'],
+                    'ip': event['ip'],
+                    'port': event['port'],
+                    'disconnected_at': None,
+                    'Time_Online': None
+                })
+                self.rollup_session(history, event['time'], event['ip'])
+
+                if len(connections) > self.history_limit:
+                    del connections[:-self.history_limit]
+
+        elif event['event'] == 'disconnected':
+            client_data['last_seen'] = event['time']
+            client_data['status'] = 'offline'
+
+            last_conn = connections[-1] if connections else None
+            if update_history and last_conn and last_conn['disconnected_at'] is None:
+                last_conn['disconnected_at'] = event['time']
+                TimeDelta = datetime.fromisoformat(last_conn['disconnected_at']) - datetime.fromisoformat(last_conn['connected_at'])
+                last_conn['Time_Online'] = TimeDelta.total_seconds()
+                self.rollup_online_time(history, last_conn['connected_at'], last_conn['Time_Online'])
+            # History may be ahead of index by later sessions, so session is found by its end
+            for conn in reversed(connections):
+                if conn['disconnected_at'] == event['time']:
+                    client_data['total_online_seconds'] += conn['Time_Online']
+                    break
+    
+    def create_client(self, client_mac: str) -> None:
+        """Create client's information block in DB if needed.
+        
+        ARGS:   client_mac: MAC address of a client
+        Return: None
+        """
+        with self.lock:
+            if client_mac not in self.clients_data:
+                # Create new data for client in DB
+                self.commit_event({'event': 'create', 'mac': client_mac, 'time': datetime.now().isoformat()})
+    
+    def update_client_connection(self, client_mac: str, client_ip: str, client_port: int, status: str = 'connected') -> None:
+        """Update information about client's connetction.
+        
+        ARGS:   client_key: unique client's ID,
+                client_port: Port of connected client,
+                status: ['connected', 'disconnected'] current connection status
+        Return: None
+        """
+        with self.lock:
+            if client_mac in self.clients_data and status in ['connected', 'disconnected']:
+                self.commit_event({
+                    'event': status,
+                    'mac': client_mac,
+                    'ip': client_ip,
+                    'port': client_port,
+                    'time': datetime.now().isoformat()
+                })
+    
+    def get_client_info(self, client_mac: str) -> dict:
+        """Client's summary from index with its 'connection_history' and 'connection_rollups',
+        history is loaded if it isn't in cache.
+        
+        ARGS:   client_mac: MAC address of a client
+        Return: dict of client's data, None for unknown client
+        """
+        with self.lock:
+            client_data = self.clients_data.get(client_mac, None)
+            if client_data is None:
+                return None
+            history = self.get_history(client_mac)
+            return {**client_data, **{field: history[field] for field in self.HISTORY_FIELDS}}
+    
+    def get_connection_history(self, client_mac: str) -> list:
+        if client_mac in self.clients_data:
+            return self.get_history(client_mac)['connection_history']
+        return []
+
+    def query_clients(self, status: str = None, ip_prefix: str = None, seen_after: datetime = None, seen_before: datetime = None,
+                      offset: int = 0, limit: int = 50) -> tuple:
+        """Page of clients' summaries matching all given filters, in order clients were first seen.
+        
+        ARGS:   status: 'online' or 'offline', None - any,
+                ip_prefix: beginning of client's last IP address,
+                seen_after, seen_before: bounds of client's last time online,
+                offset: number of matching clients skipped,
+                limit: maximum number of clients in page
+        Return: (number of matching clients, list of summaries)
+        """
+        with self.lock:
+            clients = list(self.clients_data.values())
+
+        # Times are kept in ISO format, so they are compared as strings
+        after = seen_after.isoformat() if seen_after else None
+        before = seen_before.isoformat() if seen_before else None
+        matching = [
+            client_data for client_data in clients
+            if (status is None or client_data.get('status') == status)
+            and (ip_prefix is None or (client_data['ip'] or '').startswith(ip_prefix))
+            and (after is None or client_data['last_seen'] >= after)
+            and (before is None or client_data['last_seen'] <= before)
+        ]
+
+        with self.lock:
+            page = [dict(client_data) for client_data in matching[offset:offset + limit]]
+        return len(matching), page
+
+class ProcessStore:
+    """Indexed store of process lists received from clients (SQLite).
+
+    Writer thread keeps the last process list of every client as pid -> exe map and on each
+    ProcessJSON saves only the difference: table process_runs has a row per process
+    (mac, exe, pid, started, stopped), which is inserted when process appears and closed
+    when it disappears. Every checkpoint_interval-th list (and the first one of client's
+    session) is also saved in full to snapshots/processes tables. Runs are indexed by exe
+    and by MAC, so lookups don't read snapshots.
+    """
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS snapshots (
+            id INTEGER PRIMARY KEY,
+            mac TEXT NOT NULL,
+            ts REAL NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS snapshots_mac_ts ON snapshots (mac, ts);
+
+        CREATE TABLE IF NOT EXISTS processes (
+            snapshot_id INTEGER NOT NULL,
+            exe TEXT NOT NULL,
+            pid INTEGER NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS processes_snapshot ON processes (snapshot_id);
+
+        CREATE TABLE IF NOT EXISTS process_runs (
+            mac TEXT NOT NULL,
+            exe TEXT NOT NULL COLLATE NOCASE,
+            pid INTEGER NOT NULL,
+            started REAL NOT NULL,
+            stopped REAL
+        );
+        CREATE INDEX IF NOT EXISTS process_runs_exe ON process_runs (exe, started);
+        CREATE INDEX IF NOT EXISTS process_runs_mac ON process_runs (mac, started);
+        CREATE INDEX IF NOT EXISTS process_runs_stopped ON process_runs (mac, stopped);
+    """
+
+    def __init__(self, db_fname: str = 'processes.db', batch_size: int = 256, checkpoint_interval: int = 100, log=None):
+        self.db_fname = db_fname
+        self.batch_size = batch_size
+        self.checkpoint_interval = checkpoint_interval  # Lists between full checkpoints
+        self.log = log                  # Optional log(client_mac, text) for changes
+        self.tasks = queue.Queue()
+        self.last_state = {}            # Client -> {'processes': {pid: exe}, 'ts', 'ingests'}, writer only
+        self.staged = {}                # Client -> state after batch being written, None - forgotten, writer only
+        self.staged_logs = []           # (client_mac, text) of batch being written, writer only
+
+        with self.connect() as connection:
+            connection.executescript(self.SCHEMA)
+
+        self.read_connection = self.connect()
+        self.read_lock = threading.Lock()
+        self.writer_thread = threading.Thread(target=self.writer_loop, daemon=True, name="ProcessStoreWriter")
+        self.writer_thread.start()
+
+    def connect(self) -> sqlite3.Connection:
+        # Workers of sharded server write the same file, timeout waits for other writer's commit
+        connection = sqlite3.connect(self.db_fname, timeout=30.0, check_same_thread=False)
+        # WAL lets menu read while writer commits
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("PRAGMA synchronous=NORMAL")
+        return connection
+
+    def ingest(self, client_mac: str, message: str) -> None:
+        """Pass ProcessJSON received from client to writer thread.
+        
+        ARGS:   client_mac: MAC address of client,
+                message: JSON '{ "processes": [{ "exe": ..., "pid": ... }, ...] }'
+        Return: None
+        """
+        self.tasks.put(('ingest', client_mac, time.time(), message))
+
+    def forget(self, client_mac: str) -> None:
+        """Client disconnected: close its runs and drop its last list from memory.
+        
+        ARGS:   client_mac: MAC address of client
+        Return: None
+        """
+        self.tasks.put(('forget', client_mac, time.time(), None))
+
+    def close(self) -> None:
+        """Write all queued lists and stop writer."""
+        if self.writer_thread.is_alive():
+            self.tasks.put(None)
+            self.writer_thread.join()
+        self.read_connection.close()
+
+    def writer_loop(self) -> None:
+        connection = self.connect()
+        # Take write lock at the beginning of transaction, not when reads are done
+        connection.isolation_level = 'IMMEDIATE'
+        running = True
+
+        while running:
+            batch = [self.tasks.get()]
+            try:
+                while len(batch) < self.batch_size:
+                    batch.append(self.tasks.get_nowait())
+            except queue.Empty:
+                pass
+
+            if None in batch:
+                # close() was called
+                running = False
+                batch = [task for task in batch if task is not None]
+
+            # Lists of the batch replace last_state only once it's committed. After rollback
+            # last_state still matches runs in database, so next lists are compared with them
+            self.staged = {}
+            self.staged_logs = []
+            try:
+                with connection:
+                    for kind, client_mac, ts, message in batch:
+                        if kind == 'ingest':
+                            self.write_changes(connection, client_mac, ts, message)
+                        else:
+                            self.close_runs(connection, client_mac, ts)
+            except sqlite3.Error as e:
+                print(f"\nProcess store error: {e}")
+            else:
+                for client_mac, state in self.staged.items():
+                    if state is None:
+                        self.last_state.pop(client_mac, None)
+                    else:
+                        self.last_state[client_mac] = state
+                if self.log is not None:
+                    for client_mac, text in self.staged_logs:
+                        self.log(client_mac, text)
+
+        connection.close()
+
+    def write_changes(self, connection: sqlite3.Connection, client_mac: str, ts: float, message: str) -> None:
+        """Save difference with client's previous list and checkpoint if it's time.
+        Called inside writer's transaction, new state of client is staged until commit."""
+        try:
+            current = {int(proc['pid']): sys.intern(str(proc['exe'])) for proc in json.loads(message)['processes']}
+        except (ValueError, KeyError, TypeError) as e:
+            print(f"\nInvalid process list from {client_mac}: {e}")
+            return
+
+        state = self.staged[client_mac] if client_mac in self.staged else self.last_state.get(client_mac)
+        if state is None:
+            # First list of the session continues runs left open in database
+            rows = connection.execute("SELECT pid, exe FROM process_runs WHERE mac = ? AND stopped IS NULL", (client_mac,))
+            state = {'processes': dict(rows.fetchall()), 'ts': ts, 'ingests': self.checkpoint_interval}
+        state = self.staged[client_mac] = dict(state)
+
+        previous = state['processes']
+        stopped = [(pid, exe) for pid, exe in previous.items() if current.get(pid) != exe]
+        started = [(pid, exe) for pid, exe in current.items() if previous.get(pid) != exe]
+
+        connection.executemany(
+            "UPDATE process_runs SET stopped = ? WHERE mac = ? AND pid = ? AND exe = ? AND stopped IS NULL",
+            ((ts, client_mac, pid, exe) for pid, exe in stopped)
+        )
+        connection.executemany(
+            "INSERT INTO process_runs (mac, exe, pid, started) VALUES (?, ?, ?, ?)",
+            ((client_mac, exe, pid, ts) for pid, exe in started)
+        )
+
+        checkpoint = state['ingests'] >= self.checkpoint_interval
+        if checkpoint:
+            snapshot_id = connection.execute("INSERT INTO snapshots (mac, ts) VALUES (?, ?)", (client_mac, ts)).lastrowid
+            connection.executemany(
+                "INSERT INTO processes (snapshot_id, exe, pid) VALUES (?, ?, ?)",
+                ((snapshot_id, exe, pid) for pid, exe in current.items())
+            )
+            state['ingests'] = 0
+
+        state['processes'] = current
+        state['ts'] = ts
+        state['ingests'] += 1
+
+        if self.log is not None and (checkpoint or started or stopped):
+            lines = [f"- {exe} ({pid})" for pid, exe in stopped] + [f"+ {exe} ({pid})" for pid, exe in started]
+            if checkpoint:
+                lines.append(f"Checkpoint, {len(current)} processes:\n{message.strip()}")
+            self.staged_logs.append((client_mac, '\n'.join(lines)))
+
+    def close_runs(self, connection: sqlite3.Connection, client_mac: str, ts: float) -> None:
+        """Mark client's running processes as seen until ts. Called inside writer's transaction."""
+        connection.execute("UPDATE process_runs SET stopped = ? WHERE mac = ? AND stopped IS NULL", (ts, client_mac))
+        self.staged[client_mac] = None
+
+    def query(self, sql: str, parameters: tuple) -> list:
+        with self.read_lock:
+            return self.read_connection.execute(sql, parameters).fetchall()
+
+    @staticmethod
+    def time_window(since: datetime = None, until: datetime = None) -> tuple:
+        """Convert optional window borders to timestamps."""
+        return since.timestamp() if since else 0.0, until.timestamp() if until else float('inf')
+
+    def hosts_by_exe(self, exe: str, since: datetime = None, until: datetime = None) -> list:
+        """Clients which ran exe in time window.
+        
+        ARGS:   exe: executable name (case insensitive),
+                since, until: time window, not limited if None
+        Return: list of dicts {'mac', 'first_seen', 'last_seen', 'runs'}, last_seen is None if still running
+        """
+        since_ts, until_ts = self.time_window(since, until)
+        rows = self.query(
+            """SELECT mac, MIN(started), MAX(COALESCE(stopped, 'running')), COUNT(*) FROM process_runs
+               WHERE exe = ? AND started <= ? AND (stopped IS NULL OR stopped >= ?)
+               GROUP BY mac ORDER BY MAX(started) DESC""",
+            (exe, until_ts, since_ts)
+        )
+        return [{'mac': mac, 'first_seen': datetime.fromtimestamp(first),
+                 'last_seen': None if last == 'running' else datetime.fromtimestamp(last), 'runs': count}
+                for mac, first, last, count in rows]
+
+    def exes_by_host(self, client_mac: str, since: datetime = None, until: datetime = None) -> list:
+        """Executables client ran in time window.
+        
+        ARGS:   client_mac: MAC address of client,
+                since, until: time window, not limited if None
+        Return: list of dicts {'exe', 'first_seen', 'last_seen', 'runs'}, last_seen is None if still running
+        """
+        since_ts, until_ts = self.time_window(since, until)
+        rows = self.query(
+            """SELECT exe, MIN(started), MAX(COALESCE(stopped, 'running')), COUNT(*) FROM process_runs
+               WHERE mac = ? AND started <= ? AND (stopped IS NULL OR stopped >= ?)
+               GROUP BY exe ORDER BY exe""",
+            (client_mac, until_ts, since_ts)
+        )
+        return [{'exe': exe, 'first_seen': datetime.fromtimestamp(first),
+                 'last_seen': None if last == 'running' else datetime.fromtimestamp(last), 'runs': count}
+                for exe, first, last, count in rows]
+
+    def process_changes(self, client_mac: str, since: datetime = None, until: datetime = None) -> list:
+        """Processes started and stopped on client in time window.
+        
+        ARGS:   client_mac: MAC address of client,
+                since, until: time window, not limited if None
+        Return: list of tuples (time, 'started' or 'stopped', exe, pid) ordered by time
+        """
+        since_ts, until_ts = self.time_window(since, until)
+        rows = self.query(
+            """SELECT started, 'started', exe, pid FROM process_runs WHERE mac = ? AND started BETWEEN ? AND ?
+               UNION ALL
+               SELECT stopped, 'stopped', exe, pid FROM process_runs WHERE mac = ? AND stopped BETWEEN ? AND ?
+               ORDER BY 1, 2 DESC""",
+            (client_mac, since_ts, until_ts, client_mac, since_ts, until_ts)
+        )
+        return [(datetime.fromtimestamp(ts), change, exe, pid) for ts, change, exe, pid in rows]
+
+    def snapshot_at(self, client_mac: str, at: datetime = None) -> tuple:
+        """Rebuild process list of client: the last checkpoint before given time
+        with changes made after it.
+        
+        ARGS:   client_mac: MAC address of client,
+                at: moment of time, now if None
+        Return: tuple(time of last known change, list of (exe, pid)), None if there is no checkpoint
+        """
+        at_ts = at.timestamp() if at else float('inf')
+        rows = self.query("SELECT id, ts FROM snapshots WHERE mac = ? AND ts <= ? ORDER BY ts DESC LIMIT 1", (client_mac, at_ts))
+        if not rows:
+            return None
+
+        snapshot_id, checkpoint_ts = rows[0]
+        processes = set(self.query("SELECT exe, pid FROM processes WHERE snapshot_id = ?", (snapshot_id,)))
+        last_change = checkpoint_ts
+
+        # Stops go before starts of the same moment (pid reused by new process)
+        for change_ts, change, exe, pid in self.query(
+                """SELECT stopped, 0, exe, pid FROM process_runs WHERE mac = ? AND stopped > ? AND stopped <= ?
+                   UNION ALL
+                   SELECT started, 1, exe, pid FROM process_runs WHERE mac = ? AND started > ? AND started <= ?
+                   ORDER BY 1, 2""",
+                (client_mac, checkpoint_ts, at_ts, client_mac, checkpoint_ts, at_ts)):
+            if change:
+                processes.add((exe, pid))
+            else:
+                processes.discard((exe, pid))
+            last_change = change_ts
+
+        return datetime.fromtimestamp(last_change), sorted(processes)
+
+
+class ClientSession:
+    """Connected client."""
+    __slots__ = ('number', 'socket', 'ip', 'port', 'mac', 'connected_at', 'online_before',
+                 'outbox', 'outbox_lock', 'draining', 'broken', 'awaiting', 'reader', 'protocol', 'codec', 'next_request_id',
+                 'requests')
+    MAX_REQUESTS = 1024     # Unanswered requests remembered for latency, oldest are forgotten
+
+    def __init__(self, client_socket, client_ip: str, client_port: int, client_mac: str, online_before: bool = False,
+                 protocol: int = 1, codec: str = None):
+        self.number = None              # Number in menu, given by ClientRegistry
+        self.socket = client_socket
+        self.ip = client_ip
+        self.port = client_port
+        self.mac = client_mac
+        self.connected_at = datetime.now()
+        self.online_before = online_before
+        self.outbox = deque()           # (data, Future, answer) waiting to be sent by CommandDispatcher
+        self.outbox_lock = threading.Lock()
+        self.draining = False           # Outbox is being sent by dispatcher's thread
+        self.broken = False             # Message was sent partially, connection is being closed
+        self.awaiting = None            # Answer v1 client must send before next command is sent
+        self.reader = None              # FrameReader of connection, tells if client is sending payload
+        self.protocol = protocol        # 1 - text headers, 2 - binary frames
+        self.codec = codec              # Compression negotiated with v2 client
+        self.next_request_id = 1
+        self.requests = OrderedDict()   # Request ID -> (command, monotonic time it was framed)
+
+    def frame(self, data: bytes) -> bytes:
+        """Message as it is sent to client: as is for v1 client, Command frame with new
+        request ID for v2 client. Called under outbox_lock, so IDs go in sending order.
+        
+        ARGS:   data: command
+        Return: bytes to be sent
+        """
+        if self.protocol != 2:
+            return data
+
+        request_id = self.next_request_id
+        self.next_request_id = self.next_request_id % 0xFFFFFFFF + 1
+        self.requests[request_id] = (data.decode('utf-8', errors='replace'), time.monotonic())
+        if len(self.requests) > self.MAX_REQUESTS:
+            self.requests.popitem(last=False)
+        return encode_frame(FRAME_TYPE_IDS["Command"], data, request_id, self.codec)
+
+    def busy(self) -> bool:
+        """True while message waits in outbox or v1 client hasn't answered the last command."""
+        with self.outbox_lock:
+            return bool(self.outbox) or self.awaiting is not None
+
+    def answered(self, request_id: int) -> tuple:
+        """Forget request answered by client.
+        
+        ARGS:   request_id: request ID of received frame
+        Return: (command, seconds since it was framed), None if request is unknown
+        """
+        if not request_id:
+            return None
+        with self.outbox_lock:
+            request = self.requests.pop(request_id, None)
+        if request is None:
+            return None
+        return request[0], time.monotonic() - request[1]
+
+
+class ClientRegistry:
+    """Active clients keyed by MAC.
+
+    Every registered session gets a number for the menu. Numbers are given in connection
+    order and don't change while client is connected, so lookup by number, lookup by MAC
+    or IP and removal don't depend on number of clients.
+
+    New connection of client replaces its old session, e.g. the one left by broken
+    network which isn't closed yet. Caller closes replaced session.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.sessions = {}      # MAC -> session
+        self.numbers = {}       # Number -> session, in connection order
+        self.ips = {}           # IP -> {MAC -> session}, several clients may be behind one address
+        self.next_number = 1
+
+    def register(self, session: ClientSession) -> ClientSession:
+        """Add session, session of the same MAC is replaced.
+        
+        ARGS:   session: session of connected client
+        Return: replaced session, None if client wasn't registered
+        """
+        with self.lock:
+            replaced = self.sessions.get(session.mac)
+            if replaced is not None:
+                self.remove(replaced)
+
+            session.number = self.next_number
+            self.next_number += 1
+            self.sessions[session.mac] = session
+            self.numbers[session.number] = session
+            self.ips.setdefault(session.ip, {})[session.mac] = session
+            return replaced
+
+    def unregister(self, session: ClientSession) -> bool:
+        """Remove session if it is still registered.
+        
+        ARGS:   session: session returned to register
+        Return: False if session wasn't registered or was replaced
+        """
+        with self.lock:
+            if self.sessions.get(session.mac) is not session:
+                return False
+            self.remove(session)
+            return True
+
+    def remove(self, session: ClientSession) -> None:
+        """Remove registered session. Called under lock."""
+        del self.sessions[session.mac]
+        del self.numbers[session.number]
+        same_ip = self.ips[session.ip]
+        del same_ip[session.mac]
+        if not same_ip:
+            del self.ips[session.ip]
+
+    def get(self, client_mac: str) -> ClientSession:
+        with self.lock:
+            return self.sessions.get(client_mac)
+
+    def by_ip(self, client_ip: str) -> list:
+        """Sessions of clients connected from IP address."""
+        with self.lock:
+            return list(self.ips.get(client_ip, {}).values())
+
+    def by_number(self, number: int) -> ClientSession:
+        with self.lock:
+            return self.numbers.get(number)
+
+    def snapshot(self) -> list:
+        """Registered sessions in connection order."""
+        with self.lock:
+            return list(self.numbers.values())
+
+    def __len__(self) -> int:
+        return len(self.sessions)
+
+
+class CommandDispatcher:
+    """Sends messages to clients from a pool of threads.
+
+    Every session has its own outbox. Message is put into it and the outbox is sent by one
+    of pool's threads, so messages to one client keep their order while a client that
+    doesn't read its socket holds only one thread, not the sender.
+
+    Client of protocol v1 reads commands without delimiter and runs only the first one it
+    finds in received bytes, so commands sent back to back are lost. Command with answer
+    (ANSWERS) is sent to v1 client only after its previous command is answered or
+    answer_timeout passed. Sessions relayed to shard workers are held by the worker.
+
+    Socket's own timeout is short poll of client's handler, message is written to plain
+    socket for up to write_timeout. sendall may fail after part of message is sent, client
+    would take the next message as the rest of it, so such session is marked broken and
+    its connection is closed. Wrappers of asyncio and shard sockets send whole message or nothing.
+    """
+    DELIVERED = 'delivered'
+    FAILED = 'failed'
+    TIMED_OUT = 'timed_out'
+    ANSWERS = {b"SEND_STAT": "ProcessJSON", b"SEND_SCREEN": "ScreenShot BMP", b"SEND_MAC": "MAC_ADDRESS"}
+
+    def __init__(self, workers: int = 32, answer_timeout: float = 30.0, write_timeout: float = 30.0):
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="CommandSender")
+        self.answer_timeout = answer_timeout    # Seconds v1 client may take to answer before next command is sent
+        self.write_timeout = write_timeout      # Seconds client may not read before its connection is closed
+        self.deadlines = {}                     # Session waiting for answer -> monotonic deadline
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.watchdog = threading.Thread(target=self.watchdog_loop, daemon=True, name="AnswerWatchdog")
+        self.watchdog.start()
+
+    def send(self, session: ClientSession, data: bytes) -> Future:
+        """Put message into session's outbox.
+        
+        ARGS:   session: client's session,
+                data: message to be sent
+        Return: Future with DELIVERED, FAILED or TIMED_OUT status
+        """
+        future = Future()
+        answer = self.ANSWERS.get(bytes(data)) if session.protocol != 2 and not isinstance(session.socket, ShardSocket) else None
+        with session.outbox_lock:
+            if session.broken:
+                future.set_result(self.FAILED)
+                return future
+            session.outbox.append((session.frame(data), future, answer))
+            if session.draining or session.awaiting is not None:
+                return future
+            session.draining = True
+
+        self.pool.submit(self.drain, session)
+        return future
+
+    def broadcast(self, sessions: list, data: bytes, timeout: float = 2.0) -> dict:
+        """Send message to many clients at once.
+        
+        ARGS:   sessions: clients' sessions,
+                data: message to be sent,
+                timeout: seconds to wait for all clients
+        Return: dict MAC -> status, messages not sent in time are TIMED_OUT
+        """
+        futures = {session.mac: self.send(session, data) for session in sessions}
+        wait(futures.values(), timeout=timeout)
+        return {mac: future.result() if future.done() else self.TIMED_OUT for mac, future in futures.items()}
+
+    def drain(self, session: ClientSession) -> None:
+        """Send session's outbox until it's empty or v1 client has to answer sent command."""
+        while True:
+            with session.outbox_lock:
+                if not session.outbox or session.awaiting is not None:
+                    session.draining = False
+                    return
+                data, future, answer = session.outbox.popleft()
+                # Answer may come before sending returns
+                session.awaiting = answer
+            if answer is not None:
+                with self.lock:
+                    self.deadlines[session] = time.monotonic() + self.answer_timeout
+
             try:
-                with open(self.db_fname, 'r', encoding='utf-8') as f:
-                    self.clients_data = json.load(f)
-            except:
-                self.clients_data = {}
-        else:
-            self.clients_data = {}
-    
-    def save_database(self) -> None:
-        """Save database to file. Rewrites existing file when use."""
-        with open(self.db_fname, 'w', encoding='utf-8') as f:
-            json.dump(self.clients_data, f, ensure_ascii=False, indent=4)
-    
-    def create_client(self, client_mac: str) -> None:
-        """Create client's information block in DB if needed.
+                self.write(session.socket, data)
+                future.set_result(self.DELIVERED)
+                continue
+            except socket.timeout:
+                status = self.TIMED_OUT
+            except Exception:
+                status = self.FAILED
+
+            if answer is not None:
+                self.resume(session, answer)
+            if isinstance(session.socket, socket.socket):
+                self.break_session(session)
+                future.set_result(status)
+                return
+            future.set_result(status)
+
+    def write(self, sock, data: bytes) -> None:
+        """Send whole message. Plain socket is written for up to write_timeout, not its own timeout."""
+        if not isinstance(sock, socket.socket):
+            sock.sendall(data)
+            return
+
+        view = memoryview(data)
+        deadline = time.monotonic() + self.write_timeout
+        while view:
+            try:
+                view = view[sock.send(view):]
+            except socket.timeout:
+                if time.monotonic() >= deadline:
+                    raise
+
+    def answered(self, session: ClientSession, command: str) -> None:
+        """Frame is received from client: send next command if it is the awaited answer.
         
-        ARGS:   client_mac: MAC address of a client
+        ARGS:   session: client's session,
+                command: command of received frame
         Return: None
         """
-        if client_mac not in self.clients_data:
-            # Create new data for client in DB
-            self.clients_data[client_mac] = {
-                'mac': client_mac,
-                'ip': None,
-                'port': None,
-                'first_seen': datetime.now().isoformat(),
-                'last_seen': datetime.now().isoformat(),
-                'total_connections': 0,
-                'connection_history': []
-            }
-    
-    def update_client_connection(self, client_mac: str, client_ip: str, client_port: int, status: str = 'connected') -> None:
-        """Update information about client's connetction.
+        if session.awaiting is not None and session.awaiting == command:
+            self.resume(session, command)
+
+    def resume(self, session: ClientSession, answer: str = None) -> None:
+        """Stop waiting for answer and send next messages of session.
         
-        ARGS:   client_key: unique client's ID,
-                client_port: Port of connected client,
-                status: ['connected', 'disconnected'] current connection status
+        ARGS:   session: client's session,
+                answer: awaited answer, None - stop waiting for any
         Return: None
         """
-        if client_mac in self.clients_data:
-            client_data = self.clients_data[client_mac]
-            
-            if status == 'connected':
-                client_data['last_seen'] = datetime.now().isoformat()
-                client_data['total_connections'] += 1
-                client_data['ip'] = client_ip
-                client_data['port'] = client_port
-                client_data['status'] = 'online'
-                client_data['connection_history'].append({
-                    'connected_at': datetime.now().isoformat(),
-                    'ip': client_ip,
-                    'port': client_port,
-                    'disconnected_at': None,
-                    'Time_Online': None
-                })
-            
-            elif status == 'disconnected':
-                client_data['last_seen'] = datetime.now().isoformat()
-                client_data['status'] = 'offline'
-
-                if client_data['connection_history']:
-                    client_data['connection_history'][-1]['disconnected_at'] = datetime.now().isoformat()
-                    TimeDelta = datetime.fromisoformat(client_data['connection_history'][-1]['disconnected_at']) - datetime.fromisoformat(client_data['connection_history'][-1]['connected_at'])
-                    client_data['connection_history'][-1]['Time_Online'] = str(TimeDelta)
-            
-            self.save_database()
-    
-    def get_client_info(self, client_mac: str) -> dict:
-        return self.clients_data.get(client_mac, None)
-    
-    def get_connection_history(self, client_mac: str) -> list:
-        if client_mac in self.clients_data:
-            return self.clients_data[client_mac]['connection_history']
-        return []
+        with self.lock:
+            self.deadlines.pop(session, None)
+        with session.outbox_lock:
+            if answer is not None and session.awaiting != answer:
+                return
+            session.awaiting = None
+            if session.draining or session.broken or not session.outbox:
+                return
+            session.draining = True
+
+        self.pool.submit(self.drain, session)
+
+    def watchdog_loop(self) -> None:
+        """Send next messages of v1 clients that didn't answer in time."""
+        while not self.stopped.wait(0.5):
+            now = time.monotonic()
+            with self.lock:
+                expired = [session for session, deadline in self.deadlines.items() if deadline < now]
+            for session in expired:
+                self.resume(session)
+
+    def break_session(self, session: ClientSession) -> None:
+        """Fail messages left in outbox and close connection which stream may be cut in the middle of message."""
+        with session.outbox_lock:
+            session.broken = True
+            session.draining = False
+            pending, session.outbox = session.outbox, deque()
+        with self.lock:
+            self.deadlines.pop(session, None)
+
+        print(f"\n[{datetime.now().strftime('%H:%M:%S')}] Closing {session.mac} ({session.ip}:{session.port}): message wasn't sent completely")
+        try:
+            session.socket.close()
+        except OSError:
+            pass
+        for _, future, _ in pending:
+            future.set_result(self.FAILED)
+
+    def close(self) -> None:
+        self.stopped.set()
+        self.pool.shutdown(wait=False, cancel_futures=True)
+
+
+class UploadScheduler:
+    """Asks clients for screens in waves.
+
+    At most max_inflight clients upload screen at the same time. Next waiting client
+    is asked when one of uploads is received, isn't delivered or timed out, so asking
+    all clients for screen doesn't make every client send its BMP at once.
+    """
+    def __init__(self, dispatcher: CommandDispatcher, max_inflight: int = 16, upload_timeout: float = 60.0):
+        self.dispatcher = dispatcher
+        self.max_inflight = max_inflight        # 0 - unlimited
+        self.upload_timeout = upload_timeout    # Seconds to wait for screen after request
+        self.pending = OrderedDict()            # MAC -> session waiting for its turn
+        self.inflight = {}                      # MAC -> (session, deadline)
+        self.requested = 0
+        self.completed = 0
+        self.expired = 0
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.watchdog = threading.Thread(target=self.watchdog_loop, daemon=True, name="UploadWatchdog")
+        self.watchdog.start()
+
+    def request(self, sessions: list) -> int:
+        """Queue screen requests.
+        
+        ARGS:   sessions: clients' sessions
+        Return: number of clients queued, clients already waiting or uploading are skipped
+        """
+        queued = 0
+        with self.lock:
+            for session in sessions:
+                if session.mac in self.pending or session.mac in self.inflight:
+                    continue
+                self.pending[session.mac] = session
+                queued += 1
+
+        self.pump()
+        return queued
+
+    def finished(self, session: ClientSession) -> None:
+        """Screen of client is received."""
+        with self.lock:
+            entry = self.inflight.get(session.mac)
+            if entry is not None and entry[0] is session:
+                del self.inflight[session.mac]
+                self.completed += 1
+
+        self.pump()
+
+    def forget(self, session: ClientSession) -> None:
+        """Client disconnected or request wasn't delivered."""
+        with self.lock:
+            entry = self.inflight.get(session.mac)
+            if entry is not None and entry[0] is session:
+                del self.inflight[session.mac]
+            if self.pending.get(session.mac) is session:
+                del self.pending[session.mac]
+
+        self.pump()
+
+    def busy(self, mac: str) -> bool:
+        """True if client is asked for screen or waits for its turn."""
+        with self.lock:
+            return mac in self.inflight or mac in self.pending
+
+    def pump(self) -> None:
+        """Ask next waiting clients while there are free upload slots."""
+        wave = []
+        with self.lock:
+            if self.stopped.is_set():
+                return
+            while self.pending and (not self.max_inflight or len(self.inflight) < self.max_inflight):
+                mac, session = self.pending.popitem(last=False)
+                self.inflight[mac] = (session, time.monotonic() + self.upload_timeout)
+                self.requested += 1
+                wave.append(session)
+
+        for session in wave:
+            sending = self.dispatcher.send(session, b"SEND_SCREEN")
+            sending.add_done_callback(lambda sending, session=session: self.sent(session, sending))
+
+    def sent(self, session: ClientSession, sending: Future) -> None:
+        """Free client's slot if request wasn't delivered."""
+        if sending.result() != CommandDispatcher.DELIVERED:
+            self.forget(session)
+
+    def watchdog_loop(self) -> None:
+        """Free slots of clients that didn't send screen in time."""
+        while not self.stopped.wait(1.0):
+            now = time.monotonic()
+            with self.lock:
+                for mac, (session, deadline) in list(self.inflight.items()):
+                    if deadline < now:
+                        del self.inflight[mac]
+                        self.expired += 1
+            self.pump()
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                'pending': len(self.pending),
+                'inflight': len(self.inflight),
+                'requested': self.requested,
+                'completed': self.completed,
+                'expired': self.expired,
+            }
+
+    def close(self) -> None:
+        with self.lock:
+            self.stopped.set()
+            self.pending.clear()
+        self.watchdog.join(timeout=2.0)
+
+
+class CollectionScheduler:
+    """Asks connected clients for process lists and screens periodically.
+
+    Every client has one entry per command in a heap ordered by due time, so one thread
+    serves any number of clients and each tick costs O(log n). First due time of a client
+    is random within the interval, so clients connected at once are spread over it.
+    Entries of disconnected clients are dropped when they come up. Client still sending
+    previous payload is skipped until the next interval. Command that comes up while
+    client's previous command isn't sent or answered yet is put off by STAGGER seconds,
+    so both commands of one tick aren't sent to client together.
+
+    Intervals can be set for groups of clients matched by MAC or IP prefix, in seconds as
+    stat_interval and screen_interval given here:
+    [{"name": "office", "macs": [...], "ip_prefixes": ["10.0.1."], "stat_interval": 30, "screen_interval": 600}]
+    File of groups has the units of command line options, see load_groups.
+    """
+    COMMANDS = ("SEND_STAT", "SEND_SCREEN")
+    RATE_WINDOW = 60.0      # Seconds of history used for rate and lag
+    STAGGER = 1.0           # Seconds command waits for client's previous command
+
+    def __init__(self, clients: ClientRegistry, dispatcher: CommandDispatcher, uploads: UploadScheduler,
+                 stat_interval: float = 0.0, screen_interval: float = 0.0, groups: list = None):
+        self.clients = clients
+        self.dispatcher = dispatcher
+        self.uploads = uploads
+        self.intervals = {"SEND_STAT": stat_interval, "SEND_SCREEN": screen_interval}  # Seconds, 0 - disabled
+        self.groups = groups or []
+        self.heap = []                  # [due, sequence, command, session, interval]
+        self.sequence = 0
+        self.history = {command: deque() for command in self.COMMANDS}     # (sent_at, lag)
+        self.skipped = dict.fromkeys(self.COMMANDS, 0)
+        self.condition = threading.Condition()
+        self.running = True
+        self.thread = threading.Thread(target=self.run, daemon=True, name="CollectionScheduler")
+        self.thread.start()
+
+    @staticmethod
+    def load_groups(fname: str) -> list:
+        """Read groups from JSON file. As in --stat-interval and --screen-interval, stat_interval
+        is given in seconds and screen_interval in minutes, returned groups have both in seconds.
+        
+        ARGS:   fname: name of JSON file with list of groups
+        Return: list of groups
+        """
+        with open(fname, 'r', encoding='utf-8') as f:
+            groups = json.load(f)
+
+        for group in groups:
+            if 'screen_interval' in group:
+                group['screen_interval'] = float(group['screen_interval']) * 60
+        return groups
+
+    def intervals_for(self, session: ClientSession) -> dict:
+        """Intervals of client's group or default ones."""
+        for group in self.groups:
+            if session.mac in group.get('macs', ()) or any(session.ip.startswith(prefix) for prefix in group.get('ip_prefixes', ())):
+                return {
+                    "SEND_STAT": group.get('stat_interval', self.intervals["SEND_STAT"]),
+                    "SEND_SCREEN": group.get('screen_interval', self.intervals["SEND_SCREEN"]),
+                }
+        return self.intervals
+
+    def add(self, session: ClientSession) -> None:
+        """Start collecting from connected client."""
+        now = time.monotonic()
+        with self.condition:
+            for command, interval in self.intervals_for(session).items():
+                if interval > 0:
+                    self.push(now + random.uniform(0, interval), command, session, interval)
+            self.condition.notify()
+
+    def push(self, due: float, command: str, session: ClientSession, interval: float) -> None:
+        self.sequence += 1
+        heapq.heappush(self.heap, [due, self.sequence, command, session, interval])
+
+    def run(self) -> None:
+        while True:
+            with self.condition:
+                while self.running and (not self.heap or self.heap[0][0] > time.monotonic()):
+                    self.condition.wait(self.heap[0][0] - time.monotonic() if self.heap else None)
+                if not self.running:
+                    return
+
+                now = time.monotonic()
+                due, _, command, session, interval = heapq.heappop(self.heap)
+                if self.clients.get(session.mac) is not session:
+                    # Client disconnected
+                    continue
+                if session.busy():
+                    self.push(now + self.STAGGER, command, session, interval)
+                    continue
+                self.push(max(due + interval, now), command, session, interval)
+
+            self.collect(command, session, now - due)
+
+    def collect(self, command: str, session: ClientSession, lag: float) -> None:
+        """Send command unless client is busy with previous one."""
+        busy = self.uploads.busy(session.mac) or (session.reader is not None and session.reader.receiving_payload())
+        if busy:
+            self.skipped[command] += 1
+            return
+
+        if command == "SEND_SCREEN":
+            self.uploads.request([session])
+        else:
+            self.dispatcher.send(session, command.encode('utf-8'))
+
+        now = time.monotonic()
+        history = self.history[command]
+        history.append((now, lag))
+        while history and history[0][0] < now - self.RATE_WINDOW:
+            history.popleft()
+
+    def stats(self) -> dict:
+        """Rate per minute and lag in seconds of every command over last RATE_WINDOW seconds."""
+        now = time.monotonic()
+        with self.condition:
+            scheduled = {command: 0 for command in self.COMMANDS}
+            for _, _, command, session, _ in self.heap:
+                if self.clients.get(session.mac) is session:
+                    scheduled[command] += 1
+
+        stats = {}
+        for command in self.COMMANDS:
+            recent = [lag for sent_at, lag in list(self.history[command]) if sent_at >= now - self.RATE_WINDOW]
+            stats[command] = {
+                'interval': self.intervals[command],
+                'scheduled': scheduled[command],
+                'rate': len(recent) * 60.0 / self.RATE_WINDOW,
+                'lag_avg': sum(recent) / len(recent) if recent else 0.0,
+                'lag_max': max(recent, default=0.0),
+                'skipped': self.skipped[command],
+            }
+        return stats
+
+    def close(self) -> None:
+        with self.condition:
+            self.running = False
+            self.condition.notify()
+        self.thread.join(timeout=2.0)
+
+
+class ControlAPI:
+    """JSON control API of server on local HTTP endpoint, so server can run without menu
+    and be driven by scripts. Menu and API use the same methods of server.
+
+    GET  /api/clients       known clients page by page, filters: status (online/offline),
+                            ip (prefix), seen_after and seen_before (ISO time of last
+                            connection), offset, limit
+    GET  /api/history       client's summary, sessions and daily statistics: mac, limit
+    GET  /preview           PNG preview of client's latest screen: mac
+    GET  /overview          HTML grid of previews of all clients, filters as in /api/clients
+    POST /api/send          send command to connected client: mac, command
+    POST /api/broadcast     send command to all connected clients: command
+    POST /api/disconnect    close connection of client: mac, ip for all clients of address,
+                            or all=true for all clients
+
+    POST parameters are JSON object, request must have LocalHTTPServer.TOKEN_HEADER.
+    """
+    PAGE_SIZE = 50
+    MAX_PAGE_SIZE = 1000
+
+    def __init__(self, server):
+        self.server = server
+
+    def routes(self) -> dict:
+        return {
+            '/api/clients': self.list_clients,
+            '/api/history': self.client_history,
+            '/preview': self.preview,
+            '/overview': self.overview,
+        }
+
+    def post_routes(self) -> dict:
+        return {
+            '/api/send': self.send,
+            '/api/broadcast': self.broadcast,
+            '/api/disconnect': self.disconnect,
+        }
+
+    @staticmethod
+    def reply(data, status: int = 200) -> tuple:
+        return status, 'application/json', json.dumps(data, ensure_ascii=False)
+
+    @staticmethod
+    def parse_time(query: dict, name: str) -> datetime:
+        value = query.get(name)
+        if not value:
+            return None
+        try:
+            return datetime.fromisoformat(value)
+        except ValueError:
+            raise ValueError(f"{name} must be time in ISO format, got {value!r}")
+
+    @staticmethod
+    def parse_int(query: dict, name: str, default: int, maximum: int = None) -> int:
+        try:
+            value = int(query.get(name, default))
+        except (TypeError, ValueError):
+            raise ValueError(f"{name} must be integer, got {query.get(name)!r}")
+        if value < 0:
+            raise ValueError(f"{name} must not be negative")
+        return min(value, maximum) if maximum is not None else value
+
+    def parse_command(self, query: dict) -> str:
+        command = str(query.get('command', '')).upper()
+        if command not in self.server.COMMANDS.values():
+            raise ValueError(f"command must be one of {', '.join(self.server.COMMANDS.values())}")
+        return command
+
+    def connected_client(self, query: dict) -> ClientSession:
+        return self.server.clients.get(str(query.get('mac', '')))
+
+    def describe_session(self, session: ClientSession) -> dict:
+        return {
+            'number': session.number,
+            'ip': session.ip,
+            'port': session.port,
+            'connected_at': session.connected_at.isoformat(),
+            'protocol': session.protocol,
+        }
+
+    def query_clients(self, query: dict, offset: int, limit: int) -> tuple:
+        """Clients' summaries filtered by parameters of request."""
+        status = query.get('status') or None
+        if status not in (None, 'online', 'offline'):
+            raise ValueError("status must be online or offline")
+
+        return self.server.db.query_clients(
+            status=status, ip_prefix=query.get('ip') or None,
+            seen_after=self.parse_time(query, 'seen_after'), seen_before=self.parse_time(query, 'seen_before'),
+            offset=offset, limit=limit
+        )
+
+    def list_clients(self, query: dict) -> tuple:
+        offset = self.parse_int(query, 'offset', 0)
+        limit = self.parse_int(query, 'limit', self.PAGE_SIZE, self.MAX_PAGE_SIZE)
+        total, page = self.query_clients(query, offset, limit)
+
+        screens = self.server.screenshots.latest_screens()
+        for client_data in page:
+            session = self.server.clients.get(client_data['mac'])
+            client_data['session'] = self.describe_session(session) if session is not None else None
+            client_data['screen'] = screens.get(client_data['mac'].replace(':', '_'))
+        return self.reply({'total': total, 'offset': offset, 'limit': limit, 'clients': page})
+
+    def preview(self, query: dict) -> tuple:
+        png = self.server.screenshots.get_preview(str(query.get('mac', '')).replace(':', '_'))
+        if png is None:
+            return self.reply({'error': f"No screens of {query.get('mac')}"}, 404)
+        return 200, 'image/png', png
+
+    def overview(self, query: dict) -> tuple:
+        _, clients = self.query_clients(query, 0, len(self.server.db.clients_data))
+        screens = self.server.screenshots.latest_screens()
+
+        cells = []
+        for client_data in clients:
+            screen = screens.get(client_data['mac'].replace(':', '_'))
+            if screen is None:
+                continue
+            # Time in URL makes browser load new preview instead of cached one
+            source = f"/preview?{urlencode({'mac': client_data['mac'], 't': screen['time']})}"
+            cells.append(
+                f'<figure class="{escape(client_data.get("status", "offline"))}">'
+                f'<a href="{escape(source)}"><img src="{escape(source)}" loading="lazy" alt=""></a>'
+                f'<figcaption>{escape(client_data["mac"])} {escape(str(client_data["ip"]))}<br>{escape(screen["time"])}</figcaption></figure>'
+            )
+
+        page = (
+            '<!DOCTYPE html><html><head><meta charset="utf-8"><title>WorkerSPY overview</title><style>'
+            'body{font-family:sans-serif;margin:8px;background:#eee}'
+            'main{display:grid;grid-template-columns:repeat(auto-fill,minmax(240px,1fr));gap:8px}'
+            'figure{margin:0;padding:4px;background:#fff;border-top:4px solid #aaa}figure.online{border-top-color:#3a3}'
+            'img{width:100%;display:block}figcaption{font-size:12px}'
+            f'</style></head><body><p>{len(cells)} clients with screens</p><main>{"".join(cells)}</main></body></html>'
+        )
+        return 200, 'text/html; charset=utf-8', page
+
+    def client_history(self, query: dict) -> tuple:
+        client_data = self.server.db.get_client_info(query.get('mac'))
+        if client_data is None:
+            return self.reply({'error': f"Unknown client {query.get('mac')}"}, 404)
+        limit = self.parse_int(query, 'limit', self.server.db.history_limit)
+
+        with self.server.db.lock:
+            reply = dict(client_data)
+            reply['connection_history'] = list(client_data['connection_history'][-limit:]) if limit else []
+            reply['connection_rollups'] = dict(client_data['connection_rollups'])
+        return self.reply(reply)
+
+    def send(self, query: dict) -> tuple:
+        command = self.parse_command(query)
+        session = self.connected_client(query)
+        if session is None:
+            return self.reply({'error': f"Client {query.get('mac')} isn't connected"}, 404)
+        return self.reply({'mac': session.mac, 'command': command, 'status': self.server.send_command(session, command)})
+
+    def broadcast(self, query: dict) -> tuple:
+        command = self.parse_command(query)
+        results = self.server.broadcast_command(command)
+        statuses = list(results.values())
+        counts = {status: statuses.count(status) for status in set(statuses)}
+        return self.reply({'command': command, 'clients': len(results), 'statuses': counts, 'results': results})
+
+    def disconnect(self, query: dict) -> tuple:
+        if str(query.get('all', '')).lower() in ('1', 'true', 'yes'):
+            sessions = self.server.clients.snapshot()
+        elif 'ip' in query:
+            sessions = self.server.clients.by_ip(str(query['ip']))
+            if not sessions:
+                return self.reply({'error': f"No clients connected from {query['ip']}"}, 404)
+        else:
+            session = self.connected_client(query)
+            if session is None:
+                return self.reply({'error': f"Client {query.get('mac')} isn't connected"}, 404)
+            sessions = [session]
+
+        for session in sessions:
+            self.server.close_client(session)
+            print(f"\n[{datetime.now().strftime('%H:%M:%S')}] Disconnected by API: {session.mac} ({session.ip}:{session.port})")
+        return self.reply({'disconnected': [session.mac for session in sessions]})
+
 
 class Server:
     """"Classs for server realisation."""
-    def __init__(self):
-        self.HOST = '127.0.0.1'
-        self.PORT = 8888
-        self.clients = []
-        self.clients_lock = threading.Lock()
+    HANDSHAKE_TIMEOUT = 30.0    # Seconds for client to answer SEND_MAC
+    COMMANDS = {0: "SEND_MAC", 1: "SEND_STAT", 2: "SEND_SCREEN", 3: "DEAUTH_REQUEST"}  # Menu's numbers of commands
+    SCREEN_QUEUED = 'queued'                # Screen request waits for upload slot
+    SCREEN_REQUESTED = 'already_requested'  # Client is already waiting or uploading screen
+
+    def __init__(self, history_limit: int = 50, screen_format: str = 'png', keep_bmp: bool = False, dedup_screens: bool = True,
+                 io_writers: int = 2, io_queue: int = 1024, io_full_policy: str = 'block', text_logs: bool = False,
+                 send_workers: int = 32, send_timeout: float = 2.0, max_uploads: int = 16, upload_timeout: float = 60.0,
+                 memory_budget: int = 256 * 1024 * 1024, client_rate: int = 0,
+                 max_screen_size: int = 128 * 1024 * 1024, max_json_size: int = 16 * 1024 * 1024,
+                 payload_sink: str = 'file', stat_interval: float = 0.0, screen_interval: float = 0.0,
+                 schedule_groups: list = None, host: str = '127.0.0.1', port: int = 8888, backlog: int = None,
+                 http_port: int = 0, headless: bool = False, preview_width: int = 320):
+        self.HOST = host
+        self.PORT = port
+        self.BACKLOG = backlog or 5
+        self.reuse_port = False     # Set by workers sharing port
+        self.clients = ClientRegistry()
+        self.dispatcher = CommandDispatcher(workers=send_workers)
+        self.send_timeout = send_timeout    # Seconds to wait for delivery of command
+        self.uploads = UploadScheduler(self.dispatcher, max_inflight=max_uploads, upload_timeout=upload_timeout)
+        self.budget = MemoryBudget(limit=memory_budget)
+        self.client_rate = client_rate      # Bytes per second received from one client, 0 - unlimited
+        self.max_sizes = {"ProcessJSON": max_json_size, "ScreenShot BMP": max_screen_size}
+        self.payload_sink = payload_sink    # ['file', 'memory'] where screens are received
+        self.collector = CollectionScheduler(
+            self.clients, self.dispatcher, self.uploads,
+            stat_interval=stat_interval, screen_interval=screen_interval, groups=schedule_groups
+        )
         self.server_commands = ["SEND_STAT", "SEND_SCREEN", "DEAUTH_REQUEST"]
-        self.db = ClientDatabase(db_fname='clients_db.json')
+        self.db = self.open_database(history_limit)
+        self.io = WriteBehindExecutor(writers=io_writers, max_queue=io_queue, full_policy=io_full_policy)
+        self.screenshots = self.open_screenshots(image_format=screen_format, keep_bmp=keep_bmp, dedup=dedup_screens, preview_width=preview_width)
+        self.text_logs = text_logs  # Also write process changes to logs/<mac>.txt
+        self.processes = ProcessStore(
+            db_fname='processes.db',
+            log=(lambda client_mac, changes: self.log_client_message(client_mac.replace(':', '_'), changes)) if text_logs else None
+        )
         self.server_running = True
         self.server_socket = None
+
+        METRICS.gauge('workerspy_active_sessions', "Connected clients", lambda: len(self.clients))
+        METRICS.gauge('workerspy_payload_memory_bytes', "Payload bytes held in memory", lambda: self.budget.used)
+        METRICS.gauge('workerspy_io_queue_depth', "Tasks waiting for I/O writers", lambda: self.io.metrics()['queue_depth'])
+        self.profiler = SamplingProfiler()
+        self.headless = headless    # No menu, server is controlled by API and stopped by signal
+        self.api = ControlAPI(self)
+        self.http = None            # Local endpoint with metrics, profile and control API
+        if http_port:
+            try:
+                self.http = LocalHTTPServer(http_port, self.http_routes(), post_routes=self.api.post_routes())
+            except OSError as e:
+                print(f"\nHTTP endpoint error: {e}")
     
+    def open_database(self, history_limit: int) -> ClientDatabase:
+        return ClientDatabase(db_fname='clients_db.json', history_limit=history_limit)
+
+    def open_screenshots(self, **kwargs) -> ScreenshotStore:
+        return ScreenshotStore(directory='screen', executor=self.io, **kwargs)
+
+    def create_server_socket(self) -> socket.socket:
+        """Listening socket on HOST:PORT."""
+        server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            if self.reuse_port:
+                # Kernel spreads connections between all sockets bound to the port
+                server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+            server_socket.bind((self.HOST, self.PORT))
+            server_socket.listen(self.BACKLOG)
+        except OSError:
+            server_socket.close()
+            raise
+        return server_socket
+
+    def announce_start(self, mode: str = "") -> None:
+        print("=" * 60)
+        print(f"Server started at {self.HOST}:{self.PORT}{mode}")
+        print(f"Starting time: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
+        if self.http is not None:
+            print(f"HTTP endpoint: http://127.0.0.1:{self.http.port}")
+            print(f"Control API token ({self.http.TOKEN_HEADER}): {self.http.token}")
+        print("=" * 60)
+
+    def announce_stop(self) -> None:
+        print("\n" + "=" * 60)
+        print("Server completely stopped")
+        print("=" * 60)
+
     def handle_client(self, client_socket: socket.socket, client_address: tuple[str, str]) -> None:
         """Function for making 
         
@@ -111,159 +3360,208 @@ class Server:
         client_ip = client_address[0]
         client_port = client_address[1]
         client_mac = None
+        handshake = Handshake()
         
         try:
+            client_socket.settimeout(self.HANDSHAKE_TIMEOUT)
             mac_message = "SEND_MAC"
             client_socket.send(mac_message.encode('utf-8'))
-            data = client_socket.recv(4096)
-            message = data.decode('utf-8').strip().split(',')
-            
-            if message[0] == "MAC_ADDRESS":
-                data = client_socket.recv(1024)
-                message = data.decode('utf-8').strip()
-                client_mac = message
+
+            # MAC may come in one segment with its header or in several ones
+            while not handshake.feed(client_socket.recv(4096)):
+                pass
+            client_mac = handshake.mac
+            if handshake.version == 2:
+                client_socket.sendall(handshake.reply())
         except Exception as e:
             print(f"\nEncountered [{client_mac}]: [{e}]\n")
+            client_socket.close()
             return
 
-        self.db.create_client(client_mac)
-        client_db_data = self.db.get_client_info(client_mac)
-        client_info = {
-            'socket': client_socket,
-            'ip': client_ip,
-            'port': client_port,
-            'mac': client_mac,
-            'connected_at': datetime.now(),
-            'online_before': client_db_data['total_connections'] > 1
-        }
-
-        if client_info['mac'] in [client['mac'] for client in self.clients]:
-            deauth_message = "DEAUTH_REQUEST"
-            client_socket.send(deauth_message.encode('utf-8'))
-            print(f"\n[{datetime.now().strftime('%H:%M:%S')}] Attempting multiple connection {client_mac} ({client_ip}:{client_port})")
+        session = self.register_client(client_socket, client_ip, client_port, client_mac, handshake.version, handshake.codec)
+        if session is None:
+            # Connection that wasn't registered got DEAUTH_REQUEST and isn't served, its socket must not stay in CLOSE-WAIT
+            client_socket.close()
             return
-        
-        self.db.update_client_connection(client_mac, client_ip, client_port, 'connected')
-        print(f"\n[{datetime.now().strftime('%H:%M:%S')}] Connected: {client_mac} ({client_ip}:{client_port})")
 
-        with self.clients_lock:
-            self.clients.append(client_info)
+        reader = session.reader = self.new_frame_reader(session.protocol)
+        bucket = TokenBucket(self.client_rate)
 
         try:
-            client_input_command = None # ["ProcessJSON", "ScreenShot BMP"]
-            client_message_chunks = [] # Get client's big data by 4096 bytes chunks if needed
-            client_message_size = None
-            receiving_size = 1 # Receive message by 1 byte until '\n' read
+            client_socket.settimeout(1.0)
 
-            while self.server_running:
-                client_socket.settimeout(1.0)
+            # Client may send first frames right after its MAC
+            for frame in reader.feed(handshake.rest):
+                self.handle_frame(session, frame)
 
+            while self.server_running:
+                received = reader.received_bytes
                 try:
-                    data = client_socket.recv(receiving_size)
-                        
-                    if not data:
-                        break
-                    
-                    # Not in receiving process from client
-                    if not client_input_command:
-                        chunk = data.decode('utf-8')
-                        client_message_chunks.append(chunk)
-                        
-                        if chunk == '\n':
-                            message = "".join(client_message_chunks).split(',') # Expected <"CommandName", "Message size">
-                            if message[0] not in ["ProcessJSON", "ScreenShot BMP"]:
-                                print(f"[{datetime.now().strftime('%H:%M:%S')}] Unrecognized message {client_mac} ({client_ip}:{client_port})")
-                            else:
-                                client_input_command = message[0]
-                                client_message_size = int(message[1])
-                                client_message_chunks = []
-                                receiving_size = 4096
-
-                    # Receiving Process Information from client
-                    elif client_input_command == "ProcessJSON":
-                        message = data.decode('utf-8')
-                        client_message_chunks.append(message)
-                        client_message = ''.join(client_message_chunks)
-                        receiving_size = min(4096, client_message_size - len(client_message))
-                        
-                        if len(client_message) == client_message_size:
-                            filename = client_db_data['mac'].replace(':', '_')
-                            self.log_client_message(filename, client_message)
-                            print(f"\n[{datetime.now().strftime('%H:%M:%S')}] Received running processes from client {client_mac} ({client_ip}:{client_port})\n")
-                            
-                            client_message_chunks = []
-                            client_input_command = None
-                            client_message_size = None
-                            receiving_size = 1
-
-                    # Receiving screenshot from client
-                    elif client_input_command == "ScreenShot BMP":
-                        client_message_chunks.append(data)
-                        bytes_read = sum([len(chunk) for chunk in client_message_chunks])
-                        receiving_size = min(4096, client_message_size - bytes_read)
-
-                        if bytes_read == client_message_size:
-                            filename = client_db_data['mac'].replace(':', '_')
-                            self.save_screenshoot(filename, client_message_chunks)
-                            print(f"\n[{datetime.now().strftime('%H:%M:%S')}] Received screenshot from client {client_mac} ({client_ip}:{client_port})\n")
-                            
-                            client_message_chunks = []
-                            client_input_command = None
-                            client_message_size = None
-                            receiving_size = 1
-                
+                    frames = reader.recv_from(client_socket)
                 except socket.timeout:
                     continue
+                RECV_CALLS.inc()
+
+                if frames is None:
+                    break
+
+                for frame in frames:
+                    self.handle_frame(session, frame)
+
+                pause = bucket.consume(reader.received_bytes - received)
+                if pause:
+                    time.sleep(pause)
 
         except ConnectionResetError:
             print("\nClient Disconnected!")
         except OSError as e:
-                if getattr(e, 'winerror', None) != 10038:
+                if getattr(e, 'winerror', None) != 10038 and e.errno != errno.EBADF:
                     print(f"\nError with:{client_mac} ({client_ip}:{client_port}) [{e}]")
         except Exception as e:
             print(f"\n[{datetime.now().strftime('%H:%M:%S')}] Error with: {client_mac} ({client_ip}:{client_port}): {e}")
         
         finally:
-            self.db.update_client_connection(client_mac, client_ip, client_port, 'disconnected')
-
-            with self.clients_lock:
-                if client_info in self.clients:
-                    self.clients.remove(client_info)
-
-            print(f"\n[{datetime.now().strftime('%H:%M:%S')}] Disconnected: {client_mac} ({client_ip}:{client_port})")
+            reader.close()
+            self.unregister_client(session)
 
             try:
                 client_socket.close()
             except OSError as e:
-                if getattr(e, 'winerror', None) != 10038:
+                if getattr(e, 'winerror', None) != 10038 and e.errno != errno.EBADF:
                     print(f"Error with client {client_mac} ({client_ip}:{client_port}): {e}")
 
+    def register_client(self, client_socket, client_ip: str, client_port: int, client_mac: str,
+                        protocol: int = 1, codec: str = None) -> ClientSession:
+        """Add client to active clients after handshake.
+        
+        ARGS:   client_socket: socket of client (or object with same send/close methods),
+                client_ip: IP of client,
+                client_port: Port of client,
+                client_mac: MAC address received from client,
+                protocol: protocol version of client,
+                codec: compression negotiated with v2 client
+        Return: client's session
+        """
+        self.db.create_client(client_mac)
+        client_db_data = self.db.get_client_info(client_mac)
+        session = ClientSession(client_socket, client_ip, client_port, client_mac, client_db_data['total_connections'] > 1,
+                                protocol, codec)
+
+        # Registry and database change together, so replaced session's disconnection
+        # written by its handler never closes the new session in history
+        with self.db.lock:
+            replaced = self.clients.register(session)
+            if replaced is not None:
+                self.db.update_client_connection(client_mac, replaced.ip, replaced.port, 'disconnected')
+            self.db.update_client_connection(client_mac, client_ip, client_port, 'connected')
+        if replaced is not None:
+            self.uploads.forget(replaced)
+            self.close_client(replaced)
+            print(f"\n[{datetime.now().strftime('%H:%M:%S')}] Connection replaced by new one: {client_mac} ({replaced.ip}:{replaced.port})")
+
+        self.collector.add(session)
+        print(f"\n[{datetime.now().strftime('%H:%M:%S')}] Connected: {client_mac} ({client_ip}:{client_port})")
+
+        return session
+
+    def new_frame_reader(self, protocol: int = 1) -> FrameReader:
+        """Reader of client's stream with server's payload limits and memory budget."""
+        reader_class = FrameReaderV2 if protocol == 2 else FrameReader
+        return reader_class(
+            max_sizes=self.max_sizes,
+            budget=self.budget,
+            spool_dir='incoming',
+            file_commands=("ScreenShot BMP",) if self.payload_sink == 'file' else ()
+        )
+
+    def unregister_client(self, session: ClientSession) -> None:
+        """Remove client from active clients after disconnection.
+        
+        ARGS:   session: client's session returned by register_client
+        Return: None
+        """
+        with self.db.lock:
+            if not self.clients.unregister(session):
+                # Replaced by new connection, its disconnection is already written
+                return
+            self.db.update_client_connection(session.mac, session.ip, session.port, 'disconnected')
+        self.processes.forget(session.mac)
+        self.uploads.forget(session)
+
+        print(f"\n[{datetime.now().strftime('%H:%M:%S')}] Disconnected: {session.mac} ({session.ip}:{session.port})")
+
+    def handle_frame(self, session: ClientSession, frame: Frame) -> None:
+        """Process one message received from client.
+        
+        ARGS:   session: client's session returned by register_client,
+                frame: message received from client
+        Return: None
+        """
+        filename = session.mac.replace(':', '_')
+        if frame.payload is not None:
+            # Names of unrecognized messages come from clients, they aren't used as labels
+            message_type = (frame.command if frame.command in FrameReader.FRAME_COMMANDS else 'other',)
+            RECEIVED_BYTES.inc(len(frame.payload), message_type)
+            PAYLOAD_ASSEMBLY.observe(frame.assembly_time, message_type)
+        self.dispatcher.answered(session, frame.command)
+        answered = session.answered(frame.request_id)
+        if answered is not None:
+            print(f"\n[{datetime.now().strftime('%H:%M:%S')}] {session.mac} answered {answered[0]} #{frame.request_id} in {answered[1]:.3f}s")
+
+        # Receiving Process Information from client
+        if frame.command == "ProcessJSON":
+            self.processes.ingest(session.mac, str(frame.payload, 'utf-8', errors='replace'))
+            frame.release()
+            print(f"\n[{datetime.now().strftime('%H:%M:%S')}] Received running processes from client {session.mac} ({session.ip}:{session.port})\n")
+
+        # Receiving screenshot from client
+        elif frame.command == "ScreenShot BMP":
+            self.uploads.finished(session)
+            self.save_screenshoot(filename, frame.payload, frame.release, frame.path)
+            print(f"\n[{datetime.now().strftime('%H:%M:%S')}] Received screenshot from client {session.mac} ({session.ip}:{session.port})\n")
+
+        else:
+            frame.release()
+            print(f"[{datetime.now().strftime('%H:%M:%S')}] Unrecognized message {session.mac} ({session.ip}:{session.port})")
+
     def log_client_message(self, client_ID: str, message: str) -> None:
         """Function for logging client's message to log file.
+        Message is written by I/O executor's writer threads.
         
         ARGS:   client_ID: client's identification ID,
                 message: client's message to log
         Return: None
         """
         log_filename = f"logs/{client_ID}.txt"
-        Path("logs").mkdir(exist_ok=True)
         
-        with open(log_filename, 'a', encoding='utf-8') as log:
-            log.write(f"\n[{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}]\n{message}\n")
+        if not self.io.append(log_filename, f"\n[{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}]\n{message}\n", client_ID):
+            print(f"\n[{datetime.now().strftime('%H:%M:%S')}] I/O queue is full, message of {client_ID} is dropped")
 
-    def save_screenshoot(self, client_mac: str, photo_data: list) -> None:
-        """Function for saving client's screen picture
+    def save_screenshoot(self, client_mac: str, photo_data: bytes, release=None, path: str = None) -> None:
+        """Function for saving client's screen picture. Picture is passed to
+        screenshots storage pipeline, compression is done in its own threads.
         
         ARGS:   client_mac: client's MAC address,
-                photo_data: list of chunks given in bytes received from client
+                photo_data: BMP file received from client,
+                release: called when picture is stored,
+                path: name of file picture was received to
         Return: None
         """
-        screen_filename = f"screen/{client_mac}_[{datetime.now().strftime('%Y-%m-%d_%H-%M-%S')}].bmp"
-        Path("screen").mkdir(exist_ok=True)
+        self.screenshots.submit(client_mac, photo_data, release, path)
 
-        with open(screen_filename, 'wb') as photo:
-            for photo_chunk in photo_data:
-                photo.write(photo_chunk)
+    def close_storages(self) -> None:
+        """Write everything received before server stops."""
+        if self.http is not None:
+            self.http.close()
+        self.profiler.stop()
+        self.collector.close()
+        self.uploads.close()
+        self.dispatcher.close()
+        self.screenshots.close()
+        self.io.close()
+        self.processes.close()
+        if self.db is not None:
+            self.db.close()
 
     def show_menu(self) -> None:
         """Showing server controll menu"""
@@ -276,6 +3574,10 @@ class Server:
         print("4. Send command to all clients")
         print("5. Disconnect client")
         print("6. Disconnect all clients")
+        print("7. Show I/O and upload statistics")
+        print("8. Search processes")
+        print("9. Show collection schedule")
+        print("10. Show metrics and profiler")
         print("0. Stop server")
         print("=" * 60)
 
@@ -288,8 +3590,25 @@ class Server:
         print("3. Ask client to deauth")
         print("=" * 60)
 
+    def wait_stop(self) -> None:
+        """Headless server works until it is interrupted by Ctrl+C or SIGTERM."""
+        if self.http is not None:
+            print(f"Running without menu, control API: http://127.0.0.1:{self.http.port}/api/clients")
+        else:
+            print("Running without menu, control API is disabled (see --http-port)")
+        try:
+            while self.server_running:
+                time.sleep(0.5)
+        except KeyboardInterrupt:
+            print("\n\nStopping server...")
+        self.server_running = False
+
     def menu_loop(self) -> None:
         """Server control section"""
+        if self.headless:
+            self.wait_stop()
+            return
+
         while self.server_running:
             try:
                 self.show_menu()
@@ -338,6 +3657,22 @@ class Server:
                 elif choice == '6':
                     self.disconnect_all_clients()
 
+                # I/O executor's metrics
+                elif choice == '7':
+                    self.show_io_statistics()
+
+                # Lookups in process store
+                elif choice == '8':
+                    self.search_processes()
+
+                # Periodic collection's rate and lag
+                elif choice == '9':
+                    self.show_collection_statistics()
+
+                # Counters, latency histograms and sampling profiler
+                elif choice == '10':
+                    self.show_metrics()
+
                 # Server interruption
                 elif choice == '0':
                     confirm = input("\nEnterupt server? (yes/no): ").lower()
@@ -358,75 +3693,321 @@ class Server:
             except Exception as e:
                 print(f"\nError in menu section: {e}")
     
-    def list_clients(self) -> None:
-        """All connected clients list"""
-        with self.clients_lock:
-            if not self.clients:
-                print("No active clients")
+    def show_io_statistics(self) -> None:
+        """Write-behind I/O executor's counters"""
+        print("\n" + "=" * 60)
+        self.print_io_metrics(self.io.metrics(), self.budget.metrics())
+        print("-" * 60)
+        self.print_upload_statistics()
+        print("=" * 60)
+
+    def print_io_metrics(self, metrics: dict, budget: dict) -> None:
+        print(f"I/O queue depth: {metrics['queue_depth']}/{metrics['queue_capacity']} (max {metrics['max_depth']} per writer)")
+        print(f"Full queue policy: {self.io.full_policy}")
+        print(f"Tasks submitted: {metrics['submitted']}, written: {metrics['written']} in {metrics['batches']} batches")
+        print(f"Dropped: {metrics['dropped']}, spilled: {metrics['spilled']}, errors: {metrics['errors']}")
+        print(f"Open files: {metrics['open_files']}")
+        limit = f"{budget['limit'] / 2**20:.0f} MB" if budget['limit'] else "unlimited"
+        print(f"Payload memory: {budget['used'] / 2**20:.1f} MB of {limit} (peak {budget['peak'] / 2**20:.1f} MB)")
+        print(f"Payloads received to disk: {budget['spooled']}")
+
+    def print_upload_statistics(self) -> None:
+        uploads = self.uploads.stats()
+        print(f"Screen uploads: {uploads['inflight']}/{self.uploads.max_inflight or 'unlimited'} in flight, {uploads['pending']} waiting")
+        print(f"Requested: {uploads['requested']}, received: {uploads['completed']}, timed out: {uploads['expired']}")
+
+    def show_collection_statistics(self) -> None:
+        """Periodic collection's intervals, effective rate and lag"""
+        stats = self.collector.stats()
+        print("\n" + "=" * 60)
+        print(f"{'Command':<12} {'Interval':>9} {'Clients':>8} {'Per min':>8} {'Lag avg':>8} {'Lag max':>8} {'Skipped':>8}")
+        print("-" * 60)
+        for command, command_stats in stats.items():
+            interval = f"{command_stats['interval']:g} s" if command_stats['interval'] else "off"
+            print(f"{command:<12} {interval:>9} {command_stats['scheduled']:>8} {command_stats['rate']:>8.1f} "
+                  f"{command_stats['lag_avg']:>7.2f}s {command_stats['lag_max']:>7.2f}s {command_stats['skipped']:>8}")
+        if self.collector.groups:
+            print(f"Groups with own intervals: {', '.join(group.get('name', '?') for group in self.collector.groups)}")
+        print("=" * 60)
+
+    def http_routes(self) -> dict:
+        return {
+            '/metrics': lambda query: (200, 'text/plain; version=0.0.4', Metrics.render(self.collect_metrics())),
+            '/profile': lambda query: (200, 'text/plain', SamplingProfiler.collapsed(self.profile_stacks())),
+            **self.api.routes(),
+        }
+
+    def collect_metrics(self) -> list:
+        return METRICS.collect()
+
+    def set_profiling(self, enabled: bool) -> None:
+        if enabled:
+            self.profiler.start()
+        else:
+            self.profiler.stop()
+
+    def profile_stacks(self) -> dict:
+        return self.profiler.snapshot()
+
+    def reset_profile(self) -> None:
+        self.profiler.reset()
+
+    def show_metrics(self) -> None:
+        """Counters and latency histograms, sampling profiler's control"""
+        print("\n" + "=" * 80)
+        for name, kind, _, samples in self.collect_metrics():
+            for sample_name, labels, value in samples:
+                if kind == 'histogram' and not sample_name.endswith('_count'):
+                    continue
+                label_text = ','.join(f"{key}={label}" for key, label in labels.items())
+                title = f"{sample_name}{{{label_text}}}" if label_text else sample_name
+                if kind == 'histogram':
+                    total = next(value for sum_name, sum_labels, value in samples
+                                 if sum_name == name + '_sum' and sum_labels == labels)
+                    average = total / value if value else 0.0
+                    print(f"{title:<64} {value:>8}  avg {average * 1000:.2f} ms")
+                else:
+                    print(f"{title:<64} {value:>8}")
+        if self.http is not None:
+            print(f"\nPrometheus endpoint: http://127.0.0.1:{self.http.port}/metrics")
+        print("=" * 80)
+
+        print(f"Profiler is {'running' if self.profiler.running else 'stopped'}")
+        print("1. Start/stop profiler")
+        print("2. Show profile")
+        print("3. Reset profile")
+        option = input("\nChoose action (0 to exit): ").strip()
+
+        if option == '1':
+            self.set_profiling(not self.profiler.running)
+            print(f"\nProfiler is {'running' if self.profiler.running else 'stopped'}")
+
+        elif option == '2':
+            stacks = self.profile_stacks()
+            print(f"\n{'Self':>8} {'Total':>8}  Function ({sum(stacks.values())} samples)")
+            print("-" * 80)
+            for function, own, total in SamplingProfiler.top_functions(stacks):
+                print(f"{own:>8} {total:>8}  {function}")
+            if self.http is not None:
+                print(f"\nCollapsed stacks for flame graph: http://127.0.0.1:{self.http.port}/profile")
+
+        elif option == '3':
+            self.reset_profile()
+
+    @staticmethod
+    def input_time(prompt: str) -> datetime:
+        """Ask time in 'YYYY-MM-DD[ HH:MM[:SS]]' format, empty input means None."""
+        while True:
+            value = input(prompt).strip()
+            if not value:
+                return None
+            try:
+                return datetime.fromisoformat(value)
+            except ValueError:
+                print("Invalid time format. Expected YYYY-MM-DD or YYYY-MM-DD HH:MM")
+
+    def search_processes(self) -> None:
+        """Lookups in process store by exe, by MAC and by time window"""
+        print("\n" + "=" * 60)
+        print("Search:")
+        print("1. Clients which ran executable")
+        print("2. Executables ran by client")
+        print("3. Client's process list at time")
+        print("4. Processes started and stopped on client")
+        print("=" * 60)
+        option = input("\nChoose search (0 to exit): ").strip()
+
+        if option == '1':
+            exe = input("Executable name: ").strip()
+            since = self.input_time("From (YYYY-MM-DD [HH:MM], empty - any): ")
+            until = self.input_time("To (YYYY-MM-DD [HH:MM], empty - any): ")
+            started = time.perf_counter()
+            hosts = self.processes.hosts_by_exe(exe, since, until)
+
+            print(f"\n{exe} was running on {len(hosts)} clients ({(time.perf_counter() - started) * 1000:.1f} ms)")
+            print("-" * 80)
+            for host in hosts:
+                last_seen = host['last_seen'].strftime('%Y-%m-%d %H:%M:%S') if host['last_seen'] else "[Running]"
+                print(f"{host['mac']}  {host['first_seen'].strftime('%Y-%m-%d %H:%M:%S')} - {last_seen}  runs: {host['runs']}")
+
+        elif option == '2':
+            client_mac = input("Client's MAC: ").strip().upper()
+            since = self.input_time("From (YYYY-MM-DD [HH:MM], empty - any): ")
+            until = self.input_time("To (YYYY-MM-DD [HH:MM], empty - any): ")
+            started = time.perf_counter()
+            exes = self.processes.exes_by_host(client_mac, since, until)
+
+            print(f"\n{client_mac} ran {len(exes)} executables ({(time.perf_counter() - started) * 1000:.1f} ms)")
+            print("-" * 80)
+            for exe in exes:
+                last_seen = exe['last_seen'].strftime('%Y-%m-%d %H:%M:%S') if exe['last_seen'] else "[Running]"
+                print(f"{exe['exe']}  {exe['first_seen'].strftime('%Y-%m-%d %H:%M:%S')} - {last_seen}  runs: {exe['runs']}")
+
+        elif option == '3':
+            client_mac = input("Client's MAC: ").strip().upper()
+            at = self.input_time("Time (YYYY-MM-DD [HH:MM], empty - now): ")
+            snapshot = self.processes.snapshot_at(client_mac, at)
+
+            if snapshot is None:
+                print(f"\nNo process lists of {client_mac}")
                 return
-            
-            print("\n" + "=" * 80)
-            print(f"Number of active clients: {len(self.clients)}")
+
+            snapshot_time, processes = snapshot
+            print(f"\nProcesses of {client_mac} at {snapshot_time.strftime('%Y-%m-%d %H:%M:%S')}: {len(processes)}")
             print("-" * 80)
-            
-            for i, client in enumerate(self.clients, 1):
-                uptime = datetime.now() - client['connected_at']
-                print(f"{i}. {client['mac']}\n")
-                print(f"MAC: {client['mac']}")
-                print(f"IP: {client['ip']}:{client['port']}")
-                print(f"Connected at: {client['connected_at'].strftime('%Y-%m-%d %H:%M:%S')}")
-                print(f"Time online: {uptime}")
-                print("-" * 80)
-            print("=" * 80)
-    
-    def show_client_history(self) -> None:
-        """All clients history"""
+            for exe, pid in processes:
+                print(f"{pid:>8}  {exe}")
+
+        elif option == '4':
+            client_mac = input("Client's MAC: ").strip().upper()
+            since = self.input_time("From (YYYY-MM-DD [HH:MM], empty - any): ")
+            until = self.input_time("To (YYYY-MM-DD [HH:MM], empty - any): ")
+            changes = self.processes.process_changes(client_mac, since, until)
+
+            print(f"\nProcess changes of {client_mac}: {len(changes)}")
+            print("-" * 80)
+            for change_time, change, exe, pid in changes:
+                print(f"{change_time.strftime('%Y-%m-%d %H:%M:%S')}  {'+' if change == 'started' else '-'} {exe} ({pid})")
+
+    def list_clients(self) -> None:
+        """All connected clients list"""
+        sessions = self.clients.snapshot()
+        if not sessions:
+            print("No active clients")
+            return
+        
+        screens = self.screenshots.latest_screens()
         print("\n" + "=" * 80)
-        print(f"Clients history. Total: [{len(self.db.clients_data)}] clients.")
+        print(f"Number of active clients: {len(sessions)}")
         print("-" * 80)
         
-        for i, (_, client_data) in enumerate(self.db.clients_data.items(), 1):
+        for client in sessions:
+            uptime = datetime.now() - client.connected_at
+            print(f"{client.number}. {client.mac}\n")
+            print(f"MAC: {client.mac}")
+            print(f"IP: {client.ip}:{client.port}")
+            print(f"Connected at: {client.connected_at.strftime('%Y-%m-%d %H:%M:%S')}")
+            print(f"Time online: {uptime}")
+            if client.mac.replace(':', '_') in screens:
+                screen = screens[client.mac.replace(':', '_')]
+                print(f"Last screen: {screen['file']} ({screen['time']})")
+            print("-" * 80)
+        print("=" * 80)
+    
+    def show_client_history(self) -> None:
+        """Clients history page by page, filtered by status, IP prefix and last time online"""
+        status = input("\nStatus (online/offline, empty - any): ").strip().lower() or None
+        if status not in (None, 'online', 'offline'):
+            print("Invalid status")
+            return
+        ip_prefix = input("IP address prefix (empty - any): ").strip() or None
+        seen_after = self.input_time("Last online after (YYYY-MM-DD[ HH:MM], empty - any): ")
+        seen_before = self.input_time("Last online before (YYYY-MM-DD[ HH:MM], empty - any): ")
+
+        offset = 0
+        while True:
+            total, page = self.db.query_clients(status=status, ip_prefix=ip_prefix, seen_after=seen_after, seen_before=seen_before,
+                                                offset=offset, limit=ControlAPI.PAGE_SIZE)
+            print("\n" + "=" * 80)
+            print(f"Clients history. Total: [{len(self.db.clients_data)}] clients, matching: [{total}].")
+            print("-" * 80)
+            self.print_client_history(page, offset)
+
+            offset += len(page)
+            if not page or offset >= total:
+                break
+            if input(f"\nShown {offset} of {total}. Enter - next page, 0 - exit: ").strip() == '0':
+                break
+
+    def print_client_history(self, page: list, offset: int) -> None:
+        for i, client_data in enumerate(page, offset + 1):
             print(f"{i}. {client_data['mac']}\n")
             print(f"MAC: {client_data['mac']}")
             print(f"IP: {client_data['ip']}:{client_data['port']}")
             print(f"First online: {client_data['first_seen']}")
             print(f"Last online: {client_data['last_seen']}")
             print(f"Status: {client_data.get('status', 'unknown')}")
-            
-            if client_data['connection_history']:
+            print(f"Connections: {client_data['total_connections']}")
+            print(f"Total time online: {timedelta(seconds=round(client_data['total_online_seconds']))}")
+
+            history = self.db.get_history(client_data['mac'])
+            if history['connection_history']:
                 print(f"\nConnections history (last 3):")
-                for conn in client_data['connection_history'][-3:]:
+                for conn in history['connection_history'][-3:]:
                     print(f"\t+Connected at: {conn['connected_at']}")
                     if conn['disconnected_at']:
                         print(f"\t-Disconnected at: {conn['disconnected_at']}")
-                        print(f"\tTime online: {conn['Time_Online']}")
+                        print(f"\tTime online: {timedelta(seconds=conn['Time_Online'])}")
                     else:
                         print(f"\t-Disconnected at: [Online]")
                     print("\t" + "-" * 40)
+
+            if history['connection_rollups']:
+                print(f"\nDaily statistics (last 7 days):")
+                for day, rollup in list(history['connection_rollups'].items())[-7:]:
+                    print(f"\t{day}: {rollup['sessions']} sessions, "
+                          f"online {timedelta(seconds=round(rollup['online_seconds']))}, "
+                          f"IPs: {', '.join(str(ip) for ip in rollup['ips'])}")
             
             print("-" * 80)
 
+    def send_command(self, client: ClientSession, message: str) -> str:
+        """Send command to connected client. Used by menu and control API.
+        
+        ARGS:   client: session of client,
+                message: command to be sent
+        Return: delivery status, for screen request 'queued' or 'already_requested'
+        """
+        # Screen requests share upload slots with requests sent to all clients
+        if message == "SEND_SCREEN":
+            return self.SCREEN_QUEUED if self.uploads.request([client]) else self.SCREEN_REQUESTED
+
+        sending = self.dispatcher.send(client, message.encode('utf-8'))
+        try:
+            return sending.result(timeout=self.send_timeout)
+        except FutureTimeoutError:
+            return CommandDispatcher.TIMED_OUT
+
+    def broadcast_command(self, message: str) -> dict:
+        """Send command to all connected clients at once. Used by menu and control API.
+        
+        ARGS:   message: command to be sent
+        Return: dict MAC -> delivery status, 'queued' for screen requests
+        """
+        sessions = self.clients.snapshot()
+
+        # Screens are requested in waves, not all at once
+        if message == "SEND_SCREEN":
+            self.uploads.request(sessions)
+            return {session.mac: self.SCREEN_QUEUED for session in sessions}
+
+        return self.dispatcher.broadcast(sessions, message.encode('utf-8'), timeout=self.send_timeout)
+
+    def close_client(self, client: ClientSession) -> None:
+        """Close client's connection, disconnection is written by client's handler."""
+        client.socket.close()
+
     def send_to_client(self, client_index: int, message: str) -> None:
         """Send command to particular client.
         
-        ARGS:   client_index: 1...N number of connected client, 
+        ARGS:   client_index: number of connected client shown in clients list, 
                 message: message to be sent
         Return: None
         """
-        with self.clients_lock:
-            if not self.clients:
-                print("No active clients")
-                return
-            if client_index < 1 or client_index > len(self.clients):
-                print(f"\nInvalid client\'s number. Avaliable clients: 1-{len(self.clients)}")
-                return
-            
-            client = self.clients[client_index - 1]
-            
-            try:
-                client['socket'].send(message.encode('utf-8'))
-            except Exception as e:
-                print(f"\nSending Error: {e}")
+        if not len(self.clients):
+            print("No active clients")
+            return
+
+        client = self.clients.by_number(client_index)
+        if client is None:
+            print(f"\nInvalid client\'s number. Choose number from active clients list")
+            return
+
+        status = self.send_command(client, message)
+        if status == self.SCREEN_REQUESTED:
+            print(f"\nScreen of {client.mac} is already requested")
+        elif status not in (CommandDispatcher.DELIVERED, self.SCREEN_QUEUED):
+            print(f"\nSending Error: {client.mac} ({client.ip}:{client.port}) | {status}")
     
     def send_Command_to_client(self, client_index: int, command_option: int) -> None:
         """Wrap between send_to_client and user. Allows to send coorect codes to manipulate client's behaviour.
@@ -435,60 +4016,63 @@ class Server:
                 command_option: Choosed allowed option to send.
         Return: None
         """
-        AskStatistics = "SEND_STAT"
-        AskDeauth = "DEAUTH_REQUEST"
-        AskScreen = "SEND_SCREEN"
-        AskMac = "SEND_MAC"
-
-        if command_option == 0:
-            self.send_to_client(client_index, AskMac)
-        elif command_option == 1:
-            self.send_to_client(client_index, AskStatistics)
-        elif command_option == 2:
-            self.send_to_client(client_index, AskScreen)
-        elif command_option == 3:
-            self.send_to_client(client_index, AskDeauth)
+        if command_option in self.COMMANDS:
+            self.send_to_client(client_index, self.COMMANDS[command_option])
     
-    def send_Command_to_all(self, command_option: int) -> None:
-        """Same wrap as send_command_to_client.
+    def send_Command_to_all(self, command_option: int) -> dict:
+        """Same wrap as send_command_to_client. Command is sent to all clients at once.
         
         ARGS:   command_option: number of command to be sent.
-        Return: None
+        Return: dict MAC -> delivery status, 'queued' for screen requests
         """
-        for client_index, _ in enumerate(self.clients, 1):
-            self.send_Command_to_client(client_index, command_option)
+        if command_option not in self.COMMANDS:
+            return {}
+
+        if not len(self.clients):
+            print("No active clients")
+            return {}
+
+        command = self.COMMANDS[command_option]
+        results = self.broadcast_command(command)
+
+        if command == "SEND_SCREEN":
+            uploads = self.uploads.stats()
+            print(f"\nSEND_SCREEN queued for {len(results)} clients: {uploads['inflight']} uploading, {uploads['pending']} waiting")
+            return results
+
+        statuses = list(results.values())
+        print(f"\n{command} sent to {len(results)} clients: "
+              f"delivered {statuses.count(CommandDispatcher.DELIVERED)}, "
+              f"failed {statuses.count(CommandDispatcher.FAILED)}, "
+              f"timed out {statuses.count(CommandDispatcher.TIMED_OUT)}")
+        for mac, status in results.items():
+            if status != CommandDispatcher.DELIVERED:
+                print(f"\t{mac}: {status}")
+
+        return results
     
     def disconnect_client(self, client_index: int) -> None:
         """Disconnects one client"""
-        with self.clients_lock:
-            if client_index < 1 or client_index > len(self.clients):
-                print(f"\nInvalid client number")
-                return
-            
-            client = self.clients[client_index - 1]
-            try:
-                client['socket'].close()
-                print(f"\n[{datetime.now().strftime('%H:%M:%S')}] Disconnected: {client['mac']} ({client['ip']}:{client['port']})")
-            except Exception as e:
-                print(f"\nError while deauth: {client['mac']} ({client['ip']}:{client['port']}) | {e}")
+        client = self.clients.by_number(client_index)
+        if client is None:
+            print(f"\nInvalid client number")
+            return
+        
+        try:
+            self.close_client(client)
+            print(f"\n[{datetime.now().strftime('%H:%M:%S')}] Disconnected: {client.mac} ({client.ip}:{client.port})")
+        except Exception as e:
+            print(f"\nError while deauth: {client.mac} ({client.ip}:{client.port}) | {e}")
     
     def disconnect_all_clients(self) -> None:
         """Disconnects all online clients"""
-        for i, _ in enumerate(self.clients, 1):
-            self.disconnect_client(i)
+        for client in self.clients.snapshot():
+            self.disconnect_client(client.number)
     
     def start_server(self) -> None:
-        self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        
         try:
-            self.server_socket.bind((self.HOST, self.PORT))
-            self.server_socket.listen(5)
-            
-            print("=" * 60)
-            print(f"Server started at {self.HOST}:{self.PORT}")
-            print(f"Starting time: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
-            print("=" * 60)
+            self.server_socket = self.create_server_socket()
+            self.announce_start()
             
             def accept_clients():
                 while self.server_running:
@@ -521,21 +4105,771 @@ class Server:
         finally:
             self.server_running = False
             
-            with self.clients_lock:
-                for client in self.clients[:]:
-                    try:
-                        client['socket'].close()
-                    except:
-                        pass
+            for client in self.clients.snapshot():
+                try:
+                    client.socket.close()
+                except:
+                    pass
             
+            # Give handlers time to write disconnection to database
+            deadline = time.monotonic() + 2.0
+            while len(self.clients) and time.monotonic() < deadline:
+                time.sleep(0.05)
+
             if self.server_socket:
                 self.server_socket.close()
             
-            print("\n" + "=" * 60)
-            print("Server completely stopped")
-            print("=" * 60)
+            self.close_storages()
+            self.announce_stop()
+
+
+class AsyncSocket:
+    """Thread-safe socket-like wrapper of asyncio StreamWriter.
+    Lets menu functions use socket's send/close for clients served by AsyncServer."""
+    MAX_BUFFERED = 1 << 20     # Unsent bytes when client is considered not reading
+
+    def __init__(self, loop: asyncio.AbstractEventLoop, writer: asyncio.StreamWriter):
+        self.loop = loop
+        self.writer = writer
+
+    def send(self, data: bytes) -> int:
+        if self.writer.is_closing():
+            raise ConnectionResetError("Connection is closed")
+        if self.writer.transport.get_write_buffer_size() > self.MAX_BUFFERED:
+            raise socket.timeout("Client doesn't read sent data")
+        self.loop.call_soon_threadsafe(self.writer.write, data)
+        return len(data)
+
+    sendall = send
+
+    def close(self) -> None:
+        self.loop.call_soon_threadsafe(self.writer.close)
+
+
+class AsyncServer(Server):
+    """Server realisation with one asyncio event loop for all clients instead of thread per client.
+    Event loop runs in background thread, control menu stays in main thread."""
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.BACKLOG = kwargs.get('backlog') or 1024
+        self.CLOSE_TIMEOUT = 5.0
+        self.loop = None
+        self.stop_event = None
+        self.connections = set()
+
+    async def handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        """Coroutine with the same protocol as Server.handle_client.
+        
+        ARGS:   reader: stream of data from client,
+                writer: stream of data to client
+        Return: None
+        """
+        client_ip, client_port = writer.get_extra_info('peername')[:2]
+        client_mac = None
+        client_socket = AsyncSocket(self.loop, writer)
+        task = asyncio.current_task()
+        self.connections.add(task)
+        task.add_done_callback(self.connections.discard)
+
+        handshake = Handshake()
+
+        try:
+            mac_message = "SEND_MAC"
+            writer.write(mac_message.encode('utf-8'))
+
+            async def receive_mac():
+                while not handshake.feed(await reader.read(4096)):
+                    pass
+
+            await asyncio.wait_for(receive_mac(), self.HANDSHAKE_TIMEOUT)
+            client_mac = handshake.mac
+            if handshake.version == 2:
+                writer.write(handshake.reply())
+        except Exception as e:
+            print(f"\nEncountered [{client_mac}]: [{e}]\n")
+            await self.close_writer(writer)
+            return
+
+        # Database and files are blocking, so they are used from executor's threads
+        session = await self.loop.run_in_executor(None, self.register_client, client_socket, client_ip, client_port, client_mac,
+                                                  handshake.version, handshake.codec)
+        if session is None:
+            # Connection that wasn't registered got DEAUTH_REQUEST, it's sent before transport is closed
+            await self.close_writer(writer)
+            return
+
+        frame_reader = session.reader = self.new_frame_reader(session.protocol)
+        bucket = TokenBucket(self.client_rate)
+
+        try:
+            for frame in frame_reader.feed(handshake.rest):
+                await self.loop.run_in_executor(None, self.handle_frame, session, frame)
+
+            while True:
+                data = await reader.read(frame_reader.recv_size)
+                RECV_CALLS.inc()
+                if not data:
+                    break
+
+                for frame in frame_reader.feed(data):
+                    await self.loop.run_in_executor(None, self.handle_frame, session, frame)
+
+                # Not reading the stream makes transport pause reading from socket
+                pause = bucket.consume(len(data))
+                if pause:
+                    await asyncio.sleep(pause)
+
+        except ConnectionResetError:
+            print("\nClient Disconnected!")
+        except Exception as e:
+            print(f"\n[{datetime.now().strftime('%H:%M:%S')}] Error with: {client_mac} ({client_ip}:{client_port}): {e}")
+
+        finally:
+            frame_reader.close()
+            await self.loop.run_in_executor(None, self.unregister_client, session)
+            await self.close_writer(writer)
+
+    async def close_writer(self, writer: asyncio.StreamWriter) -> None:
+        """Close client's stream and wait until its socket is closed.
+        Transport of client that doesn't read what is left to send is aborted."""
+        writer.close()
+        try:
+            await asyncio.wait_for(writer.wait_closed(), self.CLOSE_TIMEOUT)
+        except asyncio.TimeoutError:
+            writer.transport.abort()
+        except (ConnectionError, OSError):
+            pass
+
+    async def serve(self, started: threading.Event) -> None:
+        """Accept clients until stop_event is set."""
+        self.stop_event = asyncio.Event()
+
+        try:
+            self.server_socket = await asyncio.start_server(self.handle_connection, sock=self.create_server_socket(), backlog=self.BACKLOG)
+        except OSError as e:
+            print(f"\nServer Error: {e}")
+            self.server_running = False
+            started.set()
+            return
+
+        self.announce_start(" (asyncio)")
+        started.set()
+
+        await self.stop_event.wait()
+
+        self.server_socket.close()
+        for client in self.clients.snapshot():
+            client.socket.writer.close()
+
+        # Let handlers write disconnection to database
+        if self.connections:
+            await asyncio.wait(list(self.connections), timeout=5.0)
+        await self.server_socket.wait_closed()
+
+    def start_server(self) -> None:
+        self.loop = asyncio.new_event_loop()
+        started = threading.Event()
+
+        loop_thread = threading.Thread(
+            target=self.loop.run_until_complete,
+            args=(self.serve(started),),
+            daemon=True,
+            name="AsyncServer"
+        )
+        loop_thread.start()
+        started.wait()
+
+        try:
+            if self.server_running:
+                self.menu_loop()
+        except Exception as e:
+            print(f"\nCritical Server Error: {e}")
+        finally:
+            self.server_running = False
+
+            if self.stop_event is not None:
+                self.loop.call_soon_threadsafe(self.stop_event.set)
+            loop_thread.join(timeout=5.0)
+            self.close_storages()
+            self.announce_stop()
+
+
+class ShardChannel:
+    """Messages between supervisor and worker process over multiprocessing pipe.
+
+    call() sends request and waits for its reply, notify() doesn't wait. Requests of the
+    other side are passed to handler(method, args) by a pool of handler_threads threads,
+    with one thread they are handled in the order they were sent.
+    """
+    def __init__(self, connection, handler, handler_threads: int = 1, on_close=None):
+        self.connection = connection
+        self.handler = handler
+        self.on_close = on_close        # Called when other side has gone
+        self.pool = ThreadPoolExecutor(max_workers=handler_threads, thread_name_prefix="ShardHandler")
+        self.send_lock = threading.Lock()
+        self.replies = {}               # Request ID -> Future waiting for reply
+        self.replies_lock = threading.Lock()
+        self.next_id = 0
+        self.closed = False
+        self.reader = threading.Thread(target=self.reader_loop, daemon=True, name="ShardChannel")
+        self.reader.start()
+
+    def call(self, method: str, *args, timeout: float = None):
+        """Run method on the other side.
+        
+        ARGS:   method: name of request,
+                args: its arguments (picklable),
+                timeout: seconds to wait for reply
+        Return: handler's result, RuntimeError if handler failed
+        """
+        future = Future()
+        with self.replies_lock:
+            self.next_id += 1
+            request_id = self.next_id
+            self.replies[request_id] = future
+
+        try:
+            self.send(('call', request_id, method, args))
+            return future.result(timeout=timeout)
+        finally:
+            with self.replies_lock:
+                self.replies.pop(request_id, None)
+
+    def notify(self, method: str, *args) -> None:
+        """Pass request to the other side without waiting for it."""
+        self.send(('notify', None, method, args))
+
+    def send(self, message: tuple) -> None:
+        with self.send_lock:
+            if self.closed:
+                raise ConnectionResetError("Shard channel is closed")
+            self.connection.send(message)
+
+    def reader_loop(self) -> None:
+        while True:
+            try:
+                kind, request_id, first, second = self.connection.recv()
+            except (EOFError, OSError):
+                break
+
+            if kind == 'reply':
+                with self.replies_lock:
+                    future = self.replies.get(request_id)
+                if future is not None:
+                    # Reply is ('reply', request_id, error, result)
+                    if first is None:
+                        future.set_result(second)
+                    else:
+                        future.set_exception(RuntimeError(first))
+            else:
+                self.pool.submit(self.serve, kind, request_id, first, second)
+
+        with self.send_lock:
+            self.closed = True
+        with self.replies_lock:
+            for future in self.replies.values():
+                if not future.done():
+                    future.set_exception(ConnectionResetError("Shard channel is closed"))
+        if self.on_close is not None:
+            try:
+                # After requests already received from the other side
+                self.pool.submit(self.on_close)
+            except RuntimeError:
+                # Channel was closed by this side
+                pass
+
+    def serve(self, kind: str, request_id: int, method: str, args: tuple) -> None:
+        try:
+            result, error = self.handler(method, args), None
+        except Exception as e:
+            result, error = None, f"{type(e).__name__}: {e}"
+
+        if kind == 'call':
+            try:
+                self.send(('reply', request_id, error, result))
+            except (ConnectionResetError, OSError):
+                pass
+        elif error is not None:
+            print(f"\nError in shard request {method}: {error}")
+
+    def close(self) -> None:
+        with self.send_lock:
+            if not self.closed:
+                self.closed = True
+                self.connection.close()
+        self.pool.shutdown(wait=False)
+
+
+class ShardSocket:
+    """Socket of client connected to worker process, used by supervisor's session.
+    Data is sent by the worker and close() disconnects client in the worker."""
+    def __init__(self, channel: ShardChannel, client_mac: str, timeout: float = 2.0):
+        self.channel = channel
+        self.mac = client_mac
+        self.timeout = timeout
+
+    def send(self, data: bytes) -> int:
+        try:
+            status = self.channel.call('send', self.mac, bytes(data), timeout=self.timeout + 1.0)
+        except FutureTimeoutError:
+            status = CommandDispatcher.TIMED_OUT
+
+        if status == CommandDispatcher.TIMED_OUT:
+            raise socket.timeout(f"Sending to {self.mac} timed out")
+        if status != CommandDispatcher.DELIVERED:
+            raise ConnectionResetError(f"Sending to {self.mac} failed")
+        return len(data)
+
+    sendall = send
+
+    def close(self) -> None:
+        self.channel.notify('disconnect', self.mac)
+
+
+class ShardWorker:
+    """Worker process of ShardSupervisor, mixed into Server or AsyncServer.
+
+    Worker accepts clients on the port shared with other workers (SO_REUSEPORT), receives
+    their frames and writes process lists, screens and logs itself. Client database and
+    registry of all clients belong to supervisor: worker registers clients through the
+    channel and sends commands supervisor asks for. Worker has no menu, it serves clients
+    until supervisor stops it.
+    """
+    def __init__(self, connection, **kwargs):
+        super().__init__(**kwargs)
+        self.reuse_port = True
+        self.shutdown = threading.Event()
+        self.channel = ShardChannel(
+            connection, self.handle_supervisor_request,
+            handler_threads=kwargs.get('send_workers', 32),
+            on_close=self.shutdown.set
+        )
+
+    def open_database(self, history_limit: int) -> ClientDatabase:
+        # Database is written by supervisor only
+        return None
+
+    def open_screenshots(self, **kwargs) -> ScreenshotStore:
+        # Supervisor keeps index of latest screens and previews in memory, worker sends every new preview
+        return super().open_screenshots(
+            preview_index=False, preview_cache_size=0,
+            on_preview=lambda client_id, entry, png: self.channel.notify('preview', client_id, entry, png),
+            **kwargs
+        )
+
+    def announce_start(self, mode: str = "") -> None:
+        self.channel.notify('started')
+
+    def announce_stop(self) -> None:
+        pass
+
+    def menu_loop(self) -> None:
+        try:
+            self.shutdown.wait()
+        except KeyboardInterrupt:
+            pass
+        self.server_running = False
+
+    def register_client(self, client_socket, client_ip: str, client_port: int, client_mac: str,
+                        protocol: int = 1, codec: str = None) -> ClientSession:
+        try:
+            accepted, online_before = self.channel.call('register', client_mac, client_ip, client_port, timeout=10.0)
+        except (ConnectionResetError, RuntimeError, FutureTimeoutError) as e:
+            print(f"\n[{datetime.now().strftime('%H:%M:%S')}] Can't register {client_mac} ({client_ip}:{client_port}): {e}")
+            accepted = online_before = False
+
+        session = ClientSession(client_socket, client_ip, client_port, client_mac, online_before, protocol, codec)
+        if not accepted:
+            deauth_message = "DEAUTH_REQUEST"
+            client_socket.send(session.frame(deauth_message.encode('utf-8')))
+            return None
+
+        # Session of other worker is closed by supervisor, session of this worker is closed here
+        replaced = self.clients.register(session)
+        if replaced is not None:
+            self.close_client(replaced)
+        return session
+
+    def unregister_client(self, session: ClientSession) -> None:
+        if not self.clients.unregister(session):
+            # Replaced by new connection to this worker, supervisor knows the new one
+            return
+        self.processes.forget(session.mac)
+        try:
+            self.channel.notify('unregister', session.mac, session.ip, session.port)
+        except ConnectionResetError:
+            pass
+
+    def handle_frame(self, session: ClientSession, frame: Frame) -> None:
+        super().handle_frame(session, frame)
+        if frame.command == "ScreenShot BMP":
+            self.channel.notify('screen_received', session.mac)
+
+    def handle_supervisor_request(self, method: str, args: tuple):
+        """Run request sent by supervisor."""
+        if method == 'send':
+            client_mac, data = args
+            session = self.clients.get(client_mac)
+            if session is None:
+                return CommandDispatcher.FAILED
+            try:
+                return self.dispatcher.send(session, data).result(timeout=self.send_timeout)
+            except FutureTimeoutError:
+                return CommandDispatcher.TIMED_OUT
+
+        if method == 'disconnect':
+            session = self.clients.get(args[0])
+            if session is not None:
+                session.socket.close()
+            return None
+
+        if method == 'stats':
+            return {'clients': len(self.clients), 'io': self.io.metrics(), 'budget': self.budget.metrics()}
+
+        if method == 'metrics':
+            return METRICS.collect()
+
+        if method == 'profiler':
+            action = args[0]
+            if action == 'stacks':
+                return self.profile_stacks()
+            if action == 'reset':
+                self.reset_profile()
+            else:
+                self.set_profiling(action == 'start')
+            return None
+
+        if method == 'stop':
+            self.shutdown.set()
+            return None
+
+        raise ValueError(f"Unknown request {method}")
+
+
+class ThreadedShardWorker(ShardWorker, Server):
+    pass
+
+
+class AsyncShardWorker(ShardWorker, AsyncServer):
+    pass
+
+
+def run_shard_worker(connection, worker_mode: str, kwargs: dict) -> None:
+    """Entry point of worker process."""
+    # Ctrl+C is handled by supervisor, it stops workers itself
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    worker_class = AsyncShardWorker if worker_mode == 'asyncio' else ThreadedShardWorker
+    worker_class(connection, **kwargs).start_server()
+
+
+class ShardSupervisor(Server):
+    """Runs worker processes sharing server's port and serves control menu.
+
+    Every worker owns connections accepted by it, so frames are parsed and stored by
+    as many processes as there are workers. Supervisor owns client database and registry
+    of clients of all workers: session of a client has ShardSocket which forwards commands
+    to client's worker, so menu, broadcast, upload waves and periodic collection work the
+    same as with one process. Upload cap is global, memory budget is split between workers.
+    """
+    def __init__(self, workers: int = 2, worker_mode: str = 'threads', **kwargs):
+        super().__init__(**kwargs)
+        self.worker_mode = worker_mode
+        self.worker_kwargs = dict(kwargs, memory_budget=kwargs.get('memory_budget', 256 * 1024 * 1024) // workers)
+        # Supervisor asks for screens and stats and serves menu and HTTP endpoint, workers only answer
+        for name in ('stat_interval', 'screen_interval', 'schedule_groups', 'http_port', 'headless'):
+            self.worker_kwargs.pop(name, None)
+        self.shards = [None] * workers  # (process, channel)
+        self.started = threading.Semaphore(0)     # Released by every started or stopped worker
+        self.started_workers = 0
+
+    def start_server(self) -> None:
+        context = multiprocessing.get_context('spawn')
+
+        try:
+            for index in range(len(self.shards)):
+                connection, worker_connection = context.Pipe()
+                process = context.Process(
+                    target=run_shard_worker,
+                    args=(worker_connection, self.worker_mode, self.worker_kwargs),
+                    daemon=True,
+                    name=f"ShardWorker-{index + 1}"
+                )
+                process.start()
+                worker_connection.close()
+
+                channel = ShardChannel(
+                    connection,
+                    lambda method, args, index=index: self.handle_worker_request(index, method, args),
+                    on_close=lambda index=index: self.worker_stopped(index)
+                )
+                self.shards[index] = (process, channel)
+
+            # Worker notifies 'started' when it listens, stopped worker releases it too
+            for _ in self.shards:
+                self.started.acquire(timeout=30.0)
+
+            if not self.started_workers:
+                print("\nServer Error: no worker started")
+                return
+
+            self.announce_start(f" ({self.started_workers} worker processes, {self.worker_mode})")
+            self.menu_loop()
+
+        except Exception as e:
+            print(f"\nCritical Server Error: {e}")
+        finally:
+            self.server_running = False
+
+            for shard in self.shards:
+                if shard is not None:
+                    try:
+                        shard[1].notify('stop')
+                    except ConnectionResetError:
+                        pass
+
+            # Workers write disconnections of their clients before they exit
+            for shard in self.shards:
+                if shard is not None:
+                    shard[0].join(timeout=10.0)
+                    if shard[0].is_alive():
+                        shard[0].terminate()
+                    shard[1].close()
+
+            self.close_storages()
+            self.announce_stop()
+
+    def handle_worker_request(self, index: int, method: str, args: tuple):
+        """Run request sent by worker. Requests of one worker are handled in order."""
+        channel = self.shards[index][1]
+
+        if method == 'register':
+            client_mac, client_ip, client_port = args
+            self.db.create_client(client_mac)
+            client_db_data = self.db.get_client_info(client_mac)
+            session = ClientSession(ShardSocket(channel, client_mac, self.send_timeout), client_ip, client_port,
+                                    client_mac, client_db_data['total_connections'] > 1)
+
+            with self.db.lock:
+                replaced = self.clients.register(session)
+                if replaced is not None:
+                    self.db.update_client_connection(client_mac, replaced.ip, replaced.port, 'disconnected')
+                self.db.update_client_connection(client_mac, client_ip, client_port, 'connected')
+            if replaced is not None:
+                self.uploads.forget(replaced)
+                # Worker of new connection closes replaced session itself
+                if replaced.socket.channel is not channel:
+                    replaced.socket.close()
+                print(f"\n[{datetime.now().strftime('%H:%M:%S')}] Connection replaced by new one: {client_mac} ({replaced.ip}:{replaced.port})")
+            self.collector.add(session)
+            print(f"\n[{datetime.now().strftime('%H:%M:%S')}] Connected: {client_mac} ({client_ip}:{client_port}) [worker {index + 1}]")
+            return True, session.online_before
+
+        if method == 'unregister':
+            # Session may already be replaced by new connection to the same worker
+            client_mac, client_ip, client_port = args
+            session = self.clients.get(client_mac)
+            if session is not None and session.socket.channel is channel and (session.ip, session.port) == (client_ip, client_port):
+                self.unregister_shard_session(session)
+            return None
+
+        if method == 'screen_received':
+            session = self.clients.get(args[0])
+            if session is not None:
+                self.uploads.finished(session)
+            return None
+
+        if method == 'started':
+            self.started_workers += 1
+            self.started.release()
+            return None
+
+        if method == 'preview':
+            self.screenshots.add_preview(*args)
+            return None
+
+        raise ValueError(f"Unknown request {method}")
+
+    def unregister_shard_session(self, session: ClientSession) -> None:
+        """Client of worker disconnected. Its processes are closed by the worker."""
+        with self.db.lock:
+            if not self.clients.unregister(session):
+                return
+            self.db.update_client_connection(session.mac, session.ip, session.port, 'disconnected')
+        self.uploads.forget(session)
+
+        print(f"\n[{datetime.now().strftime('%H:%M:%S')}] Disconnected: {session.mac} ({session.ip}:{session.port})")
+
+    def worker_stopped(self, index: int) -> None:
+        """Worker's process has gone: its clients are disconnected."""
+        channel = self.shards[index][1]
+        for session in self.clients.snapshot():
+            if session.socket.channel is channel:
+                self.unregister_shard_session(session)
+
+        if self.server_running:
+            print(f"\n[{datetime.now().strftime('%H:%M:%S')}] Worker {index + 1} stopped")
+            self.started.release()
+
+    def show_io_statistics(self) -> None:
+        """Counters of every worker and upload waves"""
+        print("\n" + "=" * 60)
+        for index, (process, channel) in enumerate(self.shards):
+            try:
+                stats = channel.call('stats', timeout=2.0)
+            except Exception as e:
+                print(f"Worker {index + 1}: unavailable ({e})")
+                continue
+            print(f"Worker {index + 1} (pid {process.pid}), clients: {stats['clients']}")
+            self.print_io_metrics(stats['io'], stats['budget'])
+            print("-" * 60)
+        self.print_upload_statistics()
+        print("=" * 60)
+
+    def call_workers(self, method: str, *args) -> list:
+        """Call method on every running worker.
+        
+        ARGS:   method: name of worker's request,
+                args: its arguments
+        Return: [(worker number, result), ...] of workers that answered
+        """
+        results = []
+        for index, shard in enumerate(self.shards):
+            if shard is None:
+                continue
+            try:
+                results.append((index + 1, shard[1].call(method, *args, timeout=2.0)))
+            except (ConnectionResetError, RuntimeError, FutureTimeoutError):
+                pass
+        return results
+
+    def collect_metrics(self) -> list:
+        """Metrics of supervisor and workers, samples are labelled with shard."""
+        families = OrderedDict()
+        parts = [('supervisor', METRICS.collect())] + [(str(number), collected) for number, collected in self.call_workers('metrics')]
+        for shard, collected in parts:
+            for name, kind, documentation, samples in collected:
+                family = families.setdefault(name, (name, kind, documentation, []))
+                family[3].extend((sample_name, dict(labels, shard=shard), value) for sample_name, labels, value in samples)
+        return list(families.values())
+
+    def set_profiling(self, enabled: bool) -> None:
+        super().set_profiling(enabled)
+        self.call_workers('profiler', 'start' if enabled else 'stop')
+
+    def profile_stacks(self) -> dict:
+        """Samples of supervisor and workers, stacks start with process name."""
+        stacks = {f"supervisor;{stack}": count for stack, count in super().profile_stacks().items()}
+        for number, worker_stacks in self.call_workers('profiler', 'stacks'):
+            stacks.update((f"worker-{number};{stack}", count) for stack, count in worker_stacks.items())
+        return stacks
+
+    def reset_profile(self) -> None:
+        super().reset_profile()
+        self.call_workers('profiler', 'reset')
 
 
 if __name__ == "__main__":
-    server = Server()
+    parser = argparse.ArgumentParser(description="Server for collecting process statistics and screenshots from clients")
+    parser.add_argument('--mode', choices=['threads', 'asyncio'], default='threads',
+                        help="threads: thread per client, asyncio: one event loop for all clients")
+    parser.add_argument('--host', default='127.0.0.1',
+                        help="address to listen on")
+    parser.add_argument('--port', type=int, default=8888,
+                        help="port to listen on")
+    parser.add_argument('--backlog', type=int, default=None,
+                        help="length of queue of not accepted connections (default 5 for threads, 1024 for asyncio)")
+    parser.add_argument('--workers', type=int, default=1,
+                        help="number of worker processes sharing the port with SO_REUSEPORT (Linux)")
+    parser.add_argument('--history-limit', type=int, default=50,
+                        help="number of last connections kept in each client's history")
+    parser.add_argument('--screen-format', choices=['png', 'bmp', 'delta'], default='png',
+                        help="format of stored screenshots, delta: keyframes and changed tiles")
+    parser.add_argument('--keep-bmp', action='store_true',
+                        help="store original BMP next to compressed screenshot")
+    parser.add_argument('--no-dedup', action='store_true',
+                        help="store screenshot even if it is the same as previous one")
+    parser.add_argument('--io-writers', type=int, default=2,
+                        help="number of threads writing logs and screenshots")
+    parser.add_argument('--io-queue', type=int, default=1024,
+                        help="maximum number of queued file writes")
+    parser.add_argument('--io-full-policy', choices=WriteBehindExecutor.FULL_POLICIES, default='block',
+                        help="what to do with write when I/O queue is full")
+    parser.add_argument('--text-logs', action='store_true',
+                        help="also write process changes to logs/<MAC>.txt")
+    parser.add_argument('--send-workers', type=int, default=32,
+                        help="number of threads sending commands to clients")
+    parser.add_argument('--send-timeout', type=float, default=2.0,
+                        help="seconds to wait for command delivery")
+    parser.add_argument('--max-uploads', type=int, default=16,
+                        help="maximum number of clients uploading screen at the same time, 0 - unlimited")
+    parser.add_argument('--upload-timeout', type=float, default=60.0,
+                        help="seconds to wait for requested screen before asking next client")
+    parser.add_argument('--memory-budget', type=int, default=256,
+                        help="MB of received payloads kept in memory, larger payloads are received to disk, 0 - unlimited")
+    parser.add_argument('--client-rate', type=int, default=0,
+                        help="KB/s received from one client, 0 - unlimited")
+    parser.add_argument('--max-screen-size', type=int, default=128,
+                        help="maximum size of screenshot in MB, client sending larger one is disconnected")
+    parser.add_argument('--max-json-size', type=int, default=16,
+                        help="maximum size of process list in MB, client sending larger one is disconnected")
+    parser.add_argument('--payload-sink', choices=['file', 'memory'], default='file',
+                        help="file: receive screens straight into preallocated files, memory: into memory within budget")
+    parser.add_argument('--stat-interval', type=float, default=0.0,
+                        help="ask every client for process list every SEC seconds, 0 - only from menu")
+    parser.add_argument('--screen-interval', type=float, default=0.0,
+                        help="ask every client for screen every MIN minutes, 0 - only from menu")
+    parser.add_argument('--schedule-groups', default=None,
+                        help="JSON file with groups of clients that have their own intervals, "
+                             "stat_interval in seconds and screen_interval in minutes as options above")
+    parser.add_argument('--http-port', type=int, default=0,
+                        help="port of local HTTP endpoint with Prometheus metrics, profile and control API, 0 - disabled")
+    parser.add_argument('--preview-width', type=int, default=320,
+                        help="maximum width of screen previews for overview, 0 - no previews")
+    parser.add_argument('--headless', action='store_true',
+                        help="run without menu, e.g. as a service, control server through HTTP API")
+    args = parser.parse_args()
+
+    schedule_groups = CollectionScheduler.load_groups(args.schedule_groups) if args.schedule_groups else None
+
+    options = dict(
+        history_limit=max(1, args.history_limit),
+        screen_format=args.screen_format,
+        keep_bmp=args.keep_bmp,
+        dedup_screens=not args.no_dedup,
+        io_writers=max(1, args.io_writers),
+        io_queue=args.io_queue,
+        io_full_policy=args.io_full_policy,
+        text_logs=args.text_logs,
+        send_workers=max(1, args.send_workers),
+        send_timeout=args.send_timeout,
+        max_uploads=max(0, args.max_uploads),
+        upload_timeout=args.upload_timeout,
+        memory_budget=max(0, args.memory_budget) * 1024 * 1024,
+        client_rate=max(0, args.client_rate) * 1024,
+        max_screen_size=max(0, args.max_screen_size) * 1024 * 1024,
+        max_json_size=max(0, args.max_json_size) * 1024 * 1024,
+        payload_sink=args.payload_sink,
+        stat_interval=max(0.0, args.stat_interval),
+        screen_interval=max(0.0, args.screen_interval) * 60,
+        schedule_groups=schedule_groups,
+        host=args.host,
+        port=args.port,
+        backlog=args.backlog,
+        http_port=max(0, args.http_port),
+        headless=args.headless,
+        preview_width=max(0, args.preview_width)
+    )
+
+    if args.workers > 1 and not hasattr(socket, 'SO_REUSEPORT'):
+        print("Worker processes need SO_REUSEPORT, starting one process")
+        args.workers = 1
+
+    if args.workers > 1:
+        server = ShardSupervisor(workers=args.workers, worker_mode=args.mode, **options)
+    else:
+        server_class = AsyncServer if args.mode == 'asyncio' else Server
+        server = server_class(**options)
+
+    # SIGTERM of service manager stops server the same way as Ctrl+C
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
     server.start_server()
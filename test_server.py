@@ -0,0 +1,1238 @@
+"""Tests of server's components: run with python -m pytest or python -m unittest."""
+import os
+import random
+import socket
+import struct
+import json
+import sqlite3
+import tempfile
+import threading
+import time
+import unittest
+import urllib.error
+import urllib.request
+import zlib
+
+from datetime import datetime, timedelta
+from unittest import mock
+
+import server
+from server import (
+    FRAME_CODEC_IDS, FRAME_TYPE_IDS, FRAME_V2, FRAME_V2_MAGIC, SUPPORTED_CODECS,
+    ClientDatabase, ClientRegistry, ClientSession, CollectionScheduler, CommandDispatcher, FileSink, FrameReader, FrameReaderV2, Handshake, LocalHTTPServer,
+    MemoryBudget, ProcessStore, ProtocolError, ScreenshotStore, Server, UploadScheduler, WriteBehindExecutor, bmp_preview, encode_frame, parse_timedelta,
+)
+
+
+def frame(command: str, payload: bytes) -> bytes:
+    """Protocol v1 frame as sent by client."""
+    return f"{command}, {len(payload)}\n".encode('utf-8') + payload
+
+
+def feed_all(reader: FrameReader, chunks) -> list:
+    frames = []
+    for chunk in chunks:
+        frames.extend(reader.feed(chunk))
+    return frames
+
+
+def split(data: bytes, size: int) -> list:
+    return [data[i:i + size] for i in range(0, len(data), size)]
+
+
+def make_bmp(width: int, height: int, rgb: bytes, bits: int = 24, top_down: bool = False) -> bytes:
+    """BMP file of top-down RGB rows."""
+    channels = bits // 8
+    row_size = ((width * bits + 31) // 32) * 4
+    rows = []
+    for row in range(height):
+        line = bytearray(row_size)
+        pixels = rgb[row * width * 3:(row + 1) * width * 3]
+        line[0:width * channels:channels] = pixels[2::3]
+        line[1:width * channels:channels] = pixels[1::3]
+        line[2:width * channels:channels] = pixels[0::3]
+        rows.append(bytes(line))
+    if not top_down:
+        rows.reverse()
+    pixels = b''.join(rows)
+    header = struct.pack('<2sIHHI', b'BM', 54 + len(pixels), 0, 0, 54)
+    info = struct.pack('<IiiHHIIiiII', 40, width, -height if top_down else height, 1, bits, 0, len(pixels), 0, 0, 0, 0)
+    return header + info + pixels
+
+
+class FrameReaderFeedTest(unittest.TestCase):
+    STREAM = frame("ProcessJSON", b'{"name": "a.exe"}') + frame("ScreenShot BMP", bytes(range(256)) * 40)
+
+    def assert_frames(self, frames: list) -> None:
+        self.assertEqual([f.command for f in frames], ["ProcessJSON", "ScreenShot BMP"])
+        self.assertEqual(bytes(frames[0].payload), b'{"name": "a.exe"}')
+        self.assertEqual(bytes(frames[1].payload), bytes(range(256)) * 40)
+
+    def test_byte_by_byte(self):
+        reader = FrameReader(buffer_size=64)
+        self.assert_frames(feed_all(reader, split(self.STREAM, 1)))
+        self.assertEqual(reader.received_bytes, len(self.STREAM))
+        self.assertFalse(reader.receiving_payload())
+
+    def test_coalesced_frames(self):
+        reader = FrameReader()
+        stream = self.STREAM * 3
+        frames = reader.feed(stream)
+        self.assertEqual(len(frames), 6)
+        self.assert_frames(frames[:2])
+        self.assert_frames(frames[4:])
+
+    def test_header_split_from_payload(self):
+        reader = FrameReader()
+        header, payload = frame("ProcessJSON", b'[1, 2, 3]').split(b'\n')
+        self.assertEqual(reader.feed(header[:5]), [])
+        self.assertEqual(reader.feed(header[5:] + b'\n'), [])
+        self.assertTrue(reader.receiving_payload())
+        frames = reader.feed(payload)
+        self.assertEqual(bytes(frames[0].payload), b'[1, 2, 3]')
+
+    def test_payload_and_next_header_in_one_chunk(self):
+        reader = FrameReader()
+        first, second = frame("ProcessJSON", b'{}'), frame("ProcessJSON", b'[]')
+        self.assertEqual(reader.feed(first[:-1]), [])
+        frames = reader.feed(first[-1:] + second[:4])
+        self.assertEqual([bytes(f.payload) for f in frames], [b'{}'])
+        frames = reader.feed(second[4:])
+        self.assertEqual([bytes(f.payload) for f in frames], [b'[]'])
+
+    def test_zero_size_frames(self):
+        reader = FrameReader()
+        frames = reader.feed(frame("ProcessJSON", b'') + frame("ScreenShot BMP", b'') + frame("ProcessJSON", b'{}'))
+        self.assertEqual([(f.command, bytes(f.payload)) for f in frames],
+                         [("ProcessJSON", b''), ("ScreenShot BMP", b''), ("ProcessJSON", b'{}')])
+        self.assertFalse(reader.receiving_payload())
+
+    def test_unknown_header(self):
+        # Unknown command is a line without payload, stream goes on after it
+        reader = FrameReader()
+        frames = feed_all(reader, split(b"PING\nMAC_ADDRESS, 17\n" + frame("ProcessJSON", b'{}'), 3))
+        self.assertEqual([f.command for f in frames], ["PING", "MAC_ADDRESS", "ProcessJSON"])
+        self.assertIsNone(frames[0].payload)
+        self.assertEqual(bytes(frames[2].payload), b'{}')
+
+    def test_oversized_header(self):
+        reader = FrameReader(max_header_size=32)
+        with self.assertRaises(ProtocolError):
+            feed_all(reader, split(b"x" * 100, 7))
+
+    def test_header_filling_buffer(self):
+        reader = FrameReader(buffer_size=16, max_header_size=256)
+        with self.assertRaises(ProtocolError):
+            reader.feed(b"ProcessJSON, 1234567890")
+
+    def test_invalid_size(self):
+        for header in (b"ProcessJSON\n", b"ProcessJSON, abc\n", b"ProcessJSON, -1\n"):
+            with self.assertRaises(ProtocolError):
+                FrameReader().feed(header)
+
+    def test_size_limit(self):
+        reader = FrameReader(max_sizes={"ProcessJSON": 10})
+        self.assertEqual(len(reader.feed(frame("ProcessJSON", b'x' * 10))), 1)
+        with self.assertRaises(ProtocolError):
+            reader.feed(b"ProcessJSON, 11\n")
+
+
+class FrameReaderSocketTest(unittest.TestCase):
+    def setUp(self):
+        self.server_side, self.client_side = socket.socketpair()
+        self.server_side.settimeout(5)
+
+    def tearDown(self):
+        self.server_side.close()
+        self.client_side.close()
+
+    def receive(self, reader: FrameReader, count: int) -> list:
+        frames = []
+        while len(frames) < count:
+            received = reader.recv_from(self.server_side)
+            self.assertIsNotNone(received)
+            frames.extend(received)
+        return frames
+
+    def test_byte_by_byte(self):
+        reader = FrameReader(buffer_size=64)
+        stream = frame("ProcessJSON", b'{"a": 1}') + frame("ProcessJSON", b'') + b"PING\n"
+        frames = []
+        for byte in split(stream, 1):
+            self.client_side.sendall(byte)
+            frames.extend(reader.recv_from(self.server_side))
+        self.assertEqual([(f.command, f.payload and bytes(f.payload)) for f in frames],
+                         [("ProcessJSON", b'{"a": 1}'), ("ProcessJSON", b''), ("PING", None)])
+
+    def test_coalesced_frames(self):
+        reader = FrameReader()
+        payloads = [bytes([i]) * (i * 100) for i in range(1, 6)]
+        self.client_side.sendall(b''.join(frame("ProcessJSON", payload) for payload in payloads))
+        frames = self.receive(reader, len(payloads))
+        self.assertEqual([bytes(f.payload) for f in frames], payloads)
+
+    def test_payload_received_into_sink(self):
+        # Once header is parsed and nothing is buffered, payload goes straight into sink in recv_size reads
+        reader = FrameReader(recv_size=1000)
+        payload = bytes(range(256)) * 100
+        header = b"ScreenShot BMP, %d\n" % len(payload)
+        self.client_side.sendall(header)
+        self.assertEqual(reader.recv_from(self.server_side), [])
+        self.assertTrue(reader.receiving_payload())
+        self.assertEqual(reader.start, reader.end)
+
+        self.client_side.sendall(payload + frame("ProcessJSON", b'{}'))
+        frames = self.receive(reader, 2)
+        self.assertEqual(bytes(frames[0].payload), payload)
+        self.assertEqual(bytes(frames[1].payload), b'{}')
+        self.assertEqual(reader.received_bytes, len(payload) + len(header) + len(frame("ProcessJSON", b'{}')))
+
+    def test_closed_connection(self):
+        reader = FrameReader()
+        self.client_side.sendall(b"ProcessJSON, 10\n{")
+        self.assertEqual(reader.recv_from(self.server_side), [])
+        self.client_side.close()
+        self.assertIsNone(reader.recv_from(self.server_side))
+        reader.close()
+
+    def test_oversized_header(self):
+        reader = FrameReader(max_header_size=32)
+        self.client_side.sendall(b"x" * 100)
+        with self.assertRaises(ProtocolError):
+            reader.recv_from(self.server_side)
+
+
+class FileSinkTest(unittest.TestCase):
+    def setUp(self):
+        self.temp = tempfile.TemporaryDirectory()
+        self.spool_dir = os.path.join(self.temp.name, 'incoming')
+
+    def tearDown(self):
+        self.temp.cleanup()
+
+    def test_write_and_recv_into(self):
+        sink = FileSink(10, self.spool_dir)
+        self.assertTrue(os.path.exists(sink.path))
+        self.assertEqual(os.path.getsize(sink.path), 10)
+        sink.write(memoryview(b'abc'))
+        with sink.buffer(100) as target:
+            self.assertEqual(len(target), 7)
+            target[:4] = b'defg'
+        sink.commit(4)
+        sink.write(memoryview(b'hij'))
+        payload = sink.finish()
+        self.assertEqual(bytes(payload), b'abcdefghij')
+        sink.cleanup()
+        self.assertFalse(os.path.exists(sink.path))
+
+    def test_discard(self):
+        sink = FileSink(10, self.spool_dir)
+        sink.write(memoryview(b'abc'))
+        sink.discard()
+        self.assertFalse(os.path.exists(sink.path))
+
+    def test_file_command(self):
+        reader = FrameReader(spool_dir=self.spool_dir, file_commands=("ScreenShot BMP",))
+        payload = bytes(range(256)) * 40
+        frames = feed_all(reader, split(frame("ScreenShot BMP", payload) + frame("ProcessJSON", b'{}'), 1000))
+        path = frames[0].path
+        self.assertTrue(os.path.exists(path))
+        self.assertEqual(bytes(frames[0].payload), payload)
+        self.assertIsNone(frames[1].path)
+
+        frames[0].release()
+        self.assertFalse(os.path.exists(path))
+
+    def test_budget_exhausted(self):
+        budget = MemoryBudget(limit=100)
+        reader = FrameReader(budget=budget, spool_dir=self.spool_dir)
+        small, large = reader.feed(frame("ProcessJSON", b'x' * 60) + frame("ProcessJSON", b'y' * 60))
+        self.assertIsNone(small.path)
+        self.assertIsNotNone(large.path)
+        self.assertEqual(bytes(large.payload), b'y' * 60)
+        self.assertEqual(budget.metrics()['used'], 60)
+        self.assertEqual(budget.metrics()['spooled'], 1)
+
+        small.release()
+        large.release()
+        self.assertEqual(budget.metrics()['used'], 0)
+        self.assertEqual(os.listdir(self.spool_dir), [])
+
+    def test_recv_into_file(self):
+        reader = FrameReader(spool_dir=self.spool_dir, file_commands=("ScreenShot BMP",), recv_size=1000)
+        payload = os.urandom(50000)
+        server_side, client_side = socket.socketpair()
+        with server_side, client_side:
+            server_side.settimeout(5)
+            client_side.sendall(b"ScreenShot BMP, %d\n" % len(payload))
+            self.assertEqual(reader.recv_from(server_side), [])
+            client_side.sendall(payload)
+            frames = []
+            while not frames:
+                frames = reader.recv_from(server_side)
+        self.assertEqual(bytes(frames[0].payload), payload)
+        frames[0].release()
+        self.assertEqual(os.listdir(self.spool_dir), [])
+
+    def test_connection_closed_during_payload(self):
+        reader = FrameReader(spool_dir=self.spool_dir, file_commands=("ScreenShot BMP",))
+        reader.feed(b"ScreenShot BMP, 1000\n" + b'x' * 10)
+        self.assertEqual(len(os.listdir(self.spool_dir)), 1)
+        reader.close()
+        self.assertEqual(os.listdir(self.spool_dir), [])
+
+
+class FrameReaderV2Test(unittest.TestCase):
+    PROCESSES = json.dumps([{'name': f"process{i}.exe", 'pid': i} for i in range(200)]).encode('utf-8')
+    SCREEN = bytes(range(256)) * 400
+
+    def stream(self, codec: str = None) -> bytes:
+        return (encode_frame(FRAME_TYPE_IDS["ProcessJSON"], self.PROCESSES, request_id=7, codec=codec)
+                + encode_frame(FRAME_TYPE_IDS["Command"], b'', request_id=8)
+                + encode_frame(FRAME_TYPE_IDS["ScreenShot BMP"], self.SCREEN, request_id=9, codec=codec))
+
+    def assert_frames(self, frames: list) -> None:
+        self.assertEqual([(f.command, f.request_id) for f in frames],
+                         [("ProcessJSON", 7), ("Command", 8), ("ScreenShot BMP", 9)])
+        self.assertEqual(bytes(frames[0].payload), self.PROCESSES)
+        self.assertEqual(bytes(frames[1].payload), b'')
+        self.assertEqual(bytes(frames[2].payload), self.SCREEN)
+
+    def test_encode_frame(self):
+        data = encode_frame(FRAME_TYPE_IDS["ProcessJSON"], self.PROCESSES, request_id=3, codec='zlib')
+        magic, frame_type, flags, request_id, size, raw_size = FRAME_V2.unpack_from(data)
+        self.assertEqual((magic, frame_type, flags, request_id), (FRAME_V2_MAGIC, FRAME_TYPE_IDS["ProcessJSON"], FRAME_CODEC_IDS['zlib'], 3))
+        self.assertEqual(raw_size, len(self.PROCESSES))
+        self.assertEqual(size, len(data) - FRAME_V2.size)
+        self.assertEqual(zlib.decompress(data[FRAME_V2.size:]), self.PROCESSES)
+
+    def test_incompressible_payload_sent_as_is(self):
+        payload = os.urandom(1000)
+        data = encode_frame(FRAME_TYPE_IDS["ScreenShot BMP"], payload, codec='zlib')
+        self.assertEqual(FRAME_V2.unpack_from(data)[2], 0)
+        self.assertEqual(data[FRAME_V2.size:], payload)
+
+    def test_codecs(self):
+        for codec in (None,) + SUPPORTED_CODECS:
+            with self.subTest(codec=codec):
+                self.assert_frames(FrameReaderV2().feed(self.stream(codec)))
+
+    def test_byte_by_byte(self):
+        for codec in (None, 'zlib'):
+            with self.subTest(codec=codec):
+                reader = FrameReaderV2(buffer_size=64)
+                self.assert_frames(feed_all(reader, split(self.stream(codec), 1)))
+                self.assertFalse(reader.receiving_payload())
+
+    def test_header_split_from_payload(self):
+        data = self.stream('zlib')
+        reader = FrameReaderV2()
+        self.assertEqual(reader.feed(data[:FRAME_V2.size - 3]), [])
+        self.assertEqual(reader.feed(data[FRAME_V2.size - 3:FRAME_V2.size]), [])
+        self.assertTrue(reader.receiving_payload())
+        self.assert_frames(reader.feed(data[FRAME_V2.size:]))
+
+    def test_recv_into(self):
+        reader = FrameReaderV2(recv_size=1000)
+        server_side, client_side = socket.socketpair()
+        with server_side, client_side:
+            server_side.settimeout(5)
+            client_side.sendall(self.stream(None) + self.stream('zlib'))
+            frames = []
+            while len(frames) < 6:
+                frames.extend(reader.recv_from(server_side))
+        self.assert_frames(frames[:3])
+        self.assert_frames(frames[3:])
+
+    def test_unknown_type(self):
+        data = FRAME_V2.pack(FRAME_V2_MAGIC, 99, 0, 1, 2, 2) + b'{}'
+        frames = FrameReaderV2().feed(data + encode_frame(FRAME_TYPE_IDS["ProcessJSON"], b'[]'))
+        self.assertEqual([f.command for f in frames], ["Unknown type 99", "ProcessJSON"])
+        self.assertEqual(bytes(frames[1].payload), b'[]')
+
+    def test_invalid_headers(self):
+        headers = {
+            'magic': FRAME_V2.pack(b'XX', 3, 0, 0, 2, 2),
+            'codec': FRAME_V2.pack(FRAME_V2_MAGIC, 3, 3, 0, 2, 2),
+            'uncompressed size mismatch': FRAME_V2.pack(FRAME_V2_MAGIC, 3, 0, 0, 2, 5),
+            'empty frame with payload': FRAME_V2.pack(FRAME_V2_MAGIC, 3, 1, 0, 2, 0),
+            'unknown type larger than header': FRAME_V2.pack(FRAME_V2_MAGIC, 99, 0, 0, 1000, 1000),
+        }
+        if 'lz4' not in SUPPORTED_CODECS:
+            headers['lz4'] = FRAME_V2.pack(FRAME_V2_MAGIC, 3, FRAME_CODEC_IDS['lz4'], 0, 2, 2)
+        for name, header in headers.items():
+            with self.subTest(name), self.assertRaises(ProtocolError):
+                FrameReaderV2().feed(header)
+
+    def test_size_limit(self):
+        reader = FrameReaderV2(max_sizes={"ScreenShot BMP": 1000})
+        with self.assertRaises(ProtocolError):
+            reader.feed(encode_frame(FRAME_TYPE_IDS["ScreenShot BMP"], bytes(2000), codec='zlib')[:FRAME_V2.size])
+
+    def test_decompressed_larger_than_declared(self):
+        compressed = zlib.compress(bytes(100000))
+        header = FRAME_V2.pack(FRAME_V2_MAGIC, FRAME_TYPE_IDS["ScreenShot BMP"], FRAME_CODEC_IDS['zlib'], 0, len(compressed), 1000)
+        with self.assertRaises(ProtocolError):
+            FrameReaderV2().feed(header + compressed)
+
+    def test_decompressed_smaller_than_declared(self):
+        compressed = zlib.compress(bytes(1000))
+        header = FRAME_V2.pack(FRAME_V2_MAGIC, FRAME_TYPE_IDS["ScreenShot BMP"], FRAME_CODEC_IDS['zlib'], 0, len(compressed), 2000)
+        with self.assertRaises(ProtocolError):
+            FrameReaderV2().feed(header + compressed)
+
+
+class HandshakeTest(unittest.TestCase):
+    def test_v1_split(self):
+        answer = b"MAC_ADDRESS, 1700:11:22:33:44:55" + b"ProcessJSON, 2\n{}"
+        handshake = Handshake()
+        for i, byte in enumerate(split(answer, 1)):
+            if handshake.feed(byte):
+                break
+        self.assertEqual(i, 31)
+        self.assertEqual((handshake.version, handshake.mac), (1, "00:11:22:33:44:55"))
+
+    def test_v1_rest(self):
+        handshake = Handshake()
+        self.assertTrue(handshake.feed(b"MAC_ADDRESS, 1700:11:22:33:44:55ProcessJSON, 2\n{}"))
+        self.assertEqual(handshake.rest, b"ProcessJSON, 2\n{}")
+
+    def test_v2(self):
+        hello = encode_frame(FRAME_TYPE_IDS["Hello"], json.dumps({'mac': "00:11:22:33:44:55", 'codecs': ['brotli', 'zlib']}).encode('utf-8'))
+        rest = encode_frame(FRAME_TYPE_IDS["ProcessJSON"], b'{}')
+        handshake = Handshake()
+        self.assertFalse(handshake.feed(hello[:1]))
+        self.assertFalse(handshake.feed(hello[1:FRAME_V2.size + 3]))
+        self.assertTrue(handshake.feed(hello[FRAME_V2.size + 3:] + rest))
+        self.assertEqual((handshake.version, handshake.mac, handshake.codec), (2, "00:11:22:33:44:55", 'zlib'))
+        self.assertEqual(handshake.rest, rest)
+        self.assertEqual(json.loads(handshake.reply()[FRAME_V2.size:]), {'version': 2, 'codec': 'zlib'})
+
+    def test_invalid(self):
+        answers = (
+            b"HELLO",
+            b"MAC_ADDRESS, xx",
+            b"MAC_ADDRESS, 99",
+            encode_frame(FRAME_TYPE_IDS["ProcessJSON"], b'{}'),
+            encode_frame(FRAME_TYPE_IDS["Hello"], b'not json'),
+            encode_frame(FRAME_TYPE_IDS["Hello"], b'{"codecs": []}'),
+        )
+        for answer in answers:
+            with self.subTest(answer=answer), self.assertRaises(ProtocolError):
+                Handshake().feed(answer)
+
+    def test_closed(self):
+        with self.assertRaises(ConnectionResetError):
+            Handshake().feed(b'')
+
+
+class LocalHTTPServerTest(unittest.TestCase):
+    def setUp(self):
+        self.requests = []
+        echo = lambda query: self.requests.append(query) or (200, 'application/json', json.dumps(query))
+        self.http = LocalHTTPServer(0, {'/get': echo}, post_routes={'/post': echo})
+
+    def tearDown(self):
+        self.http.close()
+
+    def request(self, path: str, data: bytes = None, headers: dict = None) -> tuple:
+        request = urllib.request.Request(f"http://127.0.0.1:{self.http.port}{path}", data=data, headers=headers or {})
+        try:
+            with urllib.request.urlopen(request, timeout=5) as response:
+                return response.status, response.read()
+        except urllib.error.HTTPError as e:
+            return e.code, e.read()
+
+    def test_get(self):
+        self.assertEqual(self.request('/get?a=1'), (200, b'{"a": "1"}'))
+        self.assertEqual(self.request('/post')[0], 404)
+
+    def test_post(self):
+        headers = {'Content-Type': 'application/json', LocalHTTPServer.TOKEN_HEADER: self.http.token}
+        self.assertEqual(self.request('/post?b=2', b'{"a": 1}', headers), (200, b'{"a": 1}'))
+        self.assertEqual(self.request('/post', b'[1]', headers)[0], 400)
+        self.assertEqual(self.request('/post', b'{', headers)[0], 400)
+        self.assertEqual(self.request('/missing', b'{}', headers)[0], 404)
+
+    def test_post_rejected_without_token_or_json(self):
+        token = {LocalHTTPServer.TOKEN_HEADER: self.http.token}
+        cases = [
+            (403, {'Content-Type': 'application/json'}),
+            (403, {'Content-Type': 'application/json', LocalHTTPServer.TOKEN_HEADER: self.http.token[:-1]}),
+            (415, {**token, 'Content-Type': 'application/x-www-form-urlencoded'}),
+            (415, {**token, 'Content-Type': 'text/plain'}),
+        ]
+        for status, headers in cases:
+            with self.subTest(headers=headers):
+                self.assertEqual(self.request('/post', b'{"a": 1}', headers)[0], status)
+        self.assertEqual(self.requests, [])
+
+
+class ClientDatabaseTest(unittest.TestCase):
+    MAC = "AA:BB:CC:DD:EE:FF"
+
+    def setUp(self):
+        self.temp = tempfile.TemporaryDirectory()
+        self.fname = os.path.join(self.temp.name, 'clients_db.json')
+        self.databases = []
+
+    def tearDown(self):
+        for database in self.databases:
+            database.close()
+        self.temp.cleanup()
+
+    def open(self, **kwargs) -> ClientDatabase:
+        database = ClientDatabase(self.fname, compact_events=1000, flush_interval=0.01, **kwargs)
+        self.databases.append(database)
+        return database
+
+    def crash(self, database: ClientDatabase) -> None:
+        """Wait until every event is journaled and leave database without close()."""
+        for _ in range(500):
+            if os.path.exists(database.journal_fname):
+                with open(database.journal_fname, 'rb') as f:
+                    if f.read().count(b'\n') >= database.seq - database.snapshot_seq:
+                        break
+            time.sleep(0.01)
+        else:
+            self.fail("Writer didn't journal events")
+        self.databases.remove(database)
+
+    def sessions(self, database: ClientDatabase, count: int, close_last: bool = True) -> None:
+        database.create_client(self.MAC)
+        for i in range(count):
+            database.update_client_connection(self.MAC, f"10.0.0.{i}", 1000 + i, 'connected')
+            if close_last or i < count - 1:
+                database.update_client_connection(self.MAC, f"10.0.0.{i}", 1000 + i, 'disconnected')
+
+    @staticmethod
+    def state(database: ClientDatabase) -> tuple:
+        return (database.seq, json.loads(json.dumps(database.clients_data)),
+                json.loads(json.dumps(database.get_history(ClientDatabaseTest.MAC))))
+
+    def test_reopen_without_close(self):
+        database = self.open()
+        self.sessions(database, 3, close_last=False)
+        expected = self.state(database)
+        self.crash(database)
+
+        reopened = self.open()
+        self.assertEqual(self.state(reopened), expected)
+        info = reopened.get_client_info(self.MAC)
+        self.assertEqual(info['total_connections'], 3)
+        self.assertEqual(info['status'], 'online')
+        self.assertIsNone(reopened.get_connection_history(self.MAC)[-1]['disconnected_at'])
+
+    def test_crash_between_snapshot_and_journal_truncation(self):
+        database = self.open()
+        self.sessions(database, 2)
+        self.crash(database)
+        # Snapshot is written, journal still has all its events
+        database.save_database()
+        expected = self.state(database)
+
+        reopened = self.open()
+        self.assertEqual(self.state(reopened), expected)
+        self.assertEqual(reopened.get_client_info(self.MAC)['total_connections'], 2)
+        self.assertEqual(len(reopened.get_connection_history(self.MAC)), 2)
+
+    def test_crash_between_history_and_index(self):
+        database = self.open()
+        self.sessions(database, 1)
+        database.close()
+        database = self.open()
+        self.sessions(database, 2)
+        self.crash(database)
+
+        # History is ahead of index, its events are replayed to index only
+        def failing_write_index(snapshot_seq, index=None):
+            raise OSError("disk is full")
+        database.write_index = failing_write_index
+        expected = self.state(database)
+        with self.assertRaises(OSError):
+            database.save_database()
+
+        reopened = self.open()
+        self.assertEqual(self.state(reopened), expected)
+        info = reopened.get_client_info(self.MAC)
+        self.assertEqual(info['total_connections'], 3)
+        history = reopened.get_connection_history(self.MAC)
+        self.assertEqual(len(history), 3)
+        self.assertAlmostEqual(info['total_online_seconds'], sum(conn['Time_Online'] for conn in history))
+
+    def test_torn_last_journal_line(self):
+        database = self.open()
+        self.sessions(database, 2)
+        expected = self.state(database)
+        self.crash(database)
+        with open(database.journal_fname, 'a', encoding='utf-8') as f:
+            f.write('{"event": "connected", "mac": "' + self.MAC + '", "seq": ')
+
+        reopened = self.open()
+        self.assertEqual(self.state(reopened), expected)
+
+        # Events journaled after the cut line are replayed too
+        reopened.update_client_connection(self.MAC, "10.0.0.9", 1009, 'connected')
+        expected = self.state(reopened)
+        self.crash(reopened)
+        self.assertEqual(self.state(self.open()), expected)
+
+    def test_migrate_old_database(self):
+        history = [
+            {'connected_at': "2024-01-01T10:00:00", 'ip': "10.0.0.1", 'port': 1001,
+             'disconnected_at': "2024-01-01T11:00:00", 'Time_Online': "1:00:00"},
+            {'connected_at': "2024-01-01T23:00:00", 'ip': "10.0.0.2", 'port': 1002,
+             'disconnected_at': "2024-01-03T00:00:00.500000", 'Time_Online': "1 day, 1:00:00.500000"},
+            {'connected_at': "2024-01-03T09:00:00", 'ip': "10.0.0.2", 'port': 1003,
+             'disconnected_at': None, 'Time_Online': None},
+        ]
+        with open(self.fname, 'w', encoding='utf-8') as f:
+            json.dump({self.MAC: {'mac': self.MAC, 'ip': "10.0.0.2", 'port': 1003, 'first_seen': "2024-01-01T10:00:00",
+                                  'last_seen': "2024-01-03T09:00:00", 'total_connections': 3, 'status': 'online',
+                                  'connection_history': history}}, f)
+
+        database = self.open()
+        self.assertTrue(os.path.exists(f"{self.fname}.migrated"))
+        self.assertFalse(os.path.exists(self.fname))
+        info = database.get_client_info(self.MAC)
+        self.assertEqual([conn['Time_Online'] for conn in info['connection_history']], [3600.0, 90000.5, None])
+        self.assertEqual(info['connection_history'], database.get_connection_history(self.MAC))
+        self.assertEqual(info['connection_rollups'], {
+            '2024-01-01': {'sessions': 2, 'online_seconds': 93600.5, 'ips': ["10.0.0.1", "10.0.0.2"]},
+            '2024-01-03': {'sessions': 1, 'online_seconds': 0.0, 'ips': ["10.0.0.2"]},
+        })
+        self.assertEqual(info['total_online_seconds'], 93600.5)
+        self.assertEqual(info['total_connections'], 3)
+        database.close()
+        self.databases.remove(database)
+
+        reopened = self.open()
+        self.assertEqual(reopened.get_client_info(self.MAC), info)
+
+        # Open session of old database is closed by new event
+        reopened.update_client_connection(self.MAC, "10.0.0.2", 1003, 'disconnected')
+        reopened.close()
+        self.databases.remove(reopened)
+        history = self.open().get_connection_history(self.MAC)
+        self.assertEqual(len(history), 3)
+        self.assertIsNotNone(history[-1]['Time_Online'])
+
+    def test_upgrade_client(self):
+        database = self.open(history_limit=2)
+        client_data = {'mac': self.MAC, 'connection_history': [
+            {'connected_at': "2024-01-01T23:30:00", 'ip': "10.0.0.1", 'port': 1001,
+             'disconnected_at': "2024-01-02T00:30:00", 'Time_Online': "1:00:00"},
+            {'connected_at': "2024-01-02T08:00:00", 'ip': "10.0.0.2", 'port': 1002,
+             'disconnected_at': "2024-01-02T08:00:01.250000", 'Time_Online': "0:00:01.250000"},
+            {'connected_at': "2024-01-02T09:00:00", 'ip': "10.0.0.1", 'port': 1003,
+             'disconnected_at': None, 'Time_Online': None},
+        ]}
+        database.upgrade_client(client_data)
+
+        # Session is counted in the day it was started, older sessions stay in rollups only
+        self.assertEqual(client_data['connection_rollups'], {
+            '2024-01-01': {'sessions': 1, 'online_seconds': 3600.0, 'ips': ["10.0.0.1"]},
+            '2024-01-02': {'sessions': 2, 'online_seconds': 1.25, 'ips': ["10.0.0.2", "10.0.0.1"]},
+        })
+        self.assertEqual(client_data['total_online_seconds'], 3601.25)
+        self.assertEqual([conn['Time_Online'] for conn in client_data['connection_history']], [1.25, None])
+
+        # Upgraded client is left as is
+        upgraded = json.loads(json.dumps(client_data))
+        database.upgrade_client(client_data)
+        self.assertEqual(client_data, upgraded)
+
+    def test_rollups_across_midnight(self):
+        database = self.open()
+        database.create_client(self.MAC)
+        events = [('connected', "2024-01-01T23:30:00", "10.0.0.1"), ('disconnected', "2024-01-02T00:45:00", "10.0.0.1"),
+                  ('connected', "2024-01-02T23:59:59", "10.0.0.2")]
+        for name, at, ip in events:
+            database.commit_event({'event': name, 'mac': self.MAC, 'ip': ip, 'port': 1000, 'time': at})
+
+        info = database.get_client_info(self.MAC)
+        self.assertEqual(info['connection_rollups'], {
+            '2024-01-01': {'sessions': 1, 'online_seconds': 4500.0, 'ips': ["10.0.0.1"]},
+            '2024-01-02': {'sessions': 1, 'online_seconds': 0.0, 'ips': ["10.0.0.2"]},
+        })
+        self.assertEqual(info['total_online_seconds'], 4500.0)
+        self.assertIsNone(info['connection_history'][-1]['Time_Online'])
+
+        database.commit_event({'event': 'disconnected', 'mac': self.MAC, 'ip': "10.0.0.2", 'port': 1000,
+                               'time': "2024-01-03T00:00:09"})
+        info = database.get_client_info(self.MAC)
+        self.assertEqual(info['connection_rollups']['2024-01-02']['online_seconds'], 10.0)
+        self.assertNotIn('2024-01-03', info['connection_rollups'])
+        self.assertEqual(info['total_online_seconds'], 4510.0)
+
+
+class ParseTimedeltaTest(unittest.TestCase):
+    def test_str_of_timedelta(self):
+        for value in (timedelta(0), timedelta(seconds=59), timedelta(hours=1), timedelta(days=1, hours=1),
+                      timedelta(days=2, seconds=3, microseconds=500000), timedelta(days=400, microseconds=1)):
+            with self.subTest(value=str(value)):
+                self.assertEqual(parse_timedelta(str(value)), value)
+
+    def test_legacy_values(self):
+        self.assertEqual(parse_timedelta("1 day, 1:00:00"), timedelta(hours=25))
+        self.assertEqual(parse_timedelta("3 days, 0:00:01.5"), timedelta(days=3, seconds=1.5))
+        self.assertEqual(parse_timedelta("12:34:56"), timedelta(hours=12, minutes=34, seconds=56))
+
+
+class ProcessStoreTest(unittest.TestCase):
+    MAC = "AA:BB:CC:DD:EE:FF"
+
+    def setUp(self):
+        self.temp = tempfile.TemporaryDirectory()
+        self.logs = []
+        self.flushes = 0
+        self.store = ProcessStore(os.path.join(self.temp.name, 'processes.db'),
+                                  log=lambda mac, text: mac == self.MAC and self.logs.append(text))
+
+    def tearDown(self):
+        self.store.close()
+        self.temp.cleanup()
+
+    @staticmethod
+    def processes(*exes) -> str:
+        return json.dumps({'processes': [{'exe': exe, 'pid': pid} for pid, exe in enumerate(exes, 1)]})
+
+    def running(self) -> list:
+        return sorted(row['exe'] for row in self.store.exes_by_host(self.MAC) if row['last_seen'] is None)
+
+    def flush(self) -> None:
+        """Wait until queued lists are written: writer takes tasks in order."""
+        self.flushes += 1
+        marker = f"flush {self.flushes}"
+        self.store.ingest(marker, self.processes())
+        for _ in range(500):
+            if marker in self.store.last_state:
+                return
+            time.sleep(0.01)
+        self.fail("Writer didn't write queued lists")
+
+    def test_changes(self):
+        self.store.ingest(self.MAC, self.processes('a.exe', 'b.exe'))
+        self.store.ingest(self.MAC, self.processes('a.exe', 'c.exe'))
+        self.flush()
+        self.assertEqual(self.running(), ['a.exe', 'c.exe'])
+        self.assertEqual(len(self.logs), 2)
+
+        self.store.forget(self.MAC)
+        self.flush()
+        self.assertEqual(self.running(), [])
+        self.assertNotIn(self.MAC, self.store.last_state)
+
+    def test_failed_batch_keeps_state(self):
+        self.store.ingest(self.MAC, self.processes('a.exe', 'b.exe'))
+        self.flush()
+        state = self.store.last_state[self.MAC]
+        logs = len(self.logs)
+
+        # Batch is rolled back after its changes were written
+        failed = threading.Event()
+        write_changes = self.store.write_changes
+        def failing_write_changes(connection, client_mac, ts, message):
+            write_changes(connection, client_mac, ts, message)
+            failed.set()
+            raise sqlite3.OperationalError("database is locked")
+        self.store.write_changes = failing_write_changes
+        self.store.ingest(self.MAC, self.processes('a.exe', 'c.exe'))
+        self.assertTrue(failed.wait(5))
+        self.store.write_changes = write_changes
+
+        self.store.ingest(self.MAC, self.processes('a.exe', 'd.exe'))
+        self.flush()
+        self.assertIsNot(self.store.last_state[self.MAC], state)
+        self.assertEqual(self.store.last_state[self.MAC]['processes'], {1: 'a.exe', 2: 'd.exe'})
+        self.assertEqual(self.running(), ['a.exe', 'd.exe'])
+        self.assertEqual(self.logs[logs:], ["- b.exe (2)\n+ d.exe (2)"])
+
+
+class ClientRegistryTest(unittest.TestCase):
+    MAC = "AA:BB:CC:DD:EE:FF"
+
+    def setUp(self):
+        self.clients = ClientRegistry()
+
+    def assertConsistent(self) -> None:
+        sessions = self.clients.snapshot()
+        self.assertEqual(len(self.clients), len(sessions))
+        self.assertEqual([session.number for session in sessions], sorted(session.number for session in sessions))
+        self.assertEqual(sum(len(self.clients.by_ip(ip)) for ip in {session.ip for session in sessions}), len(sessions))
+        for session in sessions:
+            self.assertIs(self.clients.get(session.mac), session)
+            self.assertIs(self.clients.by_number(session.number), session)
+            self.assertIn(session, self.clients.by_ip(session.ip))
+
+    def test_register_and_lookup(self):
+        first = ClientSession(None, '10.0.0.1', 1001, self.MAC)
+        second = ClientSession(None, '10.0.0.1', 1002, "AA:BB:CC:DD:EE:00")
+        third = ClientSession(None, '10.0.0.2', 1003, "AA:BB:CC:DD:EE:01")
+        for session in (first, second, third):
+            self.assertIsNone(self.clients.register(session))
+        self.assertConsistent()
+        self.assertEqual(self.clients.snapshot(), [first, second, third])
+        self.assertEqual(self.clients.by_ip('10.0.0.1'), [first, second])
+        self.assertEqual(self.clients.by_ip('10.0.0.3'), [])
+
+        self.assertTrue(self.clients.unregister(second))
+        self.assertFalse(self.clients.unregister(second))
+        self.assertConsistent()
+        self.assertEqual(self.clients.by_ip('10.0.0.1'), [first])
+        self.assertIsNone(self.clients.get(second.mac))
+        self.assertIsNone(self.clients.by_number(second.number))
+
+    def test_duplicate_mac_replaces_session(self):
+        old = ClientSession(None, '10.0.0.1', 1001, self.MAC)
+        new = ClientSession(None, '10.0.0.2', 1002, self.MAC)
+        self.clients.register(old)
+        self.assertIs(self.clients.register(new), old)
+        self.assertConsistent()
+        self.assertEqual(self.clients.snapshot(), [new])
+        self.assertGreater(new.number, old.number)
+        self.assertEqual(self.clients.by_ip('10.0.0.1'), [])
+
+        # Handler of replaced session doesn't remove the new one
+        self.assertFalse(self.clients.unregister(old))
+        self.assertIs(self.clients.get(self.MAC), new)
+        self.assertTrue(self.clients.unregister(new))
+        self.assertEqual(len(self.clients), 0)
+
+    def test_contention(self):
+        # Every session ends up replaced, unregistered or registered, exactly one of them
+        outcomes = {}
+        lock = threading.Lock()
+
+        def connect(seed: int) -> None:
+            generator = random.Random(seed)
+            for port in range(300):
+                session = ClientSession(None, f"10.0.0.{generator.randrange(3)}", seed * 1000 + port,
+                                        f"AA:BB:CC:DD:EE:0{generator.randrange(5)}")
+                replaced = self.clients.register(session)
+                with lock:
+                    outcomes[session] = []
+                    if replaced is not None:
+                        outcomes[replaced].append('replaced')
+                if generator.random() < 0.5 and self.clients.unregister(session):
+                    with lock:
+                        outcomes[session].append('unregistered')
+
+        threads = [threading.Thread(target=connect, args=(seed,)) for seed in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertConsistent()
+        registered = set(self.clients.snapshot())
+        for session, outcome in outcomes.items():
+            self.assertEqual(len(outcome) + (session in registered), 1, (session.mac, session.port, outcome))
+
+
+class ServerRegistrationTest(unittest.TestCase):
+    MAC = "AA:BB:CC:DD:EE:FF"
+
+    def setUp(self):
+        self.temp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.temp.cleanup)
+        self.addCleanup(os.chdir, os.getcwd())
+        os.chdir(self.temp.name)
+        self.server = Server()
+        self.addCleanup(self.server.close_storages)
+
+    def connect(self, client_ip: str, client_port: int) -> tuple:
+        server_side, client_side = socket.socketpair()
+        self.addCleanup(server_side.close)
+        self.addCleanup(client_side.close)
+        client_side.settimeout(5)
+        return self.server.register_client(server_side, client_ip, client_port, self.MAC), client_side
+
+    def test_duplicate_connection_replaces_and_closes_old_one(self):
+        old, old_client = self.connect('10.0.0.1', 1001)
+        new, _ = self.connect('10.0.0.2', 1002)
+        self.assertIs(self.server.clients.get(self.MAC), new)
+        self.assertEqual(self.server.clients.by_ip('10.0.0.1'), [])
+        self.assertEqual(old_client.recv(100), b'')
+
+        # Old handler exits after its socket is closed, new session stays
+        self.server.unregister_client(old)
+        self.assertIs(self.server.clients.get(self.MAC), new)
+        self.assertNotEqual(new.socket.fileno(), -1)
+
+        info = self.server.db.get_client_info(self.MAC)
+        self.assertEqual(info['status'], 'online')
+        self.assertEqual(info['total_connections'], 2)
+        history = info['connection_history']
+        self.assertEqual([(conn['ip'], conn['Time_Online'] is None) for conn in history], [('10.0.0.1', False), ('10.0.0.2', True)])
+
+        self.server.unregister_client(new)
+        self.assertEqual(len(self.server.clients), 0)
+        self.assertEqual(self.server.db.get_client_info(self.MAC)['status'], 'offline')
+
+
+class CommandDispatcherTest(unittest.TestCase):
+    def setUp(self):
+        self.server_side, self.client_side = socket.socketpair()
+        self.server_side.settimeout(0.1)
+        self.client_side.settimeout(5)
+        self.session = ClientSession(self.server_side, '127.0.0.1', 1, "AA:BB:CC:DD:EE:FF")
+        self.dispatcher = CommandDispatcher(workers=2, answer_timeout=1.0, write_timeout=0.5)
+
+    def tearDown(self):
+        self.dispatcher.close()
+        self.server_side.close()
+        self.client_side.close()
+
+    def assert_nothing_received(self, seconds: float = 0.3) -> None:
+        self.client_side.settimeout(seconds)
+        with self.assertRaises(socket.timeout):
+            self.client_side.recv(100)
+        self.client_side.settimeout(5)
+
+    def test_v1_command_waits_for_answer(self):
+        futures = [self.dispatcher.send(self.session, command) for command in (b"SEND_STAT", b"SEND_SCREEN", b"SEND_STAT")]
+        self.assertEqual(self.client_side.recv(100), b"SEND_STAT")
+        self.assert_nothing_received()
+        self.assertFalse(futures[1].done())
+        self.assertTrue(self.session.busy())
+
+        # Answer to other command doesn't release next one
+        self.dispatcher.answered(self.session, "ScreenShot BMP")
+        self.assert_nothing_received()
+        self.dispatcher.answered(self.session, "ProcessJSON")
+        self.assertEqual(self.client_side.recv(100), b"SEND_SCREEN")
+        self.dispatcher.answered(self.session, "ScreenShot BMP")
+        self.assertEqual(self.client_side.recv(100), b"SEND_STAT")
+        self.assertEqual([future.result(5) for future in futures], [CommandDispatcher.DELIVERED] * 3)
+
+    def test_answer_timeout(self):
+        started = time.monotonic()
+        self.dispatcher.send(self.session, b"SEND_SCREEN")
+        self.dispatcher.send(self.session, b"SEND_STAT")
+        self.assertEqual(self.client_side.recv(100), b"SEND_SCREEN")
+        self.assertEqual(self.client_side.recv(100), b"SEND_STAT")
+        self.assertGreaterEqual(time.monotonic() - started, 1.0)
+
+    def test_messages_without_answer_and_v2_are_not_held(self):
+        self.assertEqual(self.dispatcher.send(self.session, b"hello").result(5), CommandDispatcher.DELIVERED)
+        self.assertEqual(self.dispatcher.send(self.session, b"DEAUTH_REQUEST").result(5), CommandDispatcher.DELIVERED)
+        self.assertFalse(self.session.busy())
+
+        session = ClientSession(self.server_side, '127.0.0.1', 1, "AA:BB:CC:DD:EE:FF", protocol=2)
+        futures = [self.dispatcher.send(session, command) for command in (b"SEND_STAT", b"SEND_SCREEN")]
+        self.assertEqual([future.result(5) for future in futures], [CommandDispatcher.DELIVERED] * 2)
+
+    def test_slow_reader_is_not_dropped(self):
+        # Client doesn't read for longer than socket's timeout, but less than write_timeout
+        payload = bytes(4 * 1024 * 1024)
+        sending = self.dispatcher.send(self.session, payload)
+        time.sleep(0.3)
+        received = 0
+        while received < len(payload) + 5:
+            received += len(self.client_side.recv(1024 * 1024))
+            if received == len(payload):
+                self.dispatcher.send(self.session, b"hello")
+        self.assertEqual(sending.result(5), CommandDispatcher.DELIVERED)
+        self.assertFalse(self.session.broken)
+
+    def test_partial_send_closes_session(self):
+        # Client doesn't read, so only part of message fits into socket buffers
+        futures = [self.dispatcher.send(self.session, bytes(16 * 1024 * 1024)), self.dispatcher.send(self.session, b"SEND_STAT")]
+        self.assertEqual([future.result(5) for future in futures], [CommandDispatcher.TIMED_OUT, CommandDispatcher.FAILED])
+        self.assertTrue(self.session.broken)
+        self.assertEqual(self.server_side.fileno(), -1)
+        self.assertEqual(self.dispatcher.send(self.session, b"SEND_STAT").result(0), CommandDispatcher.FAILED)
+
+
+class CollectionSchedulerTest(unittest.TestCase):
+    ANSWERS = {b"SEND_STAT": "ProcessJSON", b"SEND_SCREEN": "ScreenShot BMP"}
+
+    def setUp(self):
+        self.server_side, self.client_side = socket.socketpair()
+        self.server_side.settimeout(0.1)
+        self.clients = ClientRegistry()
+        self.dispatcher = CommandDispatcher(workers=2)
+        self.uploads = UploadScheduler(self.dispatcher)
+        self.session = ClientSession(self.server_side, '127.0.0.1', 1, "AA:BB:CC:DD:EE:FF")
+        self.clients.register(self.session)
+
+    def tearDown(self):
+        self.collector.close()
+        self.uploads.close()
+        self.dispatcher.close()
+        self.server_side.close()
+        self.client_side.close()
+
+    def test_one_command_at_once_to_v1_client(self):
+        # Both commands come up on every tick
+        CollectionScheduler.STAGGER, stagger = 0.05, CollectionScheduler.STAGGER
+        self.addCleanup(setattr, CollectionScheduler, 'STAGGER', stagger)
+        self.collector = CollectionScheduler(self.clients, self.dispatcher, self.uploads, stat_interval=0.3, screen_interval=0.3)
+        self.collector.add(self.session)
+
+        received = []
+        deadline = time.monotonic() + 2.0
+        self.client_side.settimeout(0.5)
+        while time.monotonic() < deadline:
+            try:
+                command = self.client_side.recv(100)
+            except socket.timeout:
+                continue
+            received.append(command)
+            self.assertIn(command, self.ANSWERS)
+
+            # Nothing else is sent until client answers
+            time.sleep(0.1)
+            self.client_side.setblocking(False)
+            with self.assertRaises(BlockingIOError):
+                self.client_side.recv(100)
+            self.client_side.settimeout(0.5)
+
+            if command == b"SEND_SCREEN":
+                self.uploads.finished(self.session)
+            self.dispatcher.answered(self.session, self.ANSWERS[command])
+
+        self.assertGreaterEqual(received.count(b"SEND_STAT"), 2)
+        self.assertGreaterEqual(received.count(b"SEND_SCREEN"), 2)
+
+
+    def test_group_intervals(self):
+        with tempfile.TemporaryDirectory() as directory:
+            fname = os.path.join(directory, 'groups.json')
+            with open(fname, 'w', encoding='utf-8') as f:
+                json.dump([{'name': "office", 'macs': [self.session.mac], 'stat_interval': 30, 'screen_interval': 10},
+                           {'name': "lab", 'ip_prefixes': ["10.0."], 'stat_interval': 5}], f)
+            groups = CollectionScheduler.load_groups(fname)
+
+        self.collector = CollectionScheduler(self.clients, self.dispatcher, self.uploads,
+                                             stat_interval=60, screen_interval=1200, groups=groups)
+        self.assertEqual(self.collector.intervals_for(self.session), {"SEND_STAT": 30, "SEND_SCREEN": 600})
+        lab = ClientSession(None, '10.0.0.7', 1, "AA:BB:CC:DD:EE:00")
+        self.assertEqual(self.collector.intervals_for(lab), {"SEND_STAT": 5, "SEND_SCREEN": 1200})
+        other = ClientSession(None, '192.168.0.7', 1, "AA:BB:CC:DD:EE:01")
+        self.assertEqual(self.collector.intervals_for(other), {"SEND_STAT": 60, "SEND_SCREEN": 1200})
+
+
+class WriteBehindExecutorTest(unittest.TestCase):
+    def setUp(self):
+        self.temp = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.temp.cleanup()
+
+    def path(self, name: str) -> str:
+        return os.path.join(self.temp.name, name)
+
+    def paused(self, full_policy: str) -> tuple:
+        """Executor of one writer with queue of one task, writer holds the first task
+        until returned event is set."""
+        executor = WriteBehindExecutor(writers=1, max_queue=1, full_policy=full_policy, spill_dir=self.path('spill'))
+        writing = threading.Event()
+        write_batch = executor.write_batch
+        executor.write_batch = lambda batch, files: (batch and writing.wait(5), write_batch(batch, files))
+        self.addCleanup(executor.close)
+        self.addCleanup(writing.set)
+        return executor, writing
+
+    def taken(self, executor: WriteBehindExecutor) -> None:
+        """Wait until writer takes queued tasks."""
+        for _ in range(500):
+            if executor.queues[0].empty():
+                return
+            time.sleep(0.01)
+        self.fail("Writer didn't take tasks")
+
+    def read(self, name: str) -> bytes:
+        with open(self.path(name), 'rb') as f:
+            return f.read()
+
+    def test_block(self):
+        executor, writing = self.paused('block')
+        executor.write(self.path('a'), b'a')
+        self.taken(executor)
+        executor.write(self.path('b'), b'b')
+
+        blocked = threading.Thread(target=executor.write, args=(self.path('c'), b'c'))
+        blocked.start()
+        blocked.join(0.2)
+        self.assertTrue(blocked.is_alive())
+        writing.set()
+        blocked.join(5)
+        self.assertFalse(blocked.is_alive())
+
+        executor.close()
+        self.assertEqual([self.read(name) for name in 'abc'], [b'a', b'b', b'c'])
+        self.assertEqual(executor.metrics()['dropped'], 0)
+
+    def test_drop(self):
+        executor, writing = self.paused('drop')
+        written = []
+        self.assertTrue(executor.write(self.path('a'), b'a', on_written=lambda: written.append('a')))
+        self.taken(executor)
+        self.assertTrue(executor.write(self.path('b'), b'b', on_written=lambda: written.append('b')))
+        self.assertFalse(executor.write(self.path('c'), b'c', on_written=lambda: written.append('c')))
+        self.assertFalse(executor.append(self.path('d'), b'd'))
+        self.assertEqual(written, ['c'])
+
+        writing.set()
+        executor.close()
+        self.assertEqual(sorted(written), ['a', 'b', 'c'])
+        self.assertEqual([self.read(name) for name in 'ab'], [b'a', b'b'])
+        self.assertFalse(os.path.exists(self.path('c')))
+        self.assertFalse(os.path.exists(self.path('d')))
+        metrics = executor.metrics()
+        self.assertEqual((metrics['submitted'], metrics['written'], metrics['dropped']), (4, 2, 2))
+
+    def test_spill_keeps_order(self):
+        executor, writing = self.paused('spill')
+        log = self.path('log.txt')
+        executor.append(log, "0\n", 'key')
+        self.taken(executor)
+        written = []
+        for i in range(1, 10):
+            executor.append(log, f"{i}\n", 'key')
+            if i == 5:
+                # Whole file written between spilled appends
+                executor.write(self.path('state'), b'5', 'key', on_written=lambda: written.append(5))
+        executor.write(self.path('state'), b'9', 'key')
+
+        # Spilled tasks are already on disk, not in memory
+        self.assertEqual(written, [5])
+        metrics = executor.metrics()
+        self.assertEqual((metrics['spilled'], metrics['spilling']), (10, 1))
+        self.assertTrue(os.path.exists(self.path('spill/writer-0.spill')))
+
+        writing.set()
+        executor.close()
+        self.assertEqual(self.read('log.txt'), ''.join(f"{i}\n" for i in range(10)).encode())
+        self.assertEqual(self.read('state'), b'9')
+        self.assertFalse(os.path.exists(self.path('spill/writer-0.spill')))
+        metrics = executor.metrics()
+        self.assertEqual((metrics['written'], metrics['spilling'], metrics['dropped']), (12, 0, 0))
+
+    def test_spill_replay(self):
+        # Writer waits with its first task, so it doesn't read spill file itself
+        executor, _ = self.paused('spill')
+        executor.write(self.path('a'), b'a')
+        self.taken(executor)
+        tasks = [('write', self.path('ф.bin'), bytes(range(256)), None), ('append', self.path('log'), b'', None)]
+        with executor.spill_locks[0]:
+            executor.spilling[0] = True
+            for task in tasks:
+                executor.spill(0, task)
+        self.assertEqual(executor.read_spill(0), tasks)
+        self.assertFalse(executor.spilling[0])
+        self.assertEqual(executor.read_spill(0), [])
+
+
+class ScreenshotStoreTest(unittest.TestCase):
+    MAC = "AA-BB-CC-DD-EE-FF"
+
+    def setUp(self):
+        self.temp = tempfile.TemporaryDirectory()
+        self.directory = os.path.join(self.temp.name, 'screen')
+
+    def tearDown(self):
+        self.temp.cleanup()
+
+    def test_received_bmp_released_after_executor_writes_it(self):
+        # Writer waits until test lets it write
+        writing = threading.Event()
+        executor = WriteBehindExecutor(writers=1)
+        write_batch = executor.write_batch
+        executor.write_batch = lambda batch, files: (batch and writing.wait(5), write_batch(batch, files))
+        store = ScreenshotStore(self.directory, image_format='bmp', dedup=False, workers=1,
+                                executor=executor, preview_width=0)
+
+        budget = MemoryBudget()
+        bmp = make_bmp(4, 2, bytes(range(24)))
+        self.assertTrue(budget.reserve(len(bmp)))
+        released = threading.Event()
+        def release():
+            budget.release(len(bmp))
+            released.set()
+        store.submit(self.MAC, bytearray(bmp), release)
+
+        self.assertFalse(released.wait(0.3))
+        self.assertEqual(budget.used, len(bmp))
+        writing.set()
+        self.assertTrue(released.wait(5))
+        self.assertEqual(budget.used, 0)
+
+        store.close()
+        executor.close()
+        stored = os.listdir(self.directory)
+        self.assertEqual(len(stored), 1)
+        with open(os.path.join(self.directory, stored[0]), 'rb') as f:
+            self.assertEqual(f.read(), bmp)
+
+    def test_delta_frames_restored_exactly(self):
+        store = ScreenshotStore(self.directory, image_format='delta', workers=1, tile_size=16,
+                                keyframe_interval=3, keyframe_threshold=50.0, preview_width=0)
+        self.addCleanup(store.close)
+        width, height = 45, 37
+        generator = random.Random(1)
+
+        def changed(rgb: bytes, pixels: int) -> bytes:
+            rgb = bytearray(rgb)
+            for _ in range(pixels):
+                position = generator.randrange(width * height) * 3
+                rgb[position:position + 3] = generator.randbytes(3)
+            return bytes(rgb)
+
+        screens = [generator.randbytes(width * height * 3)]
+        screens.append(changed(screens[-1], 3))
+        screens.append(screens[-1])                         # Same screen, not stored
+        for _ in range(3):                                  # Last one is keyframe by interval
+            screens.append(changed(screens[-1], 3))
+        screens.append(changed(screens[-1], width * height))    # Keyframe by changed area
+        screens.append(changed(screens[-1], 1))
+
+        started = datetime(2024, 1, 1, 12, 0, 0)
+        for i, rgb in enumerate(screens):
+            bmp = make_bmp(width, height, rgb, bits=32 if i >= 6 else 24, top_down=i == 4)
+            store.store(self.MAC, started + timedelta(seconds=i), bytearray(bmp))
+            if i == 3:
+                # Keyframe is read back from disk
+                store.keyframes.clear()
+
+        kinds = [frame['kind'] for frame in store.frame_index(self.MAC)]
+        self.assertEqual(kinds, ['key', 'delta', 'delta', 'delta', 'key', 'key', 'delta'])
+        for i, rgb in enumerate(screens):
+            with self.subTest(frame=i):
+                self.assertEqual(store.read_frame(self.MAC, started + timedelta(seconds=i, milliseconds=500)),
+                                 (width, height, rgb))
+        self.assertIsNone(store.read_frame(self.MAC, started - timedelta(seconds=1)))
+
+
+@unittest.skipIf(server.np is None, "NumPy is not installed")
+class BmpPreviewTest(unittest.TestCase):
+    def test_fallback_matches_numpy(self):
+        # Pixels of every block are the same, so the middle pixel taken without NumPy
+        # equals the average; columns and rows cut from preview are random
+        generator = random.Random(2)
+        for width, height, max_width, bits, top_down in [(45, 37, 10, 24, False), (45, 37, 10, 32, True),
+                                                         (33, 7, 4, 24, False), (31, 3, 8, 32, False),
+                                                         (7, 5, 7, 24, False), (640, 481, 320, 24, False)]:
+            factor = -(-width // max_width)
+            factor_y = min(factor, height)
+            blocks = {}
+            rgb = bytearray(generator.randbytes(width * height * 3))
+            for y in range(height // factor_y * factor_y):
+                for x in range(width // factor * factor):
+                    block = blocks.setdefault((x // factor, y // factor_y), generator.randbytes(3))
+                    rgb[(y * width + x) * 3:(y * width + x) * 3 + 3] = block
+            bmp = make_bmp(width, height, bytes(rgb), bits, top_down)
+
+            with self.subTest(width=width, height=height, bits=bits, top_down=top_down):
+                preview = bmp_preview(bmp, max_width)
+                with mock.patch.object(server, 'np', None):
+                    fallback = bmp_preview(bmp, max_width)
+                self.assertEqual((fallback[0], fallback[1], bytes(fallback[2])), preview)
+                preview_width, preview_height, pixels = preview
+                self.assertEqual(pixels, b''.join(blocks[x, y] for y in range(preview_height) for x in range(preview_width)))
+
+
+if __name__ == '__main__':
+    unittest.main()